@@ -0,0 +1,12 @@
+import os
+
+from celery import Celery
+
+# Configuración de Django para los procesos de Celery
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+app = Celery('config')
+
+# Lee las variables CELERY_* de config/settings.py (broker y backend en Redis)
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
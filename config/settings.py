@@ -197,6 +197,88 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# -------------------------------------------------------------------
+# Generación de imágenes WRF
+# -------------------------------------------------------------------
+# Caché del mapa base rasterizado (una vez por dominio). Cambie la versión
+# para invalidarla, por ejemplo al modificar el dominio o el estilo del mapa.
+WRF_IMG_BASEMAP_CACHE_DIR = os.getenv('WRF_IMG_BASEMAP_CACHE_DIR', os.path.join(MEDIA_ROOT, 'cache', 'basemaps'))
+WRF_IMG_BASEMAP_CACHE_VERSION = os.getenv('WRF_IMG_BASEMAP_CACHE_VERSION', '1')
+
+# Procesos para renderizar fotogramas en paralelo (1 = secuencial, 0 = todos los núcleos)
+# y directorio de memoria compartida donde se publican los arrays para esos procesos.
+WRF_IMG_RENDER_WORKERS = int(os.getenv('WRF_IMG_RENDER_WORKERS', 1))
+WRF_IMG_RENDER_SHM_DIR = os.getenv('WRF_IMG_RENDER_SHM_DIR', '/dev/shm')
+
+# API de datos del modelo (puede apuntar a un servidor local de pruebas)
+WRF_IMG_MODEL_API_URL = os.getenv('WRF_IMG_MODEL_API_URL', 'https://modelo.cmw.insmet.cu/api/data/')
+WRF_IMG_MODEL_API_TIMEOUT = int(os.getenv('WRF_IMG_MODEL_API_TIMEOUT', 30))
+WRF_IMG_MODEL_API_WORKERS = int(os.getenv('WRF_IMG_MODEL_API_WORKERS', 4))
+WRF_IMG_MODEL_API_VERIFY_SSL = os.getenv('WRF_IMG_MODEL_API_VERIFY_SSL', 'False') == 'True'
+# Pedir los datos en formato binario (raw float32 o NPZ); si la API no lo soporta responde en JSON
+WRF_IMG_MODEL_API_BINARY = os.getenv('WRF_IMG_MODEL_API_BINARY', 'True') == 'True'
+# Las respuestas JSON se decodifican tiempo a tiempo. Con True cada fotograma se renderiza en
+# cuanto llega (la conexión queda abierta mientras tanto); con False se lee la respuesta completa
+# y se reúne en arrays antes de renderizar. En wd10 var y U10 llegan completos antes que V10 y se
+# conservan hasta que llega cada tiempo de V10.
+WRF_IMG_MODEL_API_STREAM_JSON = os.getenv('WRF_IMG_MODEL_API_STREAM_JSON', 'True') == 'True'
+
+# Caché en disco de los campos descargados (un .npy por array, leídos con memory-mapping),
+# para que volver a generar las imágenes de un ciclo no repita la descarga. Las entradas
+# menos usadas se eliminan al superar el tamaño máximo (0 = caché desactivada).
+WRF_IMG_FIELD_CACHE_DIR = os.getenv('WRF_IMG_FIELD_CACHE_DIR', os.path.join(MEDIA_ROOT, 'cache', 'fields'))
+WRF_IMG_FIELD_CACHE_MAX_MB = int(os.getenv('WRF_IMG_FIELD_CACHE_MAX_MB', 10240))
+
+# Campos de cada variable guardados por simulación para volver a renderizar, extraer puntos o
+# calcular estadísticas sin la API: 'netcdf' o 'zarr' (si está instalado), un fragmento por
+# tiempo. NetCDF se comprime con el nivel zlib WRF_IMG_FIELD_STORE_COMPLEVEL (con h5netcdf y h5py,
+# en requirements.txt, o netCDF4); sólo con scipy se escribe NetCDF3 sin comprimir. Vacío = no se guardan.
+WRF_IMG_FIELD_STORE_FORMAT = os.getenv('WRF_IMG_FIELD_STORE_FORMAT', 'netcdf')
+WRF_IMG_FIELD_STORE_COMPLEVEL = int(os.getenv('WRF_IMG_FIELD_STORE_COMPLEVEL', 4))
+# Cada fotograma se renderiza en una tarea de Celery que lee sólo ese tiempo del almacén: con
+# workers en varias máquinas MEDIA_ROOT (imágenes y almacén de campos) debe ser un directorio
+# compartido por todas. Sin almacén lo leen de WRF_IMG_FIELD_CACHE_DIR, que entonces también
+# debe ser compartido; sin almacén ni caché cada variable se renderiza en una sola tarea.
+
+# Bloqueo por ciclo: una sola ejecución genera cada initial_datetime. El bloqueo caduca si no
+# se renueva en WRF_IMG_CYCLE_LOCK_TTL segundos (proceso caído). Con 'memory://' el bloqueo
+# sólo vale dentro del proceso (tests o desarrollo sin Redis). El Redis indicado debe ser
+# accesible también desde el cron de generate_images.sh: si no lo es, los ciclos no se generan.
+WRF_IMG_CYCLE_LOCK_URL = os.getenv('WRF_IMG_CYCLE_LOCK_URL', CELERY_BROKER_URL)
+WRF_IMG_CYCLE_LOCK_TTL = int(os.getenv('WRF_IMG_CYCLE_LOCK_TTL', 900))
+
+# Codificación de las imágenes: PNG con una paleta de WRF_IMG_PNG_COLORS colores (0 = PNG RGBA
+# sin cuantizar) y formatos adicionales separados por comas ('webp', 'avif') que la API sirve
+# según la cabecera Accept, con calidad WRF_IMG_IMAGE_QUALITY (0-100).
+WRF_IMG_PNG_COLORS = int(os.getenv('WRF_IMG_PNG_COLORS', 256))
+WRF_IMG_IMAGE_FORMATS = os.getenv('WRF_IMG_IMAGE_FORMATS', '')
+WRF_IMG_IMAGE_QUALITY = int(os.getenv('WRF_IMG_IMAGE_QUALITY', 80))
+
+# Calcular el recorte de las imágenes (bbox_inches='tight') una vez por figura en lugar de en
+# cada fotograma; el resultado es el mismo. Con False se usa 'tight' en cada savefig.
+WRF_IMG_FIXED_LAYOUT = os.getenv('WRF_IMG_FIXED_LAYOUT', 'True') == 'True'
+
+# Animaciones de los fotogramas de cada variable, separadas por comas: webp, apng y webm
+# (webm necesita ffmpeg). Vacío (por defecto) para no generarlas. Milisegundos que dura cada
+# fotograma.
+WRF_IMG_ANIMATION_FORMATS = os.getenv('WRF_IMG_ANIMATION_FORMATS', '')
+WRF_IMG_ANIMATION_FRAME_MS = int(os.getenv('WRF_IMG_ANIMATION_FRAME_MS', 500))
+WRF_IMG_FFMPEG_BINARY = os.getenv('WRF_IMG_FFMPEG_BINARY', 'ffmpeg')
+
+# Teselas XYZ (Web Mercator) de la capa de datos de cada fotograma para los zooms indicados,
+# por ejemplo '5-9' o '5,7,9'. Vacío para no generarlas. Segundos que los clientes pueden
+# cachear cada tesela.
+WRF_IMG_TILE_ZOOMS = os.getenv('WRF_IMG_TILE_ZOOMS', '')
+WRF_IMG_TILE_MAX_AGE = int(os.getenv('WRF_IMG_TILE_MAX_AGE', 7 * 24 * 3600))
+
+# Guardar también la capa de datos de cada fotograma sobre fondo transparente, con una leyenda
+# por variable y un mapa base por dominio compartidos (producto por capas de la API)
+WRF_IMG_OVERLAYS = os.getenv('WRF_IMG_OVERLAYS', 'False') == 'True'
+
+# Distancia máxima (km) de una celda de la malla al municipio más cercano para pertenecer a él
+# en los agregados por municipio y provincia (más lejos, en el mar, no pertenece a ninguno)
+WRF_IMG_REGION_MAX_KM = float(os.getenv('WRF_IMG_REGION_MAX_KM', 25))
+
 # -------------------------------------------------------------------
 # Configuración de Django REST Framework y Spectacular
 # -------------------------------------------------------------------
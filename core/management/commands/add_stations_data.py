@@ -1,5 +1,7 @@
 from django.core.management.base import BaseCommand
 from station_data.models import Province, Station, Town
+from wrf_img.utils.grid_index import refresh_grid_point_indexes
+from wrf_img.utils.regions import refresh_region_masks
 
 
 class Command(BaseCommand):
@@ -44,6 +46,15 @@ class Command(BaseCommand):
         if tipo in ['estaciones', 'todo']:
             self.agregar_estaciones(province)
 
+        # Posición de las estaciones y municipios en la malla del modelo más reciente
+        rows = refresh_grid_point_indexes()
+        if rows is not None:
+            self.stdout.write(self.style.SUCCESS(f"Índice de la malla actualizado: {len(rows)} puntos"))
+        # Celdas de cada municipio y provincia
+        masks = refresh_region_masks()
+        if masks is not None:
+            self.stdout.write(self.style.SUCCESS(f"Máscaras de la malla actualizadas: {len(masks)} regiones"))
+
         self.stdout.write(self.style.SUCCESS(f"Proceso completado para {provincia_nombre}!"))
 
     def agregar_municipios(self, province):
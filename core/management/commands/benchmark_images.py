@@ -0,0 +1,101 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from wrf_img.utils import benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Ejecuta benchmarks de la generación de imágenes con datos sintéticos y muestra el resultado en JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--suite',
+            type=str,
+            choices=['decoders', 'contours', 'layout', 'pipeline'],
+            default='decoders',
+            help=(
+                'Benchmark a ejecutar (decoders: JSON vs NPZ vs raw float32; '
+                'contours: contornos reproyectados vs malla precalculada; '
+                'layout: recorte tight en cada fotograma vs calculado una vez; '
+                'pipeline: descarga, renderizado y guardado completos desde una API local)'
+            ),
+        )
+        parser.add_argument(
+            '--grid',
+            type=str,
+            default='300x700',
+            help='Tamaño de la malla en formato FILASxCOLUMNAS (por defecto: 300x700)',
+        )
+        parser.add_argument(
+            '--frames',
+            type=int,
+            default=25,
+            help='Número de tiempos del pronóstico (por defecto: 25)',
+        )
+        parser.add_argument(
+            '--variable',
+            type=str,
+            help='Variable de los datos sintéticos (por defecto: wd10 en decoders y layout, slp en contours)',
+        )
+        parser.add_argument(
+            '--variables',
+            type=str,
+            help='Variables separadas por comas para pipeline (por defecto: T2,wd10,slp)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Procesos de render para pipeline (por defecto: 1, 0 = todos los núcleos)',
+        )
+        parser.add_argument(
+            '--binary',
+            action='store_true',
+            help='En pipeline, servir los datos en raw float32/NPZ en lugar de JSON',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Repeticiones de cada medición; se reporta la mejor (por defecto: 3)',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Fichero donde guardar el resultado JSON (por defecto: salida estándar)',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            grid_shape = tuple(int(x) for x in options['grid'].lower().split('x'))
+            if len(grid_shape) != 2:
+                raise ValueError
+        except ValueError:
+            raise CommandError('Formato de malla inválido. Use FILASxCOLUMNAS (ej: 300x700)')
+
+        kwargs = {'grid_shape': grid_shape, 'frames': options['frames'], 'repeat': options['repeat']}
+        if options.get('variable'):
+            kwargs['var_name'] = options['variable']
+
+        if options['suite'] == 'decoders':
+            result = benchmarks.benchmark_decoders(**kwargs)
+        elif options['suite'] == 'contours':
+            result = benchmarks.benchmark_contours(**kwargs)
+        elif options['suite'] == 'layout':
+            result = benchmarks.benchmark_layout(**kwargs)
+        elif options['suite'] == 'pipeline':
+            kwargs.pop('var_name', None)
+            if options.get('variables'):
+                kwargs['variables'] = [v.strip() for v in options['variables'].split(',')]
+            if options.get('binary'):
+                kwargs['formats'] = ('json', 'npz', 'raw')
+            result = benchmarks.benchmark_pipeline(workers=options['workers'], **kwargs)
+
+        output = json.dumps(result, indent=2)
+        if options.get('output'):
+            with open(options['output'], 'w') as fh:
+                fh.write(output)
+            self.stdout.write(self.style.SUCCESS(f"Resultado guardado en {options['output']}"))
+        else:
+            self.stdout.write(output)
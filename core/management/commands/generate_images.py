@@ -1,11 +1,26 @@
+import cProfile
 import datetime
+import io
+import pstats
 import warnings
+from collections import deque
+from contextlib import nullcontext
 
 from django.core.management.base import BaseCommand
-from wrf_img.utils.plot_generators import generate_and_save_meteo_plot
+from wrf_img.utils.cycle_lock import CycleLease, CycleLocked, LockUnavailable, get_done_variables, mark_variable_done
+from wrf_img.utils.model_api import ModelDataClient, get_model_client
+from wrf_img.utils.plot_generators import MeteoPlotJob
+from wrf_img.utils.render_engine import RenderEngine
+from wrf_img.utils.timing import StageTimings
 
 warnings.filterwarnings('ignore')
 
+# Variables descargadas y en cola de renderizado al mismo tiempo cuando se usa el pool
+MAX_PENDING_JOBS = 2
+
+# Funciones mostradas del perfil de --profile
+PROFILE_TOP = 25
+
 
 class Command(BaseCommand):
     help = 'Genera imágenes meteorológicas para todas las variables y horas disponibles'
@@ -26,8 +41,52 @@ class Command(BaseCommand):
             type=str,
             help='Lista de horas separadas por comas (por defecto: 00,06,12,18)',
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            help='Procesos para renderizar en paralelo (por defecto: WRF_IMG_RENDER_WORKERS, 0 = todos los núcleos)',
+        )
+        cache_group = parser.add_mutually_exclusive_group()
+        cache_group.add_argument(
+            '--no-cache',
+            action='store_true',
+            help='No leer ni guardar los campos en la caché local (siempre descarga de la API)',
+        )
+        cache_group.add_argument(
+            '--refresh',
+            action='store_true',
+            help='Volver a descargar los campos aunque estén en la caché local y actualizarla',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            help='Saltar las variables ya completas del ciclo (continúa una ejecución interrumpida)',
+        )
+        parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='generate_images.prof',
+            help='Ejecutar con cProfile y guardar el perfil en el fichero indicado '
+                 '(por defecto: generate_images.prof; se abre con snakeviz o pstats)',
+        )
 
     def handle(self, *args, **options):
+        profile_path = options.get('profile')
+        if not profile_path:
+            return self.generate(options)
+
+        # Sólo se perfila este proceso: con --workers los fotogramas se renderizan en otros
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(self.generate, options)
+        finally:
+            profiler.dump_stats(profile_path)
+            self.stdout.write(f'Perfil guardado en {profile_path}')
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_TOP)
+            self.stdout.write(output.getvalue())
+
+    def generate(self, options):
         # Procesar argumentos
         target_date = options.get('date')
         if target_date:
@@ -76,31 +135,110 @@ class Command(BaseCommand):
             valid_hours = ['00', '06', '12', '18']
 
         # Ejecutar la generación de imágenes
-        success_count = 0
-        error_count = 0
+        self.success_count = 0
+        self.skipped_count = 0
+        self.error_count = 0
+        self.timings = StageTimings()
+        self.show_timings = options.get('verbosity', 1) > 1 or bool(options.get('profile'))
 
-        for variable in variables:
+        engine = RenderEngine(workers=options.get('workers'))
+        if engine.workers == 1:
+            engine = None
+        max_pending = MAX_PENDING_JOBS if engine else 0
+
+        # Las variables de cada ciclo se descargan en paralelo (una sola malla por ciclo) y se
+        # encolan mientras las anteriores se renderizan; sólo este proceso guarda en la base de datos.
+        if options.get('no_cache'):
+            client = ModelDataClient(cache=False)
+        elif options.get('refresh'):
+            client = ModelDataClient(refresh=True)
+        else:
+            client = get_model_client()
+        date_str = now.strftime('%Y%m%d')
+        with engine or nullcontext():
             for hour in valid_hours:
-                date_str = now.strftime('%Y%m%d')
                 datetime_init = date_str + hour
-
                 try:
-                    self.stdout.write(f"Generando imágenes para {variable} a las {hour}:00...")
-                    result = generate_and_save_meteo_plot(datetime_init, variable)
-                    success_count += len(result)
-                    self.stdout.write(
-                        self.style.SUCCESS(f'✓ {len(result)} imágenes generadas para {variable} a las {hour}:00')
-                    )
+                    self.generate_locked_cycle(client, engine, datetime_init, hour, variables, max_pending, options)
+                except CycleLocked as e:
+                    self.stdout.write(self.style.WARNING(f'{str(e)}. Saltando.'))
+                except LockUnavailable as e:
+                    # Sin el backend de bloqueos no se sabe si otra ejecución genera el ciclo
+                    self.error_count += 1
+                    self.stdout.write(self.style.ERROR(f'✗ Ciclo {datetime_init} sin generar - {str(e)}'))
 
-                except Exception as e:
-                    error_count += 1
-                    self.stdout.write(
-                        self.style.ERROR(f'✗ Error procesando {variable} a las {hour}:00 - {str(e)}')
-                    )
+        if client is not get_model_client():
+            client.close()
 
         # Resumen de la ejecución
         self.stdout.write(
             self.style.SUCCESS(
-                f'Proceso completado. Éxitos: {success_count}, Errores: {error_count}'
+                f'Proceso completado. Éxitos: {self.success_count}, Sin cambios: {self.skipped_count}, '
+                f'Errores: {self.error_count}'
             )
         )
+        if self.timings.totals:
+            self.stdout.write(f'Tiempos por etapa: {self.timings.format()}')
+
+    def generate_locked_cycle(self, client, engine, datetime_init, hour, variables, max_pending, options):
+        # Una sola ejecución por ciclo (otro cron o la tarea de Celery pueden coincidir)
+        with CycleLease(datetime_init) as lease:
+            if options.get('resume'):
+                # Con el bloqueo tomado: antes otra ejecución podía estar terminando estas variables
+                done_variables = get_done_variables(datetime_init)
+                variables = [v for v in variables if v not in done_variables]
+                if not variables:
+                    self.stdout.write(f"Ciclo {datetime_init} ya generado. Saltando.")
+                    return
+            self.generate_cycle(client, engine, lease, hour, variables, max_pending)
+
+    def generate_cycle(self, client, engine, lease, hour, variables, max_pending):
+        pending = deque()
+        for variable, data in client.iter_variables(lease.datetime_init, variables):
+            try:
+                if isinstance(data, Exception):
+                    raise data
+                self.stdout.write(f"Generando imágenes para {variable} a las {hour}:00...")
+                job = MeteoPlotJob(lease.datetime_init, variable, engine=engine, data=data)
+                pending.append((variable, hour, job))
+            except Exception as e:
+                self.error_count += 1
+                self.stdout.write(
+                    self.style.ERROR(f'✗ Error procesando {variable} a las {hour}:00 - {str(e)}')
+                )
+
+            while len(pending) > max_pending:
+                self.save_job(lease, *pending.popleft())
+
+        while pending:
+            self.save_job(lease, *pending.popleft())
+
+    def save_job(self, lease, variable, hour, job):
+        try:
+            # Si el bloqueo caducó otra ejecución puede estar generando el ciclo: no se guarda
+            result = job.save(before_save=lease.check)
+            self.success_count += len(result)
+            self.skipped_count += job.skipped
+            self.timings.merge(job.timings)
+            # Los fotogramas con el mismo hash de datos y configuración no se renderizan
+            skipped = f' ({job.skipped} sin cambios)' if job.skipped else ''
+            self.stdout.write(
+                self.style.SUCCESS(f'✓ {len(result)} imágenes generadas para {variable} a las {hour}:00{skipped}')
+            )
+            if self.show_timings:
+                self.stdout.write(f'  {job.timings.format()}')
+
+        except Exception as e:
+            self.error_count += 1
+            self.stdout.write(
+                self.style.ERROR(f'✗ Error procesando {variable} a las {hour}:00 - {str(e)}')
+            )
+            return
+
+        try:
+            mark_variable_done(lease.datetime_init, variable)
+        except LockUnavailable as e:
+            # Las imágenes ya están guardadas: sin la marca solo se regenera la variable con --resume
+            self.stdout.write(
+                self.style.WARNING(f'⚠ No se pudo marcar {variable} como completa - {str(e)}')
+            )
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from wrf_img.models import ForecastVerification, Simulation
+from wrf_img.utils.verification import VERIFICATION_PAIRS, summarize_verification, verify_simulation
+
+
+class Command(BaseCommand):
+    help = 'Verifica los pronósticos guardados contra las observaciones SYNOP de las estaciones'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--date-from',
+            type=str,
+            help='Primera fecha de las simulaciones en formato YYYYMMDD (por defecto: hace 30 días)'
+        )
+        parser.add_argument(
+            '--date-to',
+            type=str,
+            help='Última fecha de las simulaciones en formato YYYYMMDD (por defecto: hoy)'
+        )
+        parser.add_argument(
+            '--variables',
+            type=str,
+            help=f"Variables separadas por comas (por defecto: {','.join(VERIFICATION_PAIRS)})"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            today = timezone.now().date()
+            date_from = self.parse_date(options['date_from']) or today - timedelta(days=30)
+            date_to = self.parse_date(options['date_to']) or today
+        except ValueError:
+            raise CommandError('Formato de fecha inválido. Use YYYYMMDD (ej: 20240115)')
+
+        variables = list(VERIFICATION_PAIRS)
+        if options['variables']:
+            variables = [var.strip() for var in options['variables'].split(',') if var.strip()]
+            unknown = [var for var in variables if var not in VERIFICATION_PAIRS]
+            if unknown:
+                raise CommandError(f"Variables sin observaciones para verificar: {', '.join(unknown)}")
+
+        simulations = Simulation.objects.exclude(field_store='').filter(
+            initial_datetime__date__gte=date_from, initial_datetime__date__lte=date_to
+        ).order_by('initial_datetime')
+
+        verified = []
+        for simulation in simulations:
+            rows = verify_simulation(simulation, variables)
+            self.stdout.write(f"  {simulation.initial_datetime:%Y%m%d%H}: {len(rows)} filas")
+            if rows:
+                verified.append(simulation.pk)
+
+        if not verified:
+            self.stdout.write(self.style.WARNING('No hay pronósticos con observaciones para verificar'))
+            return
+
+        # Resumen de todo el período por variable y plazo
+        summary = summarize_verification(ForecastVerification.objects.filter(
+            simulation__in=verified, variable_name__in=variables
+        ))
+        self.stdout.write(summary.round(3).to_string())
+        self.stdout.write(self.style.SUCCESS(f"Verificadas {len(verified)} simulaciones"))
+
+    @staticmethod
+    def parse_date(value):
+        return datetime.strptime(value, '%Y%m%d').date() if value else None
@@ -14,5 +14,6 @@ esac
 # Navegar al directorio del proyecto (opcional, si es necesario)
 # cd /ruta/al/proyecto
 
-# Ejecutar el comando con el argumento correspondiente
-${DJANGODIR}/.venv/bin/python ${DJANGODIR}/manage.py generate_images --hours $HOURS_ARG
\ No newline at end of file
+# Ejecutar el comando con el argumento correspondiente. El bloqueo de cada ciclo está en el Redis
+# de WRF_IMG_CYCLE_LOCK_URL (por defecto el broker de Celery), que debe ser accesible desde aquí
+${DJANGODIR}/.venv/bin/python ${DJANGODIR}/manage.py generate_images --hours $HOURS_ARG --resume
\ No newline at end of file
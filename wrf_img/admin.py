@@ -1,6 +1,9 @@
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Simulation, MeteoImage
+from .models import (
+    Simulation, MeteoImage, MeteoAnimation, MeteoLayerSet, MeteoTileSet, GridPointIndex, ForecastVerification,
+    RegionAggregate, RegionMask,
+)
 
 
 @admin.register(Simulation)
@@ -8,7 +11,7 @@ class SimulationAdmin(admin.ModelAdmin):
     list_display = ('initial_datetime', 'created_at', 'image_count', 'variables_available')
     list_filter = ('initial_datetime', 'created_at')
     search_fields = ('initial_datetime', 'description')
-    readonly_fields = ('created_at', 'image_count', 'variables_available')
+    readonly_fields = ('created_at', 'image_count', 'variables_available', 'field_store')
 
     def image_count(self, obj):
         return obj.image_count()
@@ -26,7 +29,9 @@ class MeteoImageAdmin(admin.ModelAdmin):
     list_display = ('variable_name', 'simulation', 'valid_datetime', 'image_preview', 'created_at')
     list_filter = ('variable_name', 'simulation__initial_datetime', 'valid_datetime', 'created_at')
     search_fields = ('variable_name', 'simulation__initial_datetime')
-    readonly_fields = ('image_preview', 'data_min', 'data_max', 'data_mean', 'created_at')
+    readonly_fields = (
+        'image_preview', 'data_min', 'data_max', 'data_mean', 'data_std', 'nan_count', 'field_stats', 'created_at'
+    )
     fieldsets = (
         ('Relación', {
             'fields': ('simulation',)
@@ -35,7 +40,7 @@ class MeteoImageAdmin(admin.ModelAdmin):
             'fields': ('valid_datetime',)
         }),
         ('Datos Meteorológicos', {
-            'fields': ('variable_name', 'data_min', 'data_max', 'data_mean')
+            'fields': ('variable_name', 'data_min', 'data_max', 'data_mean', 'data_std', 'nan_count', 'field_stats')
         }),
         ('Imagen', {
             'fields': ('image', 'image_preview', 'created_at')
@@ -47,4 +52,57 @@ class MeteoImageAdmin(admin.ModelAdmin):
             return format_html('<img src="{}" width="150" height="100" style="object-fit: cover;" />', obj.image.url)
         return "No hay imagen"
 
-    image_preview.short_description = 'Vista Previa'
\ No newline at end of file
+    image_preview.short_description = 'Vista Previa'
+
+
+@admin.register(MeteoAnimation)
+class MeteoAnimationAdmin(admin.ModelAdmin):
+    list_display = ('variable_name', 'simulation', 'animation_format', 'frame_count', 'updated_at')
+    list_filter = ('animation_format', 'variable_name', 'simulation__initial_datetime')
+    search_fields = ('variable_name', 'simulation__initial_datetime')
+    readonly_fields = ('frame_count', 'frames_hash', 'updated_at')
+
+
+@admin.register(MeteoTileSet)
+class MeteoTileSetAdmin(admin.ModelAdmin):
+    list_display = ('variable_name', 'simulation', 'valid_datetime', 'min_zoom', 'max_zoom', 'tile_count')
+    list_filter = ('variable_name', 'simulation__initial_datetime')
+    search_fields = ('variable_name', 'simulation__initial_datetime')
+    readonly_fields = ('tile_dir', 'min_zoom', 'max_zoom', 'tile_count', 'created_at')
+
+
+@admin.register(MeteoLayerSet)
+class MeteoLayerSetAdmin(admin.ModelAdmin):
+    list_display = ('variable_name', 'simulation', 'updated_at')
+    list_filter = ('variable_name', 'simulation__initial_datetime')
+    search_fields = ('variable_name', 'simulation__initial_datetime')
+    readonly_fields = ('updated_at',)
+
+
+@admin.register(GridPointIndex)
+class GridPointIndexAdmin(admin.ModelAdmin):
+    list_display = ('grid_signature', 'station', 'town', 'nearest_row', 'nearest_column', 'distance_km')
+    list_filter = ('grid_signature',)
+    readonly_fields = ('updated_at',)
+
+
+@admin.register(ForecastVerification)
+class ForecastVerificationAdmin(admin.ModelAdmin):
+    list_display = ('variable_name', 'simulation', 'station', 'lead_hours', 'count', 'bias', 'mae', 'rmse')
+    list_filter = ('variable_name', 'lead_hours', 'simulation__initial_datetime')
+    readonly_fields = ('updated_at',)
+
+
+@admin.register(RegionMask)
+class RegionMaskAdmin(admin.ModelAdmin):
+    list_display = ('grid_signature', 'province', 'town', 'cell_count', 'area_km2')
+    list_filter = ('grid_signature',)
+    exclude = ('mask',)
+    readonly_fields = ('updated_at',)
+
+
+@admin.register(RegionAggregate)
+class RegionAggregateAdmin(admin.ModelAdmin):
+    list_display = ('variable_name', 'simulation', 'province', 'town', 'updated_at')
+    list_filter = ('variable_name', 'simulation__initial_datetime')
+    readonly_fields = ('updated_at',)
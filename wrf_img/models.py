@@ -1,6 +1,8 @@
 from django.db import models
 from django.utils import timezone
 import os
+import shutil
+from django.core.files.storage import default_storage
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
 
@@ -13,6 +15,10 @@ class Simulation(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     description = models.TextField(blank=True, null=True, help_text="Descripción opcional de la simulación")
+    field_store = models.CharField(
+        max_length=255, blank=True, default='',
+        help_text="Directorio (en MEDIA_ROOT) de los campos guardados de cada variable (ver field_store)"
+    )
 
     class Meta:
         ordering = ['-initial_datetime']
@@ -49,12 +55,30 @@ class MeteoImage(models.Model):
     valid_datetime = models.DateTimeField(help_text="Fecha y hora válida de la imagen (con zona horaria)")
     variable_name = models.CharField(max_length=20, help_text="Nombre de la variable meteorológica")
     image = models.ImageField(upload_to=get_upload_path, help_text="Imagen generada")
+    # Versiones opcionales en otros formatos (ver WRF_IMG_IMAGE_FORMATS)
+    image_webp = models.ImageField(upload_to=get_upload_path, blank=True, help_text="Imagen en formato WebP")
+    image_avif = models.ImageField(upload_to=get_upload_path, blank=True, help_text="Imagen en formato AVIF")
+    # Sólo la capa de datos, sobre fondo transparente (ver WRF_IMG_OVERLAYS y MeteoLayerSet)
+    overlay = models.ImageField(upload_to=get_upload_path, blank=True, help_text="Capa de datos transparente (PNG)")
     created_at = models.DateTimeField(auto_now_add=True)
 
     # Información adicional sobre los datos
     data_min = models.FloatField(null=True, blank=True)
     data_max = models.FloatField(null=True, blank=True)
     data_mean = models.FloatField(null=True, blank=True)
+    data_std = models.FloatField(null=True, blank=True)
+    nan_count = models.IntegerField(null=True, blank=True, help_text="Celdas sin dato (NaN)")
+    # Percentiles, área sobre umbrales e histograma sobre los niveles (ver wrf_img.utils.field_stats)
+    field_stats = models.JSONField(default=dict, blank=True)
+
+    # Hash de los datos y la configuración con que se renderizó (ver get_render_hash)
+    render_hash = models.CharField(max_length=64, blank=True, default='')
+
+    # Campo de la imagen en cada formato y de la capa de datos ('overlay')
+    IMAGE_FIELDS = {'png': 'image', 'webp': 'image_webp', 'avif': 'image_avif', 'overlay': 'overlay'}
+
+    # Campos de las estadísticas de cada fotograma (ver get_frame_stats)
+    STATS_FIELDS = ('data_min', 'data_max', 'data_mean', 'data_std', 'nan_count', 'field_stats')
 
     class Meta:
         indexes = [
@@ -67,6 +91,232 @@ class MeteoImage(models.Model):
     def __str__(self):
         return f"{self.variable_name} - {self.valid_datetime} (Sim: {self.simulation.initial_datetime})"
 
+    def get_image_file(self, image_format):
+        return getattr(self, self.IMAGE_FIELDS[image_format])
+
+    def available_formats(self):
+        """Formatos en que existe la imagen"""
+        return [image_format for image_format in self.IMAGE_FIELDS if self.get_image_file(image_format)]
+
+
+class MeteoAnimation(models.Model):
+    """Animación con todos los fotogramas de una variable de una simulación, en un formato"""
+
+    def get_upload_path(self, filename):
+        """
+        Genera la ruta: meteo_plots/[datetime simulacion]/[nombre variable]/[filename]
+        """
+        simulation_time = self.simulation.initial_datetime.strftime("%Y%m%d_%H%M%S")
+        return os.path.join('meteo_plots', simulation_time, self.variable_name, filename)
+
+    simulation = models.ForeignKey(
+        Simulation,
+        on_delete=models.CASCADE,
+        help_text="Simulación a la que pertenece esta animación"
+    )
+    variable_name = models.CharField(max_length=20, help_text="Nombre de la variable meteorológica")
+    animation_format = models.CharField(max_length=10, help_text="Formato de la animación (webp, apng o webm)")
+    file = models.FileField(upload_to=get_upload_path, help_text="Animación generada")
+    frame_count = models.PositiveIntegerField(default=0)
+    # Hash de los fotogramas con que se generó (ver update_meteo_animations)
+    frames_hash = models.CharField(max_length=64, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['simulation', 'variable_name', 'animation_format']
+        ordering = ['simulation', 'variable_name', 'animation_format']
+        verbose_name = 'Animación'
+        verbose_name_plural = 'Animaciones'
+
+    def __str__(self):
+        return f"{self.variable_name} ({self.animation_format}) - Sim: {self.simulation.initial_datetime}"
+
+
+class MeteoLayerSet(models.Model):
+    """
+    Capas compartidas por los fotogramas de una variable de una simulación: leyenda y mapa
+    base del dominio, sobre los que se superponen las capas de datos (MeteoImage.overlay)
+    """
+    simulation = models.ForeignKey(
+        Simulation,
+        on_delete=models.CASCADE,
+        help_text="Simulación a la que pertenecen estas capas"
+    )
+    variable_name = models.CharField(max_length=20, help_text="Nombre de la variable meteorológica")
+    # Ficheros compartidos entre simulaciones: no se borran con la fila
+    legend = models.ImageField(blank=True, help_text="Leyenda (barra de colores) de la variable")
+    basemap_under = models.ImageField(help_text="Mapa base bajo los datos (tierra y océano)")
+    basemap_over = models.ImageField(help_text="Mapa base sobre los datos (costas, fronteras y provincias)")
+    # Extensión del dominio, común a las capas de datos y al mapa base
+    lon_min = models.FloatField()
+    lon_max = models.FloatField()
+    lat_min = models.FloatField()
+    lat_max = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['simulation', 'variable_name']
+        ordering = ['simulation', 'variable_name']
+        verbose_name = 'Capas'
+        verbose_name_plural = 'Capas'
+
+    def __str__(self):
+        return f"{self.variable_name} - Sim: {self.simulation.initial_datetime}"
+
+
+class MeteoTileSet(models.Model):
+    """Teselas XYZ de la capa de datos de un fotograma (ver wrf_img.utils.tiles)"""
+    simulation = models.ForeignKey(
+        Simulation,
+        on_delete=models.CASCADE,
+        help_text="Simulación a la que pertenecen estas teselas"
+    )
+    valid_datetime = models.DateTimeField(help_text="Fecha y hora válida del fotograma (con zona horaria)")
+    variable_name = models.CharField(max_length=20, help_text="Nombre de la variable meteorológica")
+    tile_dir = models.CharField(max_length=255, help_text="Directorio de las teselas en el almacenamiento")
+    min_zoom = models.PositiveSmallIntegerField()
+    max_zoom = models.PositiveSmallIntegerField()
+    # Teselas escritas (las vacías no se escriben)
+    tile_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['simulation', 'valid_datetime', 'variable_name']
+        ordering = ['simulation', 'valid_datetime', 'variable_name']
+        verbose_name = 'Teselas'
+        verbose_name_plural = 'Teselas'
+
+    def __str__(self):
+        return f"{self.variable_name} - {self.valid_datetime} (z{self.min_zoom}-{self.max_zoom})"
+
+
+class GridPointIndex(models.Model):
+    """
+    Posición en la malla del modelo de una estación o un municipio (ver wrf_img.utils.grid_index):
+    celda más cercana y bloque de 2x2 celdas con los pesos de la interpolación bilineal
+    """
+    grid_signature = models.CharField(max_length=16, help_text="Firma de la malla (ver grid_signature)")
+    station = models.ForeignKey(
+        'station_data.Station', on_delete=models.CASCADE, null=True, blank=True, related_name='grid_indexes'
+    )
+    town = models.ForeignKey(
+        'station_data.Town', on_delete=models.CASCADE, null=True, blank=True, related_name='grid_indexes'
+    )
+    latitude = models.FloatField(help_text="Latitud del punto al calcular el índice")
+    longitude = models.FloatField(help_text="Longitud del punto al calcular el índice")
+    # Celda más cercana
+    nearest_row = models.PositiveIntegerField()
+    nearest_column = models.PositiveIntegerField()
+    distance_km = models.FloatField()
+    # Esquina del bloque de 2x2 celdas y pesos [[w00, w01], [w10, w11]]
+    row = models.PositiveIntegerField()
+    column = models.PositiveIntegerField()
+    weights = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [['grid_signature', 'station'], ['grid_signature', 'town']]
+        indexes = [models.Index(fields=['grid_signature'])]
+        verbose_name = 'Índice en la malla'
+        verbose_name_plural = 'Índices en la malla'
+
+    def __str__(self):
+        return f"{self.station or self.town} - malla {self.grid_signature}"
+
+
+class ForecastVerification(models.Model):
+    """
+    Verificación de una variable de una simulación contra las observaciones SYNOP de una
+    estación en un plazo de pronóstico (ver wrf_img.utils.verification). Con count, bias, mae
+    y rmse se pueden agregar varias filas sin perder exactitud (ver summarize_verification).
+    """
+    simulation = models.ForeignKey(
+        Simulation,
+        on_delete=models.CASCADE,
+        help_text="Simulación verificada"
+    )
+    variable_name = models.CharField(max_length=20, help_text="Nombre de la variable meteorológica")
+    station = models.ForeignKey('station_data.Station', on_delete=models.CASCADE, related_name='verifications')
+    lead_hours = models.PositiveIntegerField(help_text="Plazo del pronóstico en horas")
+    count = models.PositiveIntegerField(help_text="Pares pronóstico-observación")
+    hits = models.PositiveIntegerField(help_text="Pares con el error dentro de la tolerancia de la variable")
+    bias = models.FloatField(help_text="Error medio (pronóstico - observación)")
+    mae = models.FloatField(help_text="Error absoluto medio")
+    rmse = models.FloatField(help_text="Raíz del error cuadrático medio")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['simulation', 'variable_name', 'station', 'lead_hours']
+        ordering = ['simulation', 'variable_name', 'station', 'lead_hours']
+        verbose_name = 'Verificación'
+        verbose_name_plural = 'Verificaciones'
+
+    def __str__(self):
+        return f"{self.variable_name} +{self.lead_hours}h - {self.station} - Sim: {self.simulation.initial_datetime}"
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.count if self.count else None
+
+
+class RegionMask(models.Model):
+    """
+    Celdas de la malla del modelo de un municipio o una provincia (ver wrf_img.utils.regions),
+    guardadas como un mapa de bits (np.packbits de la máscara aplanada)
+    """
+    grid_signature = models.CharField(max_length=16, help_text="Firma de la malla (ver grid_signature)")
+    province = models.ForeignKey(
+        'station_data.Province', on_delete=models.CASCADE, null=True, blank=True, related_name='region_masks'
+    )
+    town = models.ForeignKey(
+        'station_data.Town', on_delete=models.CASCADE, null=True, blank=True, related_name='region_masks'
+    )
+    mask = models.BinaryField(help_text="Máscara de las celdas de la región (bits)")
+    cell_count = models.PositiveIntegerField()
+    area_km2 = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [['grid_signature', 'province'], ['grid_signature', 'town']]
+        indexes = [models.Index(fields=['grid_signature'])]
+        verbose_name = 'Máscara de región'
+        verbose_name_plural = 'Máscaras de regiones'
+
+    def __str__(self):
+        return f"{self.province or self.town} - malla {self.grid_signature}"
+
+
+class RegionAggregate(models.Model):
+    """
+    Media (ponderada por área), máximo y suma de una variable en un municipio o una provincia
+    para cada tiempo válido de una simulación (listas alineadas con times)
+    """
+    simulation = models.ForeignKey(
+        Simulation,
+        on_delete=models.CASCADE,
+        help_text="Simulación a la que pertenecen los valores"
+    )
+    variable_name = models.CharField(max_length=20, help_text="Nombre de la variable meteorológica")
+    province = models.ForeignKey(
+        'station_data.Province', on_delete=models.CASCADE, null=True, blank=True, related_name='aggregates'
+    )
+    town = models.ForeignKey(
+        'station_data.Town', on_delete=models.CASCADE, null=True, blank=True, related_name='aggregates'
+    )
+    times = models.JSONField(help_text="Tiempos válidos (YYYY-MM-DDTHH:MM:SS)")
+    mean = models.JSONField()
+    maximum = models.JSONField()
+    total = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [['simulation', 'variable_name', 'province'], ['simulation', 'variable_name', 'town']]
+        verbose_name = 'Agregado por región'
+        verbose_name_plural = 'Agregados por región'
+
+    def __str__(self):
+        return f"{self.variable_name} - {self.province or self.town} - Sim: {self.simulation.initial_datetime}"
+
 
 # Señal para eliminar archivos de imagen cuando se borre la instancia
 @receiver(post_delete, sender=MeteoImage)
@@ -74,6 +324,34 @@ def delete_meteroimage_file(sender, instance, **kwargs):
     """
     Elimina el archivo de imagen cuando se borra una instancia de MeteoImage
     """
-    if instance.image:
-        if os.path.isfile(instance.image.path):
-            os.remove(instance.image.path)
\ No newline at end of file
+    for image_format in instance.available_formats():
+        image_file = instance.get_image_file(image_format)
+        if os.path.isfile(image_file.path):
+            os.remove(image_file.path)
+
+
+@receiver(post_delete, sender=Simulation)
+def delete_simulation_field_store(sender, instance, **kwargs):
+    """
+    Elimina el directorio de los campos guardados cuando se borra una Simulation
+    """
+    if instance.field_store:
+        shutil.rmtree(default_storage.path(instance.field_store), ignore_errors=True)
+
+
+@receiver(post_delete, sender=MeteoAnimation)
+def delete_meteoanimation_file(sender, instance, **kwargs):
+    """
+    Elimina el archivo de la animación cuando se borra una instancia de MeteoAnimation
+    """
+    if instance.file and os.path.isfile(instance.file.path):
+        os.remove(instance.file.path)
+
+
+@receiver(post_delete, sender=MeteoTileSet)
+def delete_meteotileset_files(sender, instance, **kwargs):
+    """
+    Elimina el directorio de las teselas cuando se borra una instancia de MeteoTileSet
+    """
+    if instance.tile_dir:
+        shutil.rmtree(default_storage.path(instance.tile_dir), ignore_errors=True)
@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from .models import Simulation, MeteoImage
+from .models import Simulation, MeteoImage, MeteoAnimation, MeteoLayerSet
+from .utils.image_encoder import get_preferred_format
 
 class SimulationSerializer(serializers.ModelSerializer):
     class Meta:
@@ -8,11 +9,68 @@ class SimulationSerializer(serializers.ModelSerializer):
 
 class MeteoImageSerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
+    overlay_url = serializers.SerializerMethodField()
+    stats = serializers.SerializerMethodField()
 
     class Meta:
         model = MeteoImage
-        fields = ['variable_name', 'valid_datetime', 'image_url']
+        fields = ['variable_name', 'valid_datetime', 'image_url', 'overlay_url', 'stats']
 
     def get_image_url(self, obj):
+        # WebP o AVIF si existen y el cliente los acepta (cabecera Accept), si no PNG
         request = self.context.get('request')
-        return request.build_absolute_uri(obj.image.url) if request else obj.image.url
+        accept = request.headers.get('Accept', '') if request else ''
+        image = obj.get_image_file(get_preferred_format(accept, obj.available_formats()))
+        return request.build_absolute_uri(image.url) if request else image.url
+
+    def get_overlay_url(self, obj):
+        return _get_file_url(self.context.get('request'), obj.overlay)
+
+    def get_stats(self, obj):
+        # Estadísticas del fotograma guardadas al generarlo (ver wrf_img.utils.field_stats)
+        return {
+            'valid_datetime': obj.valid_datetime.isoformat(),
+            'min': obj.data_min, 'max': obj.data_max, 'mean': obj.data_mean, 'std': obj.data_std,
+            'nan_count': obj.nan_count,
+            **obj.field_stats,
+        }
+
+class MeteoAnimationSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MeteoAnimation
+        fields = ['animation_format', 'frame_count', 'url']
+
+    def get_url(self, obj):
+        request = self.context.get('request')
+        return request.build_absolute_uri(obj.file.url) if request else obj.file.url
+
+class MeteoLayerSetSerializer(serializers.ModelSerializer):
+    legend_url = serializers.SerializerMethodField()
+    basemap_urls = serializers.SerializerMethodField()
+    extent = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MeteoLayerSet
+        fields = ['legend_url', 'basemap_urls', 'extent']
+
+    def get_legend_url(self, obj):
+        return _get_file_url(self.context.get('request'), obj.legend)
+
+    def get_basemap_urls(self, obj):
+        request = self.context.get('request')
+        return {
+            'under': _get_file_url(request, obj.basemap_under),
+            'over': _get_file_url(request, obj.basemap_over),
+        }
+
+    def get_extent(self, obj):
+        # [lon_min, lon_max, lat_min, lat_max], como get_map_extent
+        return [obj.lon_min, obj.lon_max, obj.lat_min, obj.lat_max]
+
+
+def _get_file_url(request, file):
+    if not file:
+        return None
+    return request.build_absolute_uri(file.url) if request else file.url
@@ -1,18 +1,42 @@
-from celery import shared_task
+import requests
+from celery import chord, shared_task
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.utils import timezone
 from datetime import datetime, timedelta
-from .utils.plot_generators import generate_and_save_meteo_plot
-from .models import Simulation
+from .utils.animations import refresh_meteo_animations
+from .utils.cycle_lock import CycleLease, LockUnavailable, get_done_variables, mark_variable_done
+from .utils.basemap import get_map_extent
+from .utils.field_store import get_field_store_format, get_field_store_path, load_field_payload, write_field_store
+from .utils.model_api import get_model_client
+from .utils.overlays import update_meteo_layer_set
+from .utils.timing import StageTimings, span
+from .utils.plot_generators import (
+    MeteoPlotJob, get_frame_renderer, get_frame_stats, get_or_create_simulation, get_render_hash,
+    get_render_key, get_stale_frames, parse_valid_datetime, upsert_meteo_images, upsert_meteo_tile_sets,
+    write_meteo_image, write_meteo_tiles,
+)
+from .utils.tiles import delete_tile_dir, render_frame_tiles
+from .models import MeteoImage, MeteoTileSet
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def generate_meteo_images_task(hour):
+@shared_task(bind=True)
+def generate_meteo_images_task(self, hour):
     """
-    Tarea para generar imágenes meteorológicas en horarios específicos
+    Tarea para generar imágenes meteorológicas en horarios específicos.
+
+    Se reemplaza por un chord: una tarea de descarga por variable, que a su vez reparte
+    un render por fotograma, y summarize_meteo_images_task, que reúne los resultados en
+    el resumen que retorna la tarea.
+
+    El ciclo se bloquea (CycleLease) mientras dura el chord: las subtareas renuevan el
+    bloqueo y el resumen lo libera. Las variables ya completas en una ejecución anterior
+    no se vuelven a generar.
     """
+    lease = None
     try:
         # Calcular la fecha y hora inicial para la API
         now = timezone.now()
@@ -37,37 +61,287 @@ def generate_meteo_images_task(hour):
             # Usar el día actual
             initial_datetime = now.replace(hour=cycle_hour, minute=0, second=0, microsecond=0)
 
-        # Formatear para la función (formato completo)
+        # Formatear para la función (formato completo) y para la API (YYYYMMDDHH)
         datetime_init_str = initial_datetime.strftime('%Y-%m-%d %H:%M:%S')
+        datetime_init = initial_datetime.strftime('%Y%m%d%H')
 
         # Lista de variables a generar
         variables = ['T2', 'rh2', 'RAINC', 'slp', 'ws10', 'wd10']
 
-        # Verificar si ya existe una simulación para esta fecha
-        # Usar datetime consciente de zona horaria para la búsqueda
-        simulation_exists = Simulation.objects.filter(initial_datetime=initial_datetime).exists()
+        lease = CycleLease(datetime_init)
+        if not lease.acquire():
+            lease = None
+            logger.info(f"Simulación para {datetime_init_str} en proceso en otra ejecución. Saltando generación.")
+            return f"Simulación para {datetime_init_str} en proceso en otra ejecución"
+
+        # Variables completas en ejecuciones anteriores (una ejecución interrumpida sigue por las que
+        # faltan). Se leen con el bloqueo tomado: antes otra ejecución podía estar terminándolas.
+        done_variables = get_done_variables(datetime_init)
+        pending_variables = [var_name for var_name in variables if var_name not in done_variables]
 
-        if simulation_exists:
+        if not pending_variables:
+            lease.release()
+            lease = None
             logger.info(f"Simulación para {datetime_init_str} ya existe. Saltando generación.")
             return f"Simulación para {datetime_init_str} ya existe"
 
-        # Generar imágenes para cada variable
-        results = {}
-        for var_name in variables:
-            try:
-                saved_images = generate_and_save_meteo_plot(datetime_init_str, var_name)
-                results[var_name] = f"Generadas {len(saved_images)} imágenes"
-                logger.info(f"Generadas {len(saved_images)} imágenes para {var_name}")
-            except Exception as e:
-                results[var_name] = f"Error: {str(e)}"
-                logger.error(f"Error generando imágenes para {var_name}: {str(e)}")
+        # Una tarea por variable; el resumen se arma cuando terminan todas
+        workflow = chord(
+            [fetch_variable_task.s(datetime_init, var_name, lease.owner) for var_name in pending_variables],
+            summarize_meteo_images_task.s(
+                datetime_init_str, now.isoformat(), datetime_init, lease.owner,
+                [var_name for var_name in variables if var_name in done_variables],
+            ),
+        )
+
+    except Exception as e:
+        if lease is not None:
+            lease.release()
+        logger.error(f"Error en la tarea de generación de imágenes: {str(e)}")
+        return {'error': str(e)}
+
+    # El resultado de la tarea pasa a ser el del chord (fuera del try: replace lanza Ignore)
+    return self.replace(workflow)
+
+
+@shared_task(bind=True)
+def fetch_variable_task(self, datetime_init, var_name, owner=None):
+    """
+    Descarga una variable, guarda sus campos en el almacén de la simulación y la reemplaza
+    por un chord de render_frame_task, uno por fotograma que falte o haya cambiado, con
+    save_variable_images_task como cierre. Cada render_frame_task lee sólo su fotograma del
+    almacén (o, si no se guardan los campos, de la caché de campos).
+    """
+    try:
+        renew_cycle_lease(datetime_init, owner)
+        client = get_model_client()
+        if client.cache is None and get_field_store_format() is None:
+            # Sin almacén ni caché de campos los fotogramas no se pueden leer desde otras tareas
+            return render_variable(datetime_init, var_name, owner)
+
+        timings = StageTimings()
+        with timings.activate():
+            data = client.fetch_variable(datetime_init, var_name, stream=False)
+            timings.merge(data['timings'])
+            simulation = get_or_create_simulation(datetime_init)
+            with span('stats'):
+                stale_frames = get_stale_frames(simulation, var_name, data)
+            # Campos de la variable en el almacén de la simulación (ver wrf_img.utils.field_store)
+            stored = get_field_store_path(simulation, var_name) is not None
+            if stale_frames or not stored:
+                stored = write_field_store(simulation, var_name, data) is not None
+        skipped = len(data['times']) - len(stale_frames)
+        if not stale_frames:
+            mark_cycle_variable_done(datetime_init, var_name)
+            logger.info(f"Imágenes de {var_name} sin cambios ({skipped})")
+            return {'variable': var_name, 'images': 0, 'skipped': skipped, 'timings': timings.as_dict()}
+        if not stored and client.cache is None:
+            # No se pudieron guardar los campos: se renderiza aquí con los ya descargados
+            return render_variable(datetime_init, var_name, owner, data)
+
+        # Los tiempos de la descarga se suman a los de los fotogramas en save_variable_images_task
+        workflow = chord(
+            [render_frame_task.s(datetime_init, var_name, i, owner) for i in stale_frames],
+            save_variable_images_task.s(datetime_init, var_name, owner, skipped, timings.as_dict()),
+        )
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error descargando {var_name}: {str(e)}")
+        return {'variable': var_name, 'error': f"Error al acceder a la API: {str(e)}"}
+    except Exception as e:
+        logger.error(f"Error generando imágenes para {var_name}: {str(e)}")
+        return {'variable': var_name, 'error': str(e)}
+
+    return self.replace(workflow)
+
+
+def render_variable(datetime_init, var_name, owner=None, data=None):
+    """
+    Genera las imágenes de una variable en el proceso actual (MeteoPlotJob). El bloqueo del
+    ciclo se renueva en un hilo mientras dura el render y se comprueba antes de guardar.
+    """
+    lease = CycleLease(datetime_init, owner=owner) if owner else None
+    if lease is not None:
+        lease.start_heartbeat()
+    try:
+        job = MeteoPlotJob(datetime_init, var_name, data=data)
+        saved_images = job.save(before_save=lease.check if lease is not None else None)
+    finally:
+        if lease is not None:
+            lease.stop_heartbeat()
+    mark_cycle_variable_done(datetime_init, var_name)
+    logger.info(f"Generadas {len(saved_images)} imágenes para {var_name}")
+    return {
+        'variable': var_name, 'images': len(saved_images), 'skipped': job.skipped,
+        'timings': job.timings.as_dict(),
+    }
+
+
+@shared_task
+def render_frame_task(datetime_init, var_name, frame_idx, owner=None):
+    """
+    Renderiza un fotograma y escribe su fichero. La fila se guarda después, junto con el
+    resto de la variable, en save_variable_images_task.
+    """
+    timings = StageTimings()
+    try:
+        renew_cycle_lease(datetime_init, owner)
+        with timings.activate():
+            simulation = get_or_create_simulation(datetime_init)
+            # Sólo se lee el fotograma de la tarea: del almacén de campos de la simulación o, si
+            # no se guardan, de la caché de campos (se vuelve a descargar si ya no está)
+            with load_field_payload(simulation, var_name) as data:
+                if data is None:
+                    data = get_model_client().fetch_variable(datetime_init, var_name, stream=False)
+                    timings.merge(data['timings'])
+                lats, longs = data['lats'], data['longs']
+                time_str = data['times'][frame_idx]
+                var_frame = data['var'][frame_idx]
+                u_frame = data['U10'][frame_idx] if 'U10' in data else None
+                v_frame = data['V10'][frame_idx] if 'V10' in data else None
 
+            # El worker reutiliza la figura entre fotogramas de la misma variable y ciclo
+            renderer = get_frame_renderer(var_name, lats, longs, simulation.initial_datetime, datetime_init)
+            images = renderer.render_images(time_str, var_frame, u_frame, v_frame)
+            tiles = render_frame_tiles(var_name, lats, longs, datetime_init, var_frame, u_frame, v_frame)
+            with span('stats'):
+                stats = get_frame_stats(var_name, var_frame, lats, longs)
+                render_hash = get_render_hash(
+                    get_render_key(var_name, lats, longs), time_str, var_frame, u_frame, v_frame
+                )
+            # El render puede superar el ttl del bloqueo: se renueva antes de escribir los ficheros
+            renew_cycle_lease(datetime_init, owner)
+            meteo_image = write_meteo_image(simulation, var_name, time_str, images, stats, render_hash)
+            tile_set = write_meteo_tiles(simulation, var_name, time_str, tiles) if tiles is not None else None
+
+        # Nombre del fichero de cada formato (PNG y opcionalmente WebP/AVIF)
+        image_names = {
+            image_format: meteo_image.get_image_file(image_format).name for image_format in images
+        }
+        # Directorio de las teselas, si se generan (ver wrf_img.utils.tiles)
+        tiles = None
+        if tile_set is not None:
+            tiles = {
+                'tile_dir': tile_set.tile_dir, 'min_zoom': tile_set.min_zoom,
+                'max_zoom': tile_set.max_zoom, 'tile_count': tile_set.tile_count,
+            }
         return {
-            'initial_datetime': datetime_init_str,
-            'results': results,
-            'generated_at': now.isoformat()
+            'frame': frame_idx, 'time': time_str, 'images': image_names, 'tiles': tiles,
+            'extent': get_map_extent(lats, longs),
+            'stats': stats, 'render_hash': render_hash, 'timings': timings.as_dict(),
         }
 
     except Exception as e:
-        logger.error(f"Error en la tarea de generación de imágenes: {str(e)}")
-        return {'error': str(e)}
+        logger.error(f"Error renderizando {var_name} (fotograma {frame_idx}): {str(e)}")
+        return {'frame': frame_idx, 'error': str(e)}
+
+
+@shared_task
+def save_variable_images_task(frames, datetime_init, var_name, owner=None, skipped=0, timings=None):
+    """
+    Guarda las filas de todos los fotogramas de una variable en una sola sentencia y suma
+    los tiempos por etapa de la descarga (timings) y de cada fotograma
+    """
+    errors = [frame['error'] for frame in frames if 'error' in frame]
+    written = [frame for frame in frames if 'error' not in frame]
+
+    timings = StageTimings(timings)
+    for frame in written:
+        timings.merge(frame['timings'])
+
+    try:
+        if errors:
+            raise Exception(errors[0])
+        # Sólo guarda quien sigue teniendo el bloqueo del ciclo
+        renew_cycle_lease(datetime_init, owner)
+
+        with timings.activate():
+            simulation = get_or_create_simulation(datetime_init)
+            meteo_images = []
+            tile_sets = []
+            for frame in sorted(written, key=lambda frame: frame['frame']):
+                meteo_images.append(MeteoImage(
+                    simulation=simulation,
+                    valid_datetime=parse_valid_datetime(frame['time']),
+                    variable_name=var_name,
+                    **frame['stats'],
+                    render_hash=frame['render_hash'],
+                    **{MeteoImage.IMAGE_FIELDS[image_format]: name for image_format, name in frame['images'].items()},
+                ))
+                if frame.get('tiles'):
+                    tile_sets.append(MeteoTileSet(
+                        simulation=simulation,
+                        valid_datetime=parse_valid_datetime(frame['time']),
+                        variable_name=var_name,
+                        **frame['tiles'],
+                    ))
+            with transaction.atomic():
+                upsert_meteo_images(meteo_images)
+                upsert_meteo_tile_sets(tile_sets)
+                # Leyenda y mapa base de las capas de datos
+                overlay_frames = [frame for frame in written if 'overlay' in frame['images']]
+                if overlay_frames:
+                    update_meteo_layer_set(simulation, var_name, overlay_frames[0]['extent'])
+            refresh_meteo_animations(simulation, var_name)
+
+    except Exception as e:
+        # La variable se guarda completa o no se guarda: se eliminan los ficheros escritos
+        for frame in written:
+            for name in frame['images'].values():
+                default_storage.delete(name)
+            if frame.get('tiles'):
+                delete_tile_dir(frame['tiles']['tile_dir'])
+        logger.error(f"Error generando imágenes para {var_name}: {str(e)}")
+        return {'variable': var_name, 'error': str(e)}
+
+    mark_cycle_variable_done(datetime_init, var_name)
+    logger.info(f"Generadas {len(meteo_images)} imágenes para {var_name}")
+    logger.info(f"Tiempos de {var_name}: {timings.format()}")
+    return {'variable': var_name, 'images': len(meteo_images), 'skipped': skipped, 'timings': timings.as_dict()}
+
+
+@shared_task
+def summarize_meteo_images_task(variable_results, datetime_init_str, generated_at,
+                                datetime_init=None, owner=None, done_variables=()):
+    """
+    Reúne los resultados por variable en el resumen de generate_meteo_images_task y
+    libera el bloqueo del ciclo.
+    """
+    if owner:
+        try:
+            CycleLease(datetime_init, owner=owner).release()
+        except LockUnavailable as e:
+            # Las variables ya terminaron: el bloqueo caduca solo al cumplir su ttl
+            logger.warning(f"No se pudo liberar el bloqueo del ciclo {datetime_init}: {str(e)}")
+
+    results = {var_name: "Ya generadas" for var_name in done_variables}
+    # Tiempos por etapa de cada variable (ver wrf_img.utils.timing)
+    timings = {result['variable']: result['timings'] for result in variable_results if 'timings' in result}
+    for result in variable_results:
+        if 'error' in result:
+            results[result['variable']] = f"Error: {result['error']}"
+        elif result.get('skipped'):
+            results[result['variable']] = f"Generadas {result['images']} imágenes ({result['skipped']} sin cambios)"
+        else:
+            results[result['variable']] = f"Generadas {result['images']} imágenes"
+
+    return {
+        'initial_datetime': datetime_init_str,
+        'results': results,
+        'timings': timings,
+        'generated_at': generated_at
+    }
+
+
+def renew_cycle_lease(datetime_init, owner):
+    """Renueva el bloqueo del ciclo desde una subtarea; lanza LeaseLost si ya no es el dueño"""
+    if owner:
+        CycleLease(datetime_init, owner=owner).heartbeat()
+
+
+def mark_cycle_variable_done(datetime_init, var_name):
+    """Marca la variable como completa; si el backend no responde solo se avisa (las imágenes ya están guardadas)"""
+    try:
+        mark_variable_done(datetime_init, var_name)
+    except LockUnavailable as e:
+        logger.warning(f"No se pudo marcar {var_name} como completa: {str(e)}")
@@ -1,12 +1,71 @@
+import io
 import os
+import tempfile
+import threading
+import time
 import django
-from django.test import TestCase
+from unittest import mock
+import numpy as np
+import requests
+import xarray as xr
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from datetime import datetime
+from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from shapely.geometry import box
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.conf import settings
+from django.core.files.base import ContentFile
 from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
 
 # Configura el entorno de Django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 django.setup()
 
+from config import celery_app
+from station_data.models import Province, Station, Town, WeatherObservation
+from wrf_img.models import ForecastVerification, GridPointIndex, RegionAggregate, RegionMask, MeteoImage, MeteoTileSet, Simulation
+from wrf_img.tasks import generate_meteo_images_task, render_frame_task, render_variable
+from wrf_img.utils import basemap, benchmarks, model_api, point_forecast
+from wrf_img.utils.animations import AnimationFrames, encode_animation, update_meteo_animations
+from wrf_img.utils.cycle_lock import (
+    CycleLease, CycleLocked, LeaseLost, LockUnavailable, MemoryLockBackend, mark_variable_done, reset_lock_backend,
+)
+from wrf_img.utils.field_cache import FieldCache, reset_field_cache
+from wrf_img.utils.field_stats import compute_field_stats, get_cell_areas
+from wrf_img.utils.field_store import get_field_store_path, load_field_payload, write_field_store
+from wrf_img.utils.grid_geometry import get_grid_geometry
+from wrf_img.utils.image_encoder import render_rgba
+from wrf_img.utils.model_api import ModelDataClient, iter_json_events, iter_payload_frames, reset_model_client
+from wrf_img.utils.plot_generators import (
+    DPI, FIGSIZE, MeteoFrameRenderer, draw_plot, get_frame_stats, render_meteo_frame, upsert_meteo_images,
+    upsert_meteo_tile_sets, write_meteo_image, write_meteo_tiles,
+)
+from wrf_img.utils.overlays import render_legend, update_meteo_layer_set
+from wrf_img.utils.plot_config import get_plot_config
+from wrf_img.utils.render_engine import RenderEngine
+from wrf_img.utils.standin_api import StandInModelAPI, build_synthetic_grid, build_synthetic_payload, encode_json
+from wrf_img.utils.tiles import MeteoTileRenderer
+from wrf_img.utils.verification import summarize_verification, verify_simulation
+from wrf_img.utils.timing import StageTimings, span
+
+
+class FakeBasemapMixin:
+    """Mapa base vacío para no descargar Natural Earth durante los tests"""
+
+    def use_fake_basemap(self, lats, longs):
+        extent = basemap.get_map_extent(lats, longs)
+        layer = np.zeros((8, 8, 4), dtype=np.uint8)
+        key = basemap.get_basemap_key(extent, FIGSIZE, DPI)
+        basemap._BASEMAP_CACHE[key] = (layer, layer)
+        self.addCleanup(basemap._BASEMAP_CACHE.pop, key, None)
+        return extent
+
 
 class MeteoImageGenerationTest(TestCase):
     def test_image_generation(self):
@@ -17,3 +76,1126 @@ class MeteoImageGenerationTest(TestCase):
             self.assertTrue(True, "Comando ejecutado exitosamente")
         except Exception as e:
             self.fail(f"Error ejecutando el comando: {str(e)}")
+
+
+class ModelDataClientTest(SimpleTestCase):
+    """Descarga de variables contra un servidor local que imita la API del modelo"""
+
+    def setUp(self):
+        self.api = StandInModelAPI(grid_shape=(12, 20), frames=3)
+        self.api.start()
+        self.addCleanup(self.api.stop)
+        self.client = ModelDataClient(base_url=self.api.url, max_workers=2, cache=False)
+        self.addCleanup(self.client.close)
+
+    def test_fetch_variables_reuses_grid(self):
+        payloads = self.client.fetch_variables('2026020400', ['T2', 'slp', 'wd10'])
+
+        self.assertEqual(sorted(payloads), ['T2', 'slp', 'wd10'])
+        self.assertEqual(len(self.api.requests), 3)
+        self.assertIs(payloads['T2']['lats'], payloads['slp']['lats'])
+        self.assertIs(payloads['T2']['longs'], payloads['wd10']['longs'])
+        self.assertEqual(payloads['slp']['var'].shape, (3, 12, 20))
+        self.assertIn('U10', payloads['wd10'])
+        self.assertNotIn('U10', payloads['T2'])
+
+    def test_get_grid_is_requested_once_per_cycle(self):
+        self.client.get_grid('2026020400')
+        self.client.get_grid('2026020400')
+        self.client.fetch_variable('2026020400', 'rh2')
+
+        self.assertEqual(len(self.api.requests), 2)
+
+    def test_binary_formats_match_json(self):
+        json_payload = self.client.fetch_variable('2026020400', 'wd10', stream=False)
+
+        for fmt in ('raw', 'npz'):
+            with StandInModelAPI(grid_shape=(12, 20), frames=3, formats=(fmt,)) as api:
+                client = ModelDataClient(base_url=api.url, cache=False)
+                payload = client.fetch_variable('2026020400', 'wd10')
+                client.close()
+
+            self.assertEqual(payload['var'].dtype, np.float32)
+            self.assertEqual(payload['times'], json_payload['times'])
+            for key in ('lats', 'var', 'U10', 'V10'):
+                np.testing.assert_allclose(payload[key], json_payload[key], rtol=1e-6)
+
+    def test_streamed_frames_match_full_payload(self):
+        full = self.client.fetch_variable('2026020400', 'wd10', stream=False)
+        streamed = self.client.fetch_variable('2026020400', 'wd10', stream=True)
+
+        self.assertNotIn('var', streamed)
+        frames = list(iter_payload_frames(streamed))
+        self.assertEqual([frame[0] for frame in frames], [0, 1, 2])
+        for i, var_frame, u_frame, v_frame in frames:
+            np.testing.assert_array_equal(var_frame, full['var'][i])
+            np.testing.assert_array_equal(u_frame, full['U10'][i])
+            np.testing.assert_array_equal(v_frame, full['V10'][i])
+
+    def test_json_events_with_small_chunks(self):
+        payload = build_synthetic_payload('2026020400', 'wd10', (4, 5), 2)
+        # Campos antes que la malla y trozos que cortan números y cadenas
+        body = encode_json({key: payload[key] for key in ('V10', 'var', 'times', 'U10', 'lats', 'longs')})
+        chunks = (body[i:i + 7] for i in range(0, len(body), 7))
+
+        events = list(iter_json_events(chunks, skip=('lats',)))
+
+        values = {event[1]: event[2] for event in events if event[0] == 'value'}
+        self.assertEqual(sorted(values), ['longs', 'times'])
+        self.assertEqual(values['times'], payload['times'])
+        for key in ('var', 'U10', 'V10'):
+            frames = [event[3] for event in events if event[0] == 'frame' and event[1] == key]
+            np.testing.assert_array_equal(np.stack(frames), payload[key])
+
+    def test_iter_variables_reports_errors(self):
+        results = dict(self.client.iter_variables('fecha', ['T2']))
+
+        self.assertIsInstance(results['T2'], requests.exceptions.HTTPError)
+
+    def test_iter_variables_closes_pending_streams(self):
+        opened = []
+
+        class RecordingStream(model_api._FrameStream):
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.closed = False
+                opened.append(self)
+
+            def close(self):
+                super().close()
+                self.closed = True
+
+        with mock.patch.object(model_api, '_FrameStream', RecordingStream):
+            variables = self.client.iter_variables('2026020400', ['T2', 'slp', 'rh2'], stream=True)
+            _, payload = next(variables)
+            payload['frames'].close()
+            # Al dejar de iterar se cierran las respuestas que ya estaban abiertas en segundo plano
+            variables.close()
+
+        self.assertGreaterEqual(len(opened), 2)
+        self.assertTrue(all(stream.closed for stream in opened))
+
+
+class FieldCacheTest(SimpleTestCase):
+    """Caché en disco de los campos descargados"""
+
+    def setUp(self):
+        self.api = StandInModelAPI(grid_shape=(12, 20), frames=3)
+        self.api.start()
+        self.addCleanup(self.api.stop)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache = FieldCache(tmp_dir.name, max_bytes=10 * 1024 * 1024)
+
+    def make_client(self, **kwargs):
+        client = ModelDataClient(base_url=self.api.url, cache=self.cache, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_cached_fields_are_not_downloaded_again(self):
+        streamed = self.make_client().fetch_variable('2026020400', 'wd10', stream=True)
+        frames = list(iter_payload_frames(streamed))
+
+        cached = self.make_client().fetch_variable('2026020400', 'wd10')
+
+        self.assertEqual(len(self.api.requests), 1)
+        self.assertIsInstance(cached['var'], np.memmap)
+        self.assertEqual(cached['times'], streamed['times'])
+        for i, var_frame, u_frame, v_frame in frames:
+            np.testing.assert_array_equal(cached['var'][i], var_frame)
+            np.testing.assert_array_equal(cached['V10'][i], v_frame)
+
+    def test_refresh_and_partial_reads(self):
+        # Una lectura interrumpida no deja la entrada en caché
+        self.make_client().get_grid('2026020400')
+        self.assertIsNone(self.cache.get('2026020400', 'T2'))
+
+        self.make_client().fetch_variable('2026020400', 'T2', stream=False)
+        self.make_client(refresh=True).fetch_variable('2026020400', 'T2', stream=False)
+
+        self.assertEqual(len(self.api.requests), 3)
+        self.assertIsNotNone(self.cache.get('2026020400', 'T2'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        client = self.make_client()
+        for var_name in ('T2', 'slp', 'rh2'):
+            client.fetch_variable('2026020400', var_name, stream=False)
+        entry_size = sum(
+            entry.stat().st_size for entry in os.scandir(os.path.join(self.cache.directory, '2026020400_T2'))
+        )
+
+        # T2 se usa de nuevo, así que la menos usada pasa a ser slp
+        for last_used, var_name in enumerate(('T2', 'slp', 'rh2')):
+            os.utime(os.path.join(self.cache.directory, f'2026020400_{var_name}', 'meta.json'), (last_used, last_used))
+        self.cache.get('2026020400', 'T2')
+        self.cache.max_bytes = entry_size * 2 + 1024
+        self.cache.evict()
+
+        self.assertIsNone(self.cache.get('2026020400', 'slp'))
+        self.assertIsNotNone(self.cache.get('2026020400', 'T2'))
+        self.assertIsNotNone(self.cache.get('2026020400', 'rh2'))
+
+
+class SimulationTestCase(FakeBasemapMixin, TestCase):
+    """Simulación de prueba con MEDIA_ROOT en un directorio temporal"""
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        override = override_settings(MEDIA_ROOT=media_root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.simulation = Simulation.objects.create(
+            initial_datetime=timezone.make_aware(timezone.datetime(2026, 2, 4, 0))
+        )
+
+    def build_images(self, value):
+        images = []
+        for hour in range(3):
+            image = MeteoImage(
+                simulation=self.simulation,
+                valid_datetime=self.simulation.initial_datetime + timezone.timedelta(hours=hour),
+                variable_name='T2',
+                data_min=value, data_max=value, data_mean=value,
+            )
+            image.image.save(f'T2_{hour}.png', ContentFile(b'png'), save=False)
+            images.append(image)
+        return images
+
+
+class MeteoImageUpsertTest(SimulationTestCase):
+    """Guardado de las filas de una variable en una sola sentencia"""
+
+    def test_variable_is_saved_in_one_statement(self):
+        upsert_meteo_images(self.build_images(1.0))
+        old_paths = [image.image.path for image in MeteoImage.objects.all()]
+
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                upsert_meteo_images(self.build_images(2.0))
+
+        # Una consulta de las filas existentes y un único INSERT ... ON CONFLICT
+        statements = [q['sql'].split()[0] for q in queries.captured_queries if 'SAVEPOINT' not in q['sql']]
+        self.assertEqual(statements, ['SELECT', 'INSERT'])
+        self.assertEqual(MeteoImage.objects.count(), 3)
+        self.assertEqual(set(MeteoImage.objects.values_list('data_mean', flat=True)), {2.0})
+        # Los ficheros de las filas reemplazadas se eliminan
+        self.assertFalse(any(os.path.exists(path) for path in old_paths))
+        self.assertTrue(all(os.path.exists(image.image.path) for image in MeteoImage.objects.all()))
+
+
+class ImageFormatTest(SimulationTestCase):
+    """Formato de las imágenes según la cabecera Accept"""
+
+    def test_format_is_chosen_by_accept(self):
+        images = self.build_images(1.0)
+        # Sólo las dos primeras tienen versión WebP
+        for hour, image in enumerate(images[:2]):
+            image.image_webp.save(f'T2_{hour}.webp', ContentFile(b'webp'), save=False)
+        upsert_meteo_images(images)
+
+        url = '/api/simulations/?datetime_init=2026020400&var_name=T2'
+        response = self.client.get(url, HTTP_ACCEPT='image/avif,image/webp,*/*')
+        self.assertEqual(
+            [os.path.splitext(url)[1] for url in response.json()['image_urls']], ['.webp', '.webp', '.png']
+        )
+        self.assertIn('Accept', response['Vary'])
+        response = self.client.get(url)
+        self.assertTrue(all(url.endswith('.png') for url in response.json()['image_urls']))
+
+
+class MeteoAnimationTest(SimulationTestCase):
+    """Animaciones de los fotogramas de una variable"""
+
+    def test_animation_of_variable_frames(self):
+        images = self.build_images(1.0)
+        for hour, image in enumerate(images):
+            # El recorte de un fotograma puede ser algo menor: se centra en la animación
+            buffer = io.BytesIO()
+            Image.new('RGB', (40, 30 - hour), (hour * 80, 0, 0)).save(buffer, format='PNG')
+            image.image.save(f'T2_{hour}.png', ContentFile(buffer.getvalue()), save=False)
+        upsert_meteo_images(images)
+
+        with override_settings(WRF_IMG_ANIMATION_FORMATS='webp,apng'):
+            animations = update_meteo_animations(self.simulation, 'T2')
+            self.assertEqual(sorted(a.animation_format for a in animations), ['apng', 'webp'])
+            for animation in animations:
+                with Image.open(animation.file.path) as loop:
+                    self.assertEqual((loop.n_frames, loop.size), (3, (40, 30)))
+                    loop.seek(2)
+                    self.assertAlmostEqual(loop.convert('RGB').getpixel((20, 15))[0], 160, delta=8)
+            # Sin fotogramas nuevos no se vuelven a generar
+            self.assertEqual(update_meteo_animations(self.simulation, 'T2'), [])
+
+        response = self.client.get('/api/simulations/?datetime_init=2026020400&var_name=T2')
+        self.assertEqual(
+            {fmt: os.path.splitext(url)[1] for fmt, url in response.json()['animation_urls'].items()},
+            {'webp': '.webp', 'apng': '.png'},
+        )
+
+    def test_frames_are_read_on_seek(self):
+        images = self.build_images(1.0)
+        for hour, image in enumerate(images):
+            buffer = io.BytesIO()
+            Image.new('RGB', (40, 30 - hour), (hour * 80, 0, 0)).save(buffer, format='PNG')
+            image.image.save(f'T2_{hour}.png', ContentFile(buffer.getvalue()), save=False)
+
+        frames = AnimationFrames(images)
+        self.assertEqual((frames.n_frames, frames.size, frames.tell()), (3, (40, 30), 0))
+        frames.seek(2)
+        # El fotograma menor queda centrado sobre fondo blanco
+        self.assertEqual(frames.getpixel((20, 0)), (255, 255, 255))
+        self.assertEqual(frames.getpixel((20, 15)), (160, 0, 0))
+        with self.assertRaises(EOFError):
+            frames.seek(3)
+
+    def test_writers_read_each_frame_through_seek(self):
+        # AnimationFrames usa atributos internos de Pillow (comprobado con 11.3.0): si el escritor
+        # de WebP o APNG cambia la forma de recorrer los fotogramas este test debe fallar
+        images = self.build_images(1.0)
+        for hour, image in enumerate(images):
+            buffer = io.BytesIO()
+            Image.new('RGB', (40, 30), (hour * 80, 255 - hour * 80, 0)).save(buffer, format='PNG')
+            image.image.save(f'T2_{hour}.png', ContentFile(buffer.getvalue()), save=False)
+
+        for animation_format in ('webp', 'apng'):
+            frames = AnimationFrames(images)
+            with mock.patch.object(frames, 'get_frame', wraps=frames.get_frame) as get_frame:
+                animation_bytes = encode_animation(frames, animation_format, 500)
+            # Cada fotograma se decodifica cuando el escritor lo pide con seek() (el 0 ya está cargado)
+            indexes = [call.args[0] for call in get_frame.call_args_list]
+            self.assertLessEqual({1, 2}, set(indexes))
+            if animation_format == 'webp':
+                # El escritor de WebP no guarda los fotogramas: cada uno se decodifica una sola vez
+                self.assertEqual(len(indexes), len(set(indexes)))
+            with Image.open(io.BytesIO(animation_bytes)) as loop:
+                self.assertEqual(loop.n_frames, 3)
+                for hour in range(3):
+                    loop.seek(hour)
+                    red, green, _ = loop.convert('RGB').getpixel((20, 15))
+                    self.assertAlmostEqual(red, hour * 80, delta=8)
+                    self.assertAlmostEqual(green, 255 - hour * 80, delta=8)
+
+
+class TileEndpointTest(SimulationTestCase):
+    """Teselas XYZ con cabeceras de caché"""
+
+    @override_settings(WRF_IMG_TILE_ZOOMS='5-6', WRF_IMG_TILE_MAX_AGE=3600)
+    def test_tiles_are_served_with_cache_headers(self):
+        payload = build_synthetic_payload('2026020400', 'wd10', (24, 36), frames=1)
+        _, var_frame, u_frame, v_frame = next(iter_payload_frames(payload))
+        tiles = MeteoTileRenderer('wd10', payload['lats'], payload['longs']).render(var_frame, u_frame, v_frame)
+        self.assertEqual({zoom for zoom, _, _ in tiles}, {5, 6})
+        upsert_meteo_tile_sets([write_meteo_tiles(self.simulation, 'wd10', payload['times'][0], tiles)])
+
+        (z, x, y), tile_bytes = next(iter(tiles.items()))
+        url = f'/api/simulations/tiles/2026020400/wd10/2026020400/{z}/{x}/{y}.png'
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(b''.join(response.streaming_content), tile_bytes)
+        self.assertIn('max-age=3600', response['Cache-Control'])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        # Las teselas vacías no se escriben: se sirve una transparente
+        response = self.client.get('/api/simulations/tiles/2026020400/wd10/2026020400/5/0/0.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Image.open(io.BytesIO(response.content)).getextrema()[3], (0, 0))
+        # Fuera de los zooms generados
+        response = self.client.get('/api/simulations/tiles/2026020400/wd10/2026020400/7/0/0.png')
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(MeteoTileSet.objects.get().tile_dir.startswith('meteo_tiles/20260204_000000/wd10/'))
+
+
+class LayeredProductTest(SimulationTestCase):
+    """Capas de datos, leyenda y mapa base por separado"""
+
+    @override_settings(WRF_IMG_OVERLAYS=True)
+    def test_layered_product(self):
+        lats, longs = build_synthetic_grid((24, 36))
+        extent = self.use_fake_basemap(lats, longs)
+
+        payload = build_synthetic_payload('2026020400', 'T2', (24, 36), frames=1)
+        _, var_frame, _, _ = next(iter_payload_frames(payload))
+        renderer = MeteoFrameRenderer('T2', lats, longs, self.simulation.initial_datetime)
+        self.addCleanup(renderer.close)
+        images = renderer.render_images(payload['times'][0], var_frame)
+        # La capa de datos se superpone píxel a píxel sobre el mapa base
+        with Image.open(io.BytesIO(images['overlay'])) as overlay:
+            self.assertEqual(overlay.size, basemap.get_basemap_size(extent, FIGSIZE, DPI))
+        upsert_meteo_images([write_meteo_image(
+            self.simulation, 'T2', payload['times'][0], images, get_frame_stats('T2', var_frame)
+        )])
+        layer_set = update_meteo_layer_set(self.simulation, 'T2', extent)
+
+        layers = self.client.get('/api/simulations/?datetime_init=2026020400&var_name=T2').json()['layers']
+        self.assertEqual(len(layers['overlay_urls']), 1)
+        self.assertTrue(layers['overlay_urls'][0].endswith('_overlay.png'))
+        self.assertIn('/meteo_layers/legends/T2_', layers['legend_url'])
+        self.assertEqual(layers['extent'], extent)
+        # Leyenda y mapa base compartidos: no se vuelven a escribir
+        other = Simulation.objects.create(initial_datetime=timezone.make_aware(timezone.datetime(2026, 2, 4, 6)))
+        self.assertEqual(
+            update_meteo_layer_set(other, 'T2', extent).basemap_over.name, layer_set.basemap_over.name
+        )
+        # Las variables de nubosidad comparten el mapa base
+        self.assertEqual(
+            update_meteo_layer_set(self.simulation, 'clflo', extent).basemap_over.name, layer_set.basemap_over.name
+        )
+        self.assertIsNone(render_legend('variable_sin_niveles'))
+
+
+class FieldStoreTest(SimulationTestCase):
+    """Almacén de los campos de cada simulación"""
+
+    def test_field_store_round_trip(self):
+        payload = build_synthetic_payload('2026020400', 'wd10', (24, 36), frames=3)
+        path = write_field_store(self.simulation, 'wd10', payload)
+        self.assertEqual(self.simulation.field_store, 'meteo_fields/20260204_000000')
+        self.assertEqual(Simulation.objects.get().field_store, self.simulation.field_store)
+
+        with load_field_payload(Simulation.objects.get(), 'wd10') as stored:
+            self.assertEqual(stored['times'], payload['times'])
+            np.testing.assert_array_equal(stored['lats'], payload['lats'])
+            for name in ('var', 'U10', 'V10'):
+                self.assertEqual(len(stored[name]), 3)
+                np.testing.assert_array_equal(stored[name][2], payload[name][2])
+        with load_field_payload(self.simulation, 'T2') as stored:
+            self.assertIsNone(stored)
+
+        # Con las dependencias del proyecto (h5netcdf) el NetCDF se comprime con zlib
+        with xr.open_dataset(path) as dataset:
+            self.assertTrue(dataset['wd10'].encoding.get('zlib'))
+
+        # El directorio de los campos se elimina con la simulación
+        self.simulation.delete()
+        self.assertFalse(os.path.exists(path))
+
+
+class PointForecastTest(SimulationTestCase):
+    """Pronóstico en un punto a partir de los campos guardados"""
+
+    def test_point_forecast(self):
+        payload = build_synthetic_payload('2026020400', 'T2', (24, 36), frames=3)
+        write_field_store(self.simulation, 'T2', payload)
+        lats, longs, field = payload['lats'], payload['longs'], payload['var']
+        url = '/api/simulations/point/?datetime_init=2026020400&variables=T2'
+
+        # En un nodo de la malla los dos métodos dan el valor de la celda
+        for method in ('nearest', 'bilinear'):
+            data = self.client.get(f'{url}&lat={lats[5, 7]}&lon={longs[5, 7]}&method={method}').json()
+            self.assertEqual(data['times'], payload['times'])
+            self.assertEqual((data['grid_point']['j'], data['grid_point']['i']), (5, 7))
+            np.testing.assert_allclose(data['series']['T2']['values'], field[:, 5, 7], atol=1e-3)
+
+        # En el centro de una celda la interpolación bilineal es la media de sus cuatro nodos
+        lat = (lats[5, 7] + lats[6, 7]) / 2
+        lon = (longs[5, 7] + longs[5, 8]) / 2
+        data = self.client.get(f'{url}&lat={lat}&lon={lon}').json()
+        np.testing.assert_allclose(data['series']['T2']['values'], field[:, 5:7, 7:9].mean(axis=(1, 2)), atol=1e-3)
+
+        self.assertEqual(self.client.get(f'{url}&lat=60&lon=10').status_code, 400)
+        self.assertEqual(self.client.get(f'{url},rh2&lat={lat}&lon={lon}').status_code, 404)
+
+    def test_replaced_stores_are_closed(self):
+        for var_name in ('T2', 'rh2'):
+            payload = build_synthetic_payload('2026020400', var_name, (24, 36), frames=3)
+            write_field_store(self.simulation, var_name, payload)
+        open_stores = mock.patch.dict(point_forecast._OPEN_STORES, clear=True)
+        open_stores.start()
+        self.addCleanup(open_stores.stop)
+        first = point_forecast.get_store_reader(self.simulation, 'T2')
+        dataset_type = type(first.dataset)
+
+        with mock.patch.object(dataset_type, 'close', autospec=True, side_effect=dataset_type.close) as close:
+            # El fichero cambió: se vuelve a abrir y se cierra el anterior
+            path = get_field_store_path(self.simulation, 'T2')
+            modified = os.stat(path).st_mtime_ns + 10 ** 9
+            os.utime(path, ns=(modified, modified))
+            second = point_forecast.get_store_reader(self.simulation, 'T2')
+            self.assertIsNot(second, first)
+            close.assert_called_once_with(first.dataset)
+
+            # Sin sitio se cierra el más antiguo
+            with mock.patch.object(point_forecast, 'MAX_OPEN_STORES', 1):
+                point_forecast.get_store_reader(self.simulation, 'rh2')
+            self.assertEqual(close.call_count, 2)
+            close.assert_called_with(second.dataset)
+
+
+class GridPointIndexTest(SimulationTestCase):
+    """Celda de la malla de cada estación y municipio"""
+
+    def test_grid_point_index(self):
+        payload = build_synthetic_payload('2026020400', 'T2', (24, 36), frames=2)
+        write_field_store(self.simulation, 'T2', payload)
+        self.assertFalse(GridPointIndex.objects.exists())
+
+        # add_stations_data reconstruye el índice de la malla más reciente
+        call_command('add_stations_data', stdout=io.StringIO())
+        count = Station.objects.count() + Town.objects.count()
+        self.assertEqual(GridPointIndex.objects.count(), count)
+        point_index = GridPointIndex.objects.get(station__number=78355)
+        self.assertAlmostEqual(sum(sum(row) for row in point_index.weights), 1.0, places=5)
+
+        # La serie de una estación indexada es la misma que ubicándola por lat/lon
+        url = '/api/simulations/point/?datetime_init=2026020400&variables=T2'
+        data = self.client.get(f'{url}&station=78355').json()
+        station = Station.objects.get(number=78355)
+        expected = self.client.get(f'{url}&lat={station.latitude}&lon={station.longitude}').json()
+        self.assertEqual(data['series'], expected['series'])
+        self.assertEqual(data['location']['name'], str(station))
+
+        # Una malla nueva se indexa al guardar sus campos
+        other = Simulation.objects.create(initial_datetime=timezone.make_aware(timezone.datetime(2026, 2, 4, 6)))
+        write_field_store(other, 'T2', build_synthetic_payload('2026020406', 'T2', (30, 40), frames=1))
+        self.assertEqual(GridPointIndex.objects.count(), 2 * count)
+
+
+class ForecastVerificationTest(SimulationTestCase):
+    """Verificación contra las observaciones de las estaciones"""
+
+    def test_forecast_verification(self):
+        payload = build_synthetic_payload('2026020400', 'T2', (24, 36), frames=3)
+        write_field_store(self.simulation, 'T2', payload)
+        call_command('add_stations_data', stdout=io.StringIO())
+        station = Station.objects.get(number=78355)
+        forecast = self.client.get(
+            '/api/simulations/point/?datetime_init=2026020400&variables=T2&station=78355'
+        ).json()['series']['T2']['values']
+
+        # Observaciones en los tiempos válidos 1 y 2, y una fuera de la simulación
+        observed = [forecast[1] - 1.0, forecast[2] + 3.0]
+        for t, value in zip(payload['times'][1:], observed):
+            valid = datetime.strptime(t, '%Y-%m-%dT%H:%M:%S')
+            WeatherObservation.objects.create(
+                station=station, station_number=station.number,
+                date=valid.date(), hour=valid.time(), temperature=value,
+            )
+        WeatherObservation.objects.create(
+            station=station, station_number=station.number,
+            date=datetime(2026, 2, 10).date(), hour=datetime(2026, 2, 10).time(), temperature=0.0,
+        )
+
+        # Un par por plazo: error +1 (acierto con tolerancia de 2 °C) y -3
+        self.assertEqual(len(verify_simulation(self.simulation)), 2)
+        first, second = ForecastVerification.objects.filter(station=station).order_by('lead_hours')
+        self.assertEqual((first.count, first.hits, second.hits), (1, 1, 0))
+        self.assertAlmostEqual(first.bias, 1.0, places=2)
+        self.assertAlmostEqual(second.bias, -3.0, places=2)
+        self.assertAlmostEqual(second.rmse, 3.0, places=2)
+
+        # El resumen pondera por el número de pares; verificar de nuevo reemplaza las filas
+        verify_simulation(self.simulation, ['T2'])
+        summary = summarize_verification(ForecastVerification.objects.all(), by=('variable_name',))
+        self.assertEqual(summary.loc['T2', 'count'], 2)
+        self.assertAlmostEqual(summary.loc['T2', 'bias'], -1.0, places=2)
+        self.assertAlmostEqual(summary.loc['T2', 'mae'], 2.0, places=2)
+        self.assertAlmostEqual(summary.loc['T2', 'hit_rate'], 0.5)
+
+
+class RegionAggregateTest(SimulationTestCase):
+    """Agregados por provincia y municipio"""
+
+    def test_region_aggregates(self):
+        call_command('add_stations_data', stdout=io.StringIO())
+        payload = build_synthetic_payload('2026020400', 'RAINC', (24, 36), frames=3)
+        write_field_store(self.simulation, 'RAINC', payload)
+
+        # Cada celda pertenece a lo sumo a un municipio; la provincia es la unión de los suyos
+        province = Province.objects.get(code='09')
+        masks = {
+            (mask.province_id, mask.town_id): np.unpackbits(np.frombuffer(bytes(mask.mask), np.uint8), count=24 * 36)
+            for mask in RegionMask.objects.all()
+        }
+        town_masks = [mask for (province_id, _), mask in masks.items() if province_id is None]
+        self.assertLessEqual(max(np.sum(town_masks, axis=0)), 1)
+        np.testing.assert_array_equal(masks[(province.pk, None)], np.sum(town_masks, axis=0))
+
+        # Agregados de la provincia calculados celda a celda
+        aggregate = RegionAggregate.objects.get(simulation=self.simulation, variable_name='RAINC', province=province)
+        cells = masks[(province.pk, None)].astype(bool)
+        areas = get_cell_areas(payload['lats'], payload['longs']).ravel()[cells]
+        for k, frame in enumerate(payload['var']):
+            values = frame.ravel()[cells]
+            self.assertAlmostEqual(aggregate.mean[k], np.average(values, weights=areas), places=3)
+            self.assertAlmostEqual(aggregate.maximum[k], values.max(), places=3)
+            self.assertAlmostEqual(aggregate.total[k], values.sum(), delta=0.05)
+
+        url = '/api/simulations/regions/?datetime_init=2026020400&variables=RAINC'
+        data = self.client.get(f'{url}&province=09&hours=1').json()
+        self.assertEqual(data['times'], payload['times'][:2])
+        self.assertEqual(data['regions'][0]['name'], str(province))
+        self.assertEqual(len(data['regions'][0]['series']['RAINC']['max']), 2)
+        town = Town.objects.first()
+        self.assertEqual(self.client.get(f'{url}&town={town.pk}').json()['regions'][0]['town'], town.pk)
+        self.assertEqual(self.client.get(f'{url},T2').status_code, 404)
+
+
+def stub_feature(*args):
+    """Elemento de Natural Earth sustituido por un polígono que cubre el dominio (sin descargas)"""
+    return cfeature.ShapelyFeature([box(-180, -90, 180, 90)], ccrs.PlateCarree())
+
+
+class BasemapCacheTest(SimpleTestCase):
+    """Caché del mapa base rasterizado, en memoria y en disco"""
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        override = override_settings(WRF_IMG_BASEMAP_CACHE_DIR=cache_dir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.cache_dir = cache_dir.name
+
+        features = mock.Mock()
+        for name in ('LAND', 'OCEAN', 'COASTLINE', 'BORDERS', 'STATES'):
+            getattr(features, name).with_scale.side_effect = stub_feature
+        patcher = mock.patch('wrf_img.utils.basemap.cfeature', features)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        basemap.clear_basemap_cache()
+        self.addCleanup(basemap.clear_basemap_cache)
+
+        self.extent = basemap.get_map_extent(*build_synthetic_grid((12, 18)))
+
+    def get_layers(self):
+        with mock.patch('wrf_img.utils.basemap.render_basemap_layers', wraps=basemap.render_basemap_layers) as render:
+            layers = basemap.get_basemap_layers(self.extent, (2, 1.5), 20)
+        return layers, render.call_count
+
+    def test_layers_are_cached_in_memory_and_on_disk(self):
+        layers, renders = self.get_layers()
+        self.assertEqual(renders, 1)
+        width, height = basemap.get_basemap_size(self.extent, (2, 1.5), 20)
+        self.assertEqual(layers[0].shape, (height, width, 4))
+        # La capa inferior es opaca (tierra sobre el fondo blanco)
+        self.assertTrue(layers[0][..., 3].all())
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # En memoria: las mismas capas sin rasterizar
+        cached, renders = self.get_layers()
+        self.assertEqual(renders, 0)
+        self.assertIs(cached, layers)
+
+        # Desde el .npz tras vaciar la memoria (otro proceso)
+        basemap.clear_basemap_cache()
+        stored, renders = self.get_layers()
+        self.assertEqual(renders, 0)
+        for layer, stored_layer in zip(layers, stored):
+            np.testing.assert_array_equal(stored_layer, layer)
+
+        # Otra versión de la caché vuelve a rasterizar en otro fichero
+        with override_settings(WRF_IMG_BASEMAP_CACHE_VERSION='2'):
+            _, renders = self.get_layers()
+        self.assertEqual(renders, 1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        basemap.clear_basemap_cache(remove_files=True)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class MeteoFrameRendererTest(FakeBasemapMixin, SimpleTestCase):
+    """Reutilizar la figura entre fotogramas da las mismas imágenes que una figura por fotograma"""
+
+    def setUp(self):
+        self.lats, self.longs = build_synthetic_grid((24, 36))
+        self.use_fake_basemap(self.lats, self.longs)
+        self.initial_datetime = timezone.make_aware(datetime(2026, 2, 4, 0))
+
+    def test_reused_figure_is_pixel_identical(self):
+        # slp: isolíneas con etiquetas; wd10: barbas; clflo: mapa base oscuro
+        for var_name in ('slp', 'wd10', 'clflo'):
+            payload = build_synthetic_payload('2026020400', var_name, (24, 36), frames=3)
+            renderer = MeteoFrameRenderer(var_name, self.lats, self.longs, self.initial_datetime)
+            self.addCleanup(renderer.close)
+
+            for i, var_frame, u_frame, v_frame in iter_payload_frames(payload):
+                time_str = payload['times'][i]
+                reused = renderer.render(time_str, var_frame, u_frame, v_frame)
+                expected = render_meteo_frame(
+                    var_name, self.lats, self.longs, time_str, self.initial_datetime,
+                    var_frame, u_frame, v_frame
+                )
+                with self.subTest(variable=var_name, frame=i):
+                    np.testing.assert_array_equal(decode_png(reused), decode_png(expected))
+
+    def test_fixed_layout_matches_tight_bbox(self):
+        # En wd10 el título es lo que más sobresale: el recorte cambia con su longitud
+        payload = build_synthetic_payload('2026020400', 'wd10', (24, 36), frames=3)
+        times = ['2026-02-04T01:00:00', '2026-02-08T23:00:00', '2026-02-05T10:00:00']
+        images = {}
+        for fixed_layout in (False, True):
+            with override_settings(WRF_IMG_FIXED_LAYOUT=fixed_layout):
+                renderer = MeteoFrameRenderer('wd10', self.lats, self.longs, self.initial_datetime)
+                self.addCleanup(renderer.close)
+                images[fixed_layout] = [
+                    renderer.render(times[i], var_frame, u_frame, v_frame)
+                    for i, var_frame, u_frame, v_frame in iter_payload_frames(payload)
+                ]
+        self.assertEqual(images[True], images[False])
+
+    def test_precomputed_geometry_matches_reprojection(self):
+        payload = build_synthetic_payload('2026020400', 'T2', (24, 36), frames=1)
+        var_frame = np.asarray(payload['var'][0])
+        plot_config = get_plot_config('T2')
+
+        fig = Figure(figsize=FIGSIZE, dpi=DPI)
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(projection=ccrs.PlateCarree())
+        ax.set_extent(basemap.get_map_extent(self.lats, self.longs), crs=ccrs.PlateCarree())
+
+        def render(draw):
+            contour = draw()
+            buffer = io.BytesIO()
+            fig.savefig(buffer, format='png', dpi=DPI)
+            contour.remove()
+            return decode_png(buffer.getvalue())
+
+        # Ruta anterior: Cartopy reproyecta los polígonos de cada contourf
+        expected = render(lambda: ax.contourf(
+            self.longs, self.lats, var_frame, levels=plot_config['levels'], cmap=plot_config['cmap'],
+            vmin=plot_config['vmin'], vmax=plot_config['vmax'], transform=ccrs.PlateCarree(),
+        ))
+        geometry = get_grid_geometry(self.lats, self.longs, ax.projection)
+        precomputed = render(lambda: draw_plot(
+            ax, 'T2', plot_config, self.lats, self.longs, var_frame, geometry=geometry
+        )[0])
+
+        np.testing.assert_array_equal(precomputed, expected)
+        # La geometría se calcula una vez por malla
+        self.assertIs(get_grid_geometry(self.lats.copy(), self.longs.copy(), ax.projection), geometry)
+
+    def test_palette_png_and_other_formats(self):
+        payload = build_synthetic_payload('2026020400', 'RAINC', (24, 36), frames=1)
+        renderer = MeteoFrameRenderer('RAINC', self.lats, self.longs, self.initial_datetime)
+        self.addCleanup(renderer.close)
+        images = renderer.render_images(payload['times'][0], payload['var'][0], formats=['png', 'webp', 'avif'])
+        rgba = np.array(render_rgba(renderer.fig, bbox_inches='tight', dpi=DPI))
+
+        png = Image.open(io.BytesIO(images['png']))
+        self.assertEqual(png.mode, 'P')
+        # Los colores de los rellenos se conservan exactos
+        pixels = decode_png(images['png'])
+        self.assertGreater((pixels == rgba).all(axis=-1).mean(), 0.95)
+        for image_format in ('webp', 'avif'):
+            with self.subTest(image_format=image_format):
+                image = Image.open(io.BytesIO(images[image_format]))
+                self.assertEqual(image.format, image_format.upper())
+                self.assertEqual(image.size, png.size)
+
+
+def decode_png(image_bytes):
+    return np.asarray(Image.open(io.BytesIO(image_bytes)).convert('RGBA'))
+
+
+class RenderEngineTest(SimpleTestCase):
+    """Fotogramas renderizados en el pool de procesos, en orden y sin dejar ficheros compartidos"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.lats, cls.longs = build_synthetic_grid((12, 18))
+        # Los procesos del pool salen de un único servidor de procesos, que lee la configuración
+        # del entorno al arrancar: el mapa base vacío va en una caché en disco de toda la clase
+        cache_dir = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(cache_dir.cleanup)
+        cls.cache_dir = cache_dir.name
+        environ = mock.patch.dict(os.environ, {'WRF_IMG_BASEMAP_CACHE_DIR': cls.cache_dir})
+        environ.start()
+        cls.addClassCleanup(environ.stop)
+        extent = basemap.get_map_extent(cls.lats, cls.longs)
+        layer = np.zeros((8, 8, 4), dtype=np.uint8)
+        with override_settings(WRF_IMG_BASEMAP_CACHE_DIR=cls.cache_dir):
+            key = basemap.get_basemap_key(extent, FIGSIZE, DPI)
+            cls.addClassCleanup(basemap._BASEMAP_CACHE.pop, key, None)
+            np.savez(basemap._get_cache_path(key), under=layer, over=layer)
+
+    def setUp(self):
+        self.initial_datetime = timezone.make_aware(datetime(2026, 2, 4, 0))
+        shared_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(shared_dir.cleanup)
+        self.shared_dir = shared_dir.name
+        override = override_settings(WRF_IMG_BASEMAP_CACHE_DIR=self.cache_dir, WRF_IMG_RENDER_SHM_DIR=self.shared_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.engine = RenderEngine(workers=2)
+        self.addCleanup(self.engine.shutdown)
+
+    def shared_files(self, include_grid=False):
+        return [
+            name for _, _, names in os.walk(self.shared_dir) for name in names
+            if name.endswith('.npy') and (include_grid or not name.startswith(('lats_', 'longs_')))
+        ]
+
+    def submit(self, payload):
+        return self.engine.submit(
+            'T2', self.lats, self.longs, payload['times'], self.initial_datetime, iter_payload_frames(payload)
+        )
+
+    def test_frames_are_returned_in_order(self):
+        payload = build_synthetic_payload('2026020400', 'T2', (12, 18), frames=4)
+        results = list(self.submit(payload))
+
+        self.assertEqual([frame_idx for frame_idx, _, _ in results], [0, 1, 2, 3])
+        renderer = MeteoFrameRenderer('T2', self.lats, self.longs, self.initial_datetime)
+        self.addCleanup(renderer.close)
+        for (i, var_frame, u_frame, v_frame), (_, images, _) in zip(iter_payload_frames(payload), results):
+            expected = renderer.render_images(payload['times'][i], var_frame, u_frame, v_frame)
+            with self.subTest(frame=i):
+                self.assertEqual(set(images), set(expected))
+                np.testing.assert_array_equal(decode_png(images['png']), decode_png(expected['png']))
+        self.assertEqual(self.shared_files(), [])
+
+    def test_closed_iterator_removes_shared_files(self):
+        payload = build_synthetic_payload('2026020400', 'T2', (12, 18), frames=4)
+        frames = self.submit(payload)
+        self.assertEqual(next(frames)[0], 0)
+        frames.close()
+        self.assertEqual(self.shared_files(), [])
+        # La malla se comparte entre variables hasta cerrar el motor
+        self.engine.shutdown()
+        self.assertEqual(self.shared_files(include_grid=True), [])
+
+
+class FieldStatsTest(SimpleTestCase):
+    def test_stats_match_numpy(self):
+        lats, longs = build_synthetic_grid((24, 36))
+        fields = np.stack([
+            build_synthetic_payload('2026020400', var_name, (24, 36), frames=3)['var'] for var_name in ('RAINC', 'ws10')
+        ])
+        fields[0, 1, 3, 4] = np.nan
+        areas = get_cell_areas(lats, longs)
+
+        for var_name, var_fields in zip(('RAINC', 'ws10'), fields):
+            levels = get_plot_config(var_name)['levels']
+            for frame, stats in zip(var_fields, compute_field_stats(var_name, var_fields, areas)):
+                values = frame[np.isfinite(frame)]
+                self.assertEqual(stats['nan_count'], frame.size - values.size)
+                self.assertAlmostEqual(stats['data_max'], float(values.max()), places=4)
+                self.assertAlmostEqual(stats['data_std'], float(values.std()), places=3)
+                self.assertAlmostEqual(stats['field_stats']['percentiles']['p95'], float(np.percentile(values, 95)), places=3)
+                counts = stats['field_stats']['histogram']['counts']
+                # Con los intervalos de los extremos, por debajo del primer nivel y desde el último
+                self.assertEqual(counts, np.histogram(values, bins=[-np.inf, *levels, np.inf])[0].tolist())
+                for threshold, area in stats['field_stats']['areas_km2'].items():
+                    self.assertAlmostEqual(area, areas[frame > float(threshold)].sum(), delta=0.1)
+
+
+class FinishingLockBackend(MemoryLockBackend):
+    """Otra ejecución marca sus variables como completas justo antes de que se obtenga el bloqueo"""
+
+    def __init__(self, variables):
+        super().__init__()
+        self.variables = variables
+
+    def acquire(self, key, owner, ttl):
+        done_key = key.rsplit(':', 1)[0] + ':done'
+        for var_name in self.variables:
+            self.add_marker(done_key, var_name, ttl)
+        return super().acquire(key, owner, ttl)
+
+
+class FlakyLockBackend(MemoryLockBackend):
+    """El backend deja de responder al marcar variables y al liberar el bloqueo"""
+
+    def add_marker(self, key, member, ttl):
+        raise LockUnavailable("Redis no responde")
+
+    def release(self, key, owner):
+        raise LockUnavailable("Redis no responde")
+
+
+class SlowPlotJob:
+    """MeteoPlotJob cuyo render dura más que el ttl del bloqueo"""
+
+    def __init__(self, datetime_init, var_name, data=None):
+        self.skipped = 0
+        self.timings = StageTimings()
+
+    def save(self, before_save=None):
+        time.sleep(0.6)
+        before_save()
+        return []
+
+
+class MeteoImagesTaskTest(FakeBasemapMixin, TestCase):
+    """Reparto de generate_meteo_images_task en tareas de Celery (modo eager)"""
+
+    def setUp(self):
+        self.api = StandInModelAPI(grid_shape=(12, 20), frames=2)
+        self.api.start()
+        self.addCleanup(self.api.stop)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        override = override_settings(
+            MEDIA_ROOT=os.path.join(tmp_dir.name, 'media'),
+            WRF_IMG_FIELD_CACHE_DIR=os.path.join(tmp_dir.name, 'fields'),
+            WRF_IMG_FIELD_CACHE_MAX_MB=64,
+            WRF_IMG_MODEL_API_URL=self.api.url,
+            # Celery en modo eager con resultados en memoria (los chords no necesitan Redis)
+            CELERY_TASK_ALWAYS_EAGER=True,
+            CELERY_TASK_EAGER_PROPAGATES=True,
+            CELERY_RESULT_BACKEND='cache+memory://',
+            WRF_IMG_CYCLE_LOCK_URL='memory://',
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        for reset in (reset_field_cache, reset_model_client, reset_lock_backend):
+            reset()
+            self.addCleanup(reset)
+
+        self.reset_celery_backend()
+        self.addCleanup(self.reset_celery_backend)
+
+        self.use_fake_basemap(*build_synthetic_grid((12, 20)))
+
+    def reset_celery_backend(self):
+        # La instancia del backend se crea una vez; se descarta para que use result_backend
+        celery_app._backend_cache = None
+        celery_app._local = threading.local()
+
+    def test_variables_and_frames_fan_out(self):
+        # apply() ejecuta en el proceso, como un worker; delay() en modo eager no permite
+        # los chords anidados que crean las tareas al reemplazarse
+        summary = generate_meteo_images_task.apply(args=(4,)).get()
+
+        variables = ['T2', 'rh2', 'RAINC', 'slp', 'ws10', 'wd10']
+        self.assertEqual(summary['results'], {var_name: 'Generadas 2 imágenes' for var_name in variables})
+        self.assertEqual(MeteoImage.objects.count(), 12)
+        self.assertEqual(Simulation.objects.count(), 1)
+        # Cada variable se descarga una vez; los fotogramas se leen de la caché de campos
+        self.assertEqual(len(self.api.requests), len(variables))
+        for image in MeteoImage.objects.all():
+            self.assertTrue(os.path.exists(image.image.path))
+            self.assertEqual(image.nan_count, 0)
+            self.assertIn('p50', image.field_stats['percentiles'])
+        datetime_init = timezone.now().strftime('%Y%m%d') + '00'
+        stats = self.client.get(f'/api/simulations/?datetime_init={datetime_init}&var_name=RAINC').json()['stats']
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(sum(stats[0]['histogram']['counts']), 12 * 20)
+        # Tiempos por etapa de la descarga y de los dos fotogramas de cada variable
+        self.assertEqual(set(summary['timings']), set(variables))
+        for timings in summary['timings'].values():
+            self.assertEqual(timings['savefig']['count'], 2)
+            self.assertIn('fetch', timings)
+            self.assertIn('db', timings)
+
+    @override_settings(WRF_IMG_FIELD_CACHE_MAX_MB=0)
+    def test_frames_are_read_from_field_store(self):
+        # Sin caché de campos cada fotograma se lee del almacén de la simulación, sin volver a descargar
+        reset_field_cache()
+        reset_model_client()
+        summary = generate_meteo_images_task.apply(args=(4,)).get()
+
+        self.assertEqual(set(summary['results'].values()), {'Generadas 2 imágenes'})
+        self.assertEqual(MeteoImage.objects.count(), 12)
+        self.assertEqual(len(self.api.requests), 6)
+        for timings in summary['timings'].values():
+            self.assertEqual(timings['savefig']['count'], 2)
+
+    def test_completed_variables_are_resumed(self):
+        # Con hour=4 el ciclo es el de las 00Z del día actual
+        datetime_init = timezone.now().strftime('%Y%m%d') + '00'
+        mark_variable_done(datetime_init, 'T2')
+        mark_variable_done(datetime_init, 'rh2')
+
+        summary = generate_meteo_images_task.apply(args=(4,)).get()
+
+        self.assertEqual(summary['results']['T2'], 'Ya generadas')
+        self.assertEqual(summary['results']['slp'], 'Generadas 2 imágenes')
+        self.assertEqual(len(self.api.requests), 4)
+        self.assertEqual(MeteoImage.objects.count(), 8)
+
+        # Con todas las variables completas no se vuelve a generar nada
+        result = generate_meteo_images_task.apply(args=(4,)).get()
+        self.assertIn('ya existe', result)
+        self.assertEqual(len(self.api.requests), 4)
+
+    def test_markers_are_read_after_acquiring_the_lock(self):
+        # La ejecución anterior termina todas las variables justo antes de soltar el bloqueo
+        datetime_init = timezone.now().strftime('%Y%m%d') + '00'
+        backend = FinishingLockBackend(['T2', 'rh2', 'RAINC', 'slp', 'ws10', 'wd10'])
+        with mock.patch('wrf_img.utils.cycle_lock.get_lock_backend', return_value=backend):
+            result = generate_meteo_images_task.apply(args=(4,)).get()
+            self.assertIn('ya existe', result)
+            self.assertIsNone(backend.get_owner(CycleLease(datetime_init).key))
+
+            output = io.StringIO()
+            call_command('generate_images', hours='00', variables='T2', resume=True, stdout=output)
+            self.assertIn(f'Ciclo {datetime_init} ya generado', output.getvalue())
+        self.assertEqual(self.api.requests, [])
+
+    def test_marker_and_release_failures_keep_saved_images(self):
+        with mock.patch('wrf_img.utils.cycle_lock.get_lock_backend', return_value=FlakyLockBackend()):
+            summary = generate_meteo_images_task.apply(args=(4,)).get()
+        self.assertEqual(summary['results']['T2'], 'Generadas 2 imágenes')
+
+        # El bloqueo que no se pudo liberar caduca solo: otra ejecución empieza con el backend vacío
+        MeteoImage.objects.all().delete()
+        output = io.StringIO()
+        with mock.patch('wrf_img.utils.cycle_lock.get_lock_backend', return_value=FlakyLockBackend()):
+            call_command('generate_images', hours='00', variables='T2', stdout=output)
+        self.assertIn('Éxitos: 2', output.getvalue())
+        self.assertIn('No se pudo marcar T2 como completa', output.getvalue())
+        self.assertIn('Errores: 0', output.getvalue())
+        self.assertNotIn('sin generar', output.getvalue())
+        images = MeteoImage.objects.filter(variable_name='T2')
+        self.assertEqual(images.count(), 2)
+        self.assertTrue(all(os.path.exists(image.image.path) for image in images))
+
+    @override_settings(WRF_IMG_CYCLE_LOCK_TTL=0.3)
+    def test_in_process_render_keeps_the_lease(self):
+        lease = CycleLease('2025010100')
+        self.assertTrue(lease.acquire())
+        with mock.patch('wrf_img.tasks.MeteoPlotJob', SlowPlotJob):
+            result = render_variable('2025010100', 'T2', lease.owner)
+        self.assertEqual(result['images'], 0)
+        self.assertEqual(lease.backend.get_owner(lease.key), lease.owner)
+
+    def test_frame_is_not_written_after_losing_the_lease(self):
+        datetime_init = '2025010100'
+        lease = CycleLease(datetime_init)
+        self.assertTrue(lease.acquire())
+
+        def steal_lease(*args):
+            # Otra ejecución toma el ciclo mientras se renderiza el fotograma
+            lease.release()
+            CycleLease(datetime_init).acquire()
+
+        with mock.patch('wrf_img.tasks.render_frame_tiles', side_effect=steal_lease):
+            result = render_frame_task(datetime_init, 'T2', 0, lease.owner)
+        self.assertIn('error', result)
+        media_files = [name for _, _, names in os.walk(settings.MEDIA_ROOT) for name in names]
+        self.assertEqual(media_files, [])
+
+    def test_unchanged_frames_are_skipped(self):
+        generate_meteo_images_task.apply(args=(4,)).get()
+        image_names = set(MeteoImage.objects.values_list('image', flat=True))
+
+        # Se borran las marcas de variables completas: sólo el hash evita volver a renderizar
+        reset_lock_backend()
+        stale = MeteoImage.objects.filter(variable_name='T2').first()
+        MeteoImage.objects.filter(pk=stale.pk).update(render_hash='desactualizado')
+
+        summary = generate_meteo_images_task.apply(args=(4,)).get()
+
+        self.assertEqual(summary['results']['T2'], 'Generadas 1 imágenes (1 sin cambios)')
+        self.assertEqual(summary['results']['wd10'], 'Generadas 0 imágenes (2 sin cambios)')
+        self.assertEqual(MeteoImage.objects.count(), 12)
+        changed = image_names ^ set(MeteoImage.objects.values_list('image', flat=True))
+        self.assertEqual(changed, {stale.image.name, MeteoImage.objects.get(pk=stale.pk).image.name})
+
+    def test_locked_cycle_is_skipped(self):
+        datetime_init = timezone.now().strftime('%Y%m%d') + '00'
+        lease = CycleLease(datetime_init)
+        self.assertTrue(lease.acquire())
+
+        result = generate_meteo_images_task.apply(args=(4,)).get()
+
+        self.assertIn('en proceso', result)
+        self.assertEqual(self.api.requests, [])
+        self.assertEqual(MeteoImage.objects.count(), 0)
+        # El bloqueo sigue siendo de quien lo tenía
+        lease.heartbeat()
+
+
+class CycleLeaseTest(SimpleTestCase):
+    """Bloqueo con caducidad por ciclo"""
+
+    def setUp(self):
+        self.backend = MemoryLockBackend()
+
+    def test_only_one_owner(self):
+        with CycleLease('2026020400', backend=self.backend) as lease:
+            with self.assertRaises(CycleLocked):
+                with CycleLease('2026020400', backend=self.backend):
+                    pass
+            # Otro ciclo no queda bloqueado
+            self.assertTrue(CycleLease('2026020406', backend=self.backend).acquire())
+            lease.heartbeat()
+
+        # Al salir se libera
+        self.assertTrue(CycleLease('2026020400', backend=self.backend).acquire())
+
+    def test_expired_lease_is_taken_over(self):
+        lease = CycleLease('2026020400', ttl=0.05, backend=self.backend)
+        self.assertTrue(lease.acquire())
+        time.sleep(0.1)
+
+        # Sin heartbeat el bloqueo caduca (proceso caído) y otra ejecución retoma el ciclo
+        other = CycleLease('2026020400', ttl=60, backend=self.backend)
+        self.assertTrue(other.acquire())
+        with self.assertRaises(LeaseLost):
+            lease.heartbeat()
+        with self.assertRaises(LeaseLost):
+            lease.check()
+        # El dueño anterior no puede liberar el bloqueo del nuevo
+        self.assertFalse(lease.release())
+        other.heartbeat()
+
+    def test_heartbeat_keeps_lease(self):
+        lease = CycleLease('2026020400', ttl=0.2, backend=self.backend)
+        self.assertTrue(lease.acquire())
+        lease.start_heartbeat(interval=0.05)
+        self.addCleanup(lease.stop_heartbeat)
+        time.sleep(0.4)
+
+        self.assertFalse(CycleLease('2026020400', backend=self.backend).acquire())
+        lease.check()
+
+    @override_settings(WRF_IMG_CYCLE_LOCK_URL='redis://127.0.0.1:1/0', WRF_IMG_RENDER_WORKERS=1)
+    def test_unreachable_backend_skips_cycles(self):
+        # Sin Redis cada ciclo se informa como error y el comando termina con el resumen
+        reset_lock_backend()
+        self.addCleanup(reset_lock_backend)
+        with self.assertRaises(LockUnavailable):
+            CycleLease('2026020400').acquire()
+
+        output = io.StringIO()
+        call_command('generate_images', date='20260204', hours='00,06', variables='T2', resume=True, stdout=output)
+        output = output.getvalue()
+        self.assertIn('Ciclo 2026020400 sin generar', output)
+        self.assertIn('Ciclo 2026020406 sin generar', output)
+        self.assertIn('Errores: 2', output)
+
+
+class StageTimingsTest(SimpleTestCase):
+    def test_nested_spans_are_exclusive(self):
+        timings = StageTimings()
+        with timings.activate():
+            with span('decode'):
+                time.sleep(0.02)
+                with span('fetch'):
+                    time.sleep(0.05)
+        with span('fetch'):
+            # Sin StageTimings activo no se registra nada
+            time.sleep(0.01)
+
+        totals = timings.as_dict()
+        self.assertEqual(totals['fetch']['count'], 1)
+        self.assertGreaterEqual(totals['fetch']['seconds'], 0.05)
+        self.assertLess(totals['decode']['seconds'], 0.05)
+
+        merged = StageTimings(totals)
+        merged.merge(timings)
+        self.assertEqual(merged.as_dict()['fetch']['count'], 2)
+
+
+class BenchmarkPipelineTest(FakeBasemapMixin, TestCase):
+    def setUp(self):
+        self.use_fake_basemap(*build_synthetic_grid((20, 40)))
+
+    def test_pipeline_reports_and_rolls_back(self):
+        result = benchmarks.benchmark_pipeline(grid_shape=(20, 40), frames=2, variables=['T2', 'wd10'])
+
+        self.assertEqual(result['runs'][0]['frames'], 4)
+        self.assertGreater(result['frames_per_second'], 0)
+        self.assertGreater(result['peak_rss_bytes'], 0)
+        self.assertEqual(result['stages']['savefig']['count'], 4)
+        self.assertEqual(set(result['variable_stages']), {'T2', 'wd10'})
+        # La ejecución no deja filas ni simulaciones
+        self.assertFalse(MeteoImage.objects.exists())
+        self.assertFalse(Simulation.objects.exists())
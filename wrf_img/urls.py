@@ -3,4 +3,13 @@ from . import views
 
 urlpatterns = [
     path('', views.SimulationListView.as_view(), name='simulation_list'),  # Única ruta para ambas funcionalidades Ej:http://localhost:8000/simulations/?datetime_init=2026020400&var_name=T2
+    # Serie temporal en un punto: /api/simulations/point/?datetime_init=2026020400&variables=T2&lat=23.1&lon=-82.4
+    path('point/', views.PointForecastView.as_view(), name='point_forecast'),
+    # Valores por provincia o municipio: /api/simulations/regions/?datetime_init=2026020400&variables=RAINC&province=09
+    path('regions/', views.RegionForecastView.as_view(), name='region_forecast'),
+    # Teselas XYZ: /api/simulations/tiles/2026020400/T2/2026020406/6/17/28.png
+    path(
+        'tiles/<str:datetime_init>/<str:var_name>/<str:valid_time>/<int:z>/<int:x>/<int:y>.png',
+        views.meteo_tile, name='meteo_tile'
+    ),
 ]
@@ -0,0 +1,255 @@
+"""
+Animaciones de los fotogramas de cada variable.
+
+Después de guardar las imágenes de una variable, sus fotogramas se reúnen en un único fichero
+animado por formato (ver MeteoAnimation), de modo que un cliente descarga una animación en
+lugar de una imagen por tiempo. Formatos: WebP animado y APNG con Pillow, y WebM con ffmpeg
+si está instalado. Una animación sólo se vuelve a generar si cambió alguno de sus fotogramas.
+"""
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image
+
+from wrf_img.models import MeteoAnimation, MeteoImage
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+# Extensión y tipo de contenido de cada formato (el APNG se sirve como PNG)
+ANIMATION_FORMATS = {
+    'webp': ('webp', 'image/webp'),
+    'apng': ('png', 'image/apng'),
+    'webm': ('webm', 'video/webm'),
+}
+
+# Calidad del vídeo WebM (CRF de VP9: menor es mejor, 0-63)
+WEBM_CRF = 35
+
+_unavailable_warned = set()
+
+
+def get_animation_formats():
+    """Formatos configurados en WRF_IMG_ANIMATION_FORMATS que se pueden generar"""
+    formats = []
+    for animation_format in getattr(settings, 'WRF_IMG_ANIMATION_FORMATS', '').split(','):
+        animation_format = animation_format.strip().lower()
+        if not animation_format or animation_format in formats:
+            continue
+        if animation_format not in ANIMATION_FORMATS:
+            raise ValueError(f"Formato de animación no soportado: {animation_format}")
+        if animation_format == 'webm' and get_ffmpeg() is None:
+            if animation_format not in _unavailable_warned:
+                _unavailable_warned.add(animation_format)
+                logger.warning("No se encontró ffmpeg; no se generan animaciones WebM")
+            continue
+        formats.append(animation_format)
+    return formats
+
+
+def get_ffmpeg():
+    """Ruta del ejecutable de ffmpeg (WRF_IMG_FFMPEG_BINARY) o None si no está disponible"""
+    return shutil.which(getattr(settings, 'WRF_IMG_FFMPEG_BINARY', 'ffmpeg'))
+
+
+def update_meteo_animations(simulation, var_name, formats=None):
+    """
+    Genera las animaciones de una variable con sus fotogramas guardados, en orden de
+    tiempo válido. Los formatos cuya animación ya corresponde a los mismos fotogramas no
+    se vuelven a generar. Retorna las MeteoAnimation actualizadas.
+    """
+    if formats is None:
+        formats = get_animation_formats()
+    if not formats:
+        return []
+
+    with span('db'):
+        meteo_images = list(
+            MeteoImage.objects.filter(simulation=simulation, variable_name=var_name).order_by('valid_datetime')
+        )
+        existing = {
+            animation.animation_format: animation
+            for animation in MeteoAnimation.objects.filter(simulation=simulation, variable_name=var_name)
+        }
+    if len(meteo_images) < 2:
+        return []
+
+    frames_hash = get_frames_hash(meteo_images)
+    pending = [
+        animation_format for animation_format in formats
+        if animation_format not in existing or existing[animation_format].frames_hash != frames_hash
+    ]
+    if not pending:
+        return []
+
+    duration = int(getattr(settings, 'WRF_IMG_ANIMATION_FRAME_MS', 500))
+    updated = []
+    with span('animation'):
+        frames = AnimationFrames(meteo_images)
+        for animation_format in pending:
+            animation_bytes = encode_animation(frames, animation_format, duration)
+            animation = existing.get(animation_format) or MeteoAnimation(
+                simulation=simulation, variable_name=var_name, animation_format=animation_format,
+            )
+            old_file = animation.file.name if animation.file else None
+            extension = ANIMATION_FORMATS[animation_format][0]
+            animation.file.save(f"{var_name}_loop.{extension}", ContentFile(animation_bytes), save=False)
+            animation.frame_count = frames.n_frames
+            animation.frames_hash = frames_hash
+            animation.save()
+            if old_file and old_file != animation.file.name:
+                storage = animation.file.storage
+                transaction.on_commit(lambda name=old_file: storage.delete(name))
+            updated.append(animation)
+
+    return updated
+
+
+def refresh_meteo_animations(simulation, var_name):
+    """
+    update_meteo_animations tras guardar las imágenes de una variable: un error se registra
+    pero no se propaga, porque las imágenes ya están guardadas
+    """
+    try:
+        return update_meteo_animations(simulation, var_name)
+    except Exception as e:
+        logger.error(f"Error generando las animaciones de {var_name}: {str(e)}")
+        return []
+
+
+def get_frames_hash(meteo_images):
+    """Hash de los ficheros de los fotogramas (cambian con cada nuevo renderizado)"""
+    digest = hashlib.sha256()
+    for meteo_image in meteo_images:
+        digest.update(f'{meteo_image.image.name}:{meteo_image.render_hash}\n'.encode())
+    return digest.hexdigest()
+
+
+class AnimationFrames(Image.Image):
+    """
+    Fotogramas de una animación como una imagen de varios fotogramas (como un GIF abierto con
+    Pillow): seek() lee y decodifica sólo el fotograma pedido, de modo que WebP no necesita
+    tenerlos todos en memoria (el escritor de APNG de Pillow sí los conserva). Todos tienen el
+    tamaño del mayor: el recorte de cada imagen puede variar unos píxeles con la longitud del
+    título y las menores se centran sobre fondo blanco.
+
+    Comprobado con Pillow 11.3.0 (requirements.txt): _size, _mode e im son atributos internos
+    de Image.Image, y los escritores de WebP y APNG recorren los fotogramas con n_frames, seek()
+    y tell(). Pasar append_images no evita tener todos en memoria: el escritor de WebP hace
+    list() de la secuencia y convierte cada imagen. MeteoAnimationTest comprueba cada
+    fotograma de las animaciones escritas.
+    """
+
+    def __init__(self, meteo_images):
+        super().__init__()
+        self.meteo_images = list(meteo_images)
+        # Image.open sólo lee la cabecera
+        sizes = []
+        for meteo_image in self.meteo_images:
+            with meteo_image.image.open('rb') as fh, Image.open(fh) as image:
+                sizes.append(image.size)
+        self._size = (max(width for width, _ in sizes), max(height for _, height in sizes))
+        self._mode = 'RGB'
+        self.n_frames = len(self.meteo_images)
+        self.is_animated = self.n_frames > 1
+        self._frame_index = None
+        self.seek(0)
+
+    def get_frame(self, frame):
+        """Fotograma decodificado como una imagen RGB del tamaño de la animación"""
+        if not 0 <= frame < self.n_frames:
+            raise EOFError("No hay más fotogramas")
+        with self.meteo_images[frame].image.open('rb') as fh, Image.open(fh) as image:
+            image = image.convert('RGB')
+        if image.size != self.size:
+            canvas = Image.new('RGB', self.size, 'white')
+            canvas.paste(image, ((self.width - image.width) // 2, (self.height - image.height) // 2))
+            image = canvas
+        return image
+
+    def seek(self, frame):
+        if frame == self._frame_index:
+            return
+        self.im = self.get_frame(frame).im
+        self._frame_index = frame
+
+    def tell(self):
+        return self._frame_index
+
+
+def encode_animation(frames, animation_format, duration):
+    """
+    Codifica los fotogramas (AnimationFrames) en una animación (duration: milisegundos por
+    fotograma)
+    """
+    if animation_format == 'webm':
+        return encode_webm(frames, duration)
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024)
+    with buffer:
+        if animation_format == 'webp':
+            quality = int(getattr(settings, 'WRF_IMG_IMAGE_QUALITY', 80))
+            frames.save(
+                buffer, format='WEBP', save_all=True, duration=duration, loop=0, quality=quality, method=4,
+            )
+        elif animation_format == 'apng':
+            frames.save(buffer, format='PNG', save_all=True, duration=duration, loop=0)
+        else:
+            raise ValueError(f"Formato de animación no soportado: {animation_format}")
+        buffer.seek(0)
+        return buffer.read()
+
+
+def encode_webm(frames, duration):
+    """Vídeo WebM (VP9) con ffmpeg, que recibe los fotogramas en PNG por la entrada estándar"""
+    ffmpeg = get_ffmpeg()
+    if ffmpeg is None:
+        raise RuntimeError("No se encontró ffmpeg para generar la animación WebM")
+
+    with tempfile.TemporaryDirectory(prefix='wrf_img_webm_') as tmp_dir, tempfile.TemporaryFile() as errors:
+        # El muxer de WebM necesita una salida con seek: el vídeo se escribe en un fichero
+        output = os.path.join(tmp_dir, 'loop.webm')
+        command = [
+            ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'image2pipe', '-c:v', 'png', '-framerate', f'{1000 / duration:.4f}', '-i', '-',
+            # yuv420p necesita ancho y alto pares
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white',
+            '-c:v', 'libvpx-vp9', '-pix_fmt', 'yuv420p', '-crf', str(WEBM_CRF), '-b:v', '0',
+            output,
+        ]
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=errors)
+        try:
+            # Un fotograma decodificado cada vez
+            for i in range(frames.n_frames):
+                buffer = io.BytesIO()
+                frames.get_frame(i).save(buffer, format='PNG', compress_level=1)
+                process.stdin.write(buffer.getvalue())
+        except BrokenPipeError:
+            # ffmpeg terminó antes de tiempo: el motivo queda en su salida de errores
+            pass
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+        try:
+            process.wait(timeout=600)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+        if process.returncode != 0:
+            errors.seek(0)
+            raise subprocess.CalledProcessError(process.returncode, command, stderr=errors.read())
+        with open(output, 'rb') as fh:
+            return fh.read()
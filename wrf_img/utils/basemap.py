@@ -0,0 +1,154 @@
+import hashlib
+import logging
+import os
+
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import numpy as np
+from django.conf import settings
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+logger = logging.getLogger(__name__)
+
+# Resolución de los elementos de Natural Earth
+RESOLUTION = '10m'
+
+# Capas rasterizadas en memoria: {clave: (capa_inferior, capa_superior)}
+_BASEMAP_CACHE = {}
+
+
+def get_map_extent(lats, longs):
+    """Retorna la extensión [lon_min, lon_max, lat_min, lat_max] del dominio"""
+    return [
+        float(np.min(longs)), float(np.max(longs)),
+        float(np.min(lats)), float(np.max(lats))
+    ]
+
+
+def get_basemap_key(extent, figsize, dpi):
+    """
+    Clave de caché del mapa base: (extensión, tamaño de figura, dpi). Las variables de nubosidad
+    usan el mismo mapa base (sólo cambia el fondo de la figura, ver setup_figure).
+    Incluye WRF_IMG_BASEMAP_CACHE_VERSION para poder invalidar la caché desde la configuración.
+    """
+    version = getattr(settings, 'WRF_IMG_BASEMAP_CACHE_VERSION', '1')
+    return (
+        tuple(round(float(x), 4) for x in extent),
+        tuple(float(x) for x in figsize),
+        int(dpi),
+        str(version),
+    )
+
+
+def get_basemap_layers(extent, figsize, dpi):
+    """
+    Retorna las capas del mapa base rasterizadas para un dominio.
+
+    El mapa base se divide en dos capas RGBA para respetar el orden de dibujo de Cartopy:
+    - inferior (tierra y océano, zorder -1), debajo de los datos
+    - superior (costas, fronteras y provincias, zorder 1.5), encima del relleno de colores
+
+    Las capas se generan una sola vez por clave y se guardan en memoria y en disco.
+    """
+    key = get_basemap_key(extent, figsize, dpi)
+    layers = _BASEMAP_CACHE.get(key)
+    if layers is not None:
+        return layers
+
+    cache_path = _get_cache_path(key)
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            with np.load(cache_path) as stored:
+                layers = (stored['under'], stored['over'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Caché de mapa base corrupta en {cache_path}: {str(e)}")
+            layers = None
+
+    if layers is None:
+        logger.info(f"Rasterizando mapa base para el dominio {key[0]}")
+        layers = render_basemap_layers(extent, figsize, dpi)
+        if cache_path:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = f"{cache_path}.tmp.npz"
+                np.savez(tmp_path, under=layers[0], over=layers[1])
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                logger.warning(f"No se pudo guardar la caché del mapa base: {str(e)}")
+
+    _BASEMAP_CACHE[key] = layers
+    return layers
+
+
+def get_basemap_size(extent, figsize, dpi):
+    """
+    Tamaño (ancho, alto) en píxeles del raster del mapa base: conserva la relación de aspecto
+    del dominio con el ancho de la figura final
+    """
+    width_px = int(round(figsize[0] * dpi))
+    lon_span = extent[1] - extent[0]
+    lat_span = extent[3] - extent[2]
+    height_px = max(1, int(round(width_px * lat_span / lon_span)))
+    return width_px, height_px
+
+
+def render_basemap_layers(extent, figsize, dpi):
+    """Rasteriza las capas estáticas del mapa para la extensión indicada"""
+    width_px, height_px = get_basemap_size(extent, figsize, dpi)
+
+    def render(add_features, background):
+        fig = Figure(figsize=(width_px / dpi, height_px / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        fig.patch.set_alpha(0)
+        ax = fig.add_axes([0, 0, 1, 1], projection=ccrs.PlateCarree())
+        ax.set_extent(extent, crs=ccrs.PlateCarree())
+        ax.set_aspect('auto')
+        ax.spines['geo'].set_visible(False)
+        if background:
+            ax.set_facecolor(background)
+        else:
+            ax.patch.set_visible(False)
+        add_features(ax)
+        canvas.draw()
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+    def add_under(ax):
+        ax.add_feature(cfeature.LAND.with_scale(RESOLUTION), facecolor='#f5f5f5')
+        ax.add_feature(cfeature.OCEAN.with_scale(RESOLUTION), facecolor='#c8e4ff')
+
+    def add_over(ax):
+        ax.add_feature(cfeature.COASTLINE.with_scale(RESOLUTION), linewidth=0.8)
+        ax.add_feature(cfeature.BORDERS.with_scale(RESOLUTION), linestyle=':', linewidth=0.5)
+        ax.add_feature(cfeature.STATES.with_scale(RESOLUTION), linewidth=0.3, edgecolor='gray')
+
+    # El fondo de los ejes es blanco también en las variables de nubosidad (ver setup_figure)
+    under = render(add_under, 'white')
+    over = render(add_over, None)
+    return under, over
+
+
+def draw_basemap(ax, extent, figsize, dpi):
+    """Compone las capas del mapa base cacheadas sobre unos ejes PlateCarree"""
+    under, over = get_basemap_layers(extent, figsize, dpi)
+    image_extent = [extent[0], extent[1], extent[2], extent[3]]
+    ax.imshow(under, extent=image_extent, origin='upper', zorder=-1, transform=ccrs.PlateCarree())
+    ax.imshow(over, extent=image_extent, origin='upper', zorder=1.5, transform=ccrs.PlateCarree())
+
+
+def clear_basemap_cache(remove_files=False):
+    """Vacía la caché en memoria y, opcionalmente, los ficheros en disco"""
+    _BASEMAP_CACHE.clear()
+    cache_dir = getattr(settings, 'WRF_IMG_BASEMAP_CACHE_DIR', None)
+    if remove_files and cache_dir and os.path.isdir(cache_dir):
+        for filename in os.listdir(cache_dir):
+            if filename.endswith('.npz'):
+                os.remove(os.path.join(cache_dir, filename))
+
+
+def _get_cache_path(key):
+    cache_dir = getattr(settings, 'WRF_IMG_BASEMAP_CACHE_DIR', None)
+    if not cache_dir:
+        return None
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(cache_dir, f"basemap_{digest}.npz")
@@ -0,0 +1,301 @@
+"""
+Benchmarks de la generación de imágenes WRF con datos sintéticos.
+
+Cada función retorna un diccionario serializable a JSON con los resultados, de modo que
+puedan compararse entre versiones (ver el comando manage.py benchmark_images).
+"""
+import json
+import resource
+import tempfile
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+import cartopy.crs as ccrs
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from django.db import transaction
+from django.test.utils import override_settings
+from matplotlib.figure import Figure
+
+from .basemap import get_map_extent
+from .grid_geometry import GridGeometry
+from .model_api import (
+    ModelDataClient, decode_npz, decode_raw_arrays, encode_npz, encode_raw_arrays, iter_json_events, iter_payload_frames,
+)
+from .plot_config import get_plot_config
+from .render_engine import RenderEngine
+from .standin_api import StandInModelAPI, build_synthetic_payload, encode_json
+from .timing import StageTimings
+
+# Variables del benchmark de la ruta completa: campo simple, barbas de viento e isobaras
+PIPELINE_VARIABLES = ('T2', 'wd10', 'slp')
+
+
+def measure(func, repeat=3):
+    """
+    Ejecuta func varias veces y retorna (resultado, mejor tiempo en segundos, pico de memoria
+    en bytes). El pico se mide con tracemalloc, que incluye las reservas de numpy.
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        result = None
+
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, best, peak
+
+
+def benchmark_decoders(grid_shape=(300, 700), frames=25, var_name='wd10', repeat=3):
+    """
+    Compara tamaño, tiempo de decodificación y pico de memoria de JSON, JSON incremental
+    (un fotograma a la vez, descartándolo después), NPZ y raw float32
+    """
+    payload = build_synthetic_payload('2026020400', var_name, grid_shape, frames)
+    bodies = {
+        'json': encode_json(payload),
+        'json_stream': encode_json(payload),
+        'npz': encode_npz(payload),
+        'raw': encode_raw_arrays(payload),
+    }
+
+    def decode_json(body):
+        # Ruta original: response.json() seguido de la conversión a arrays de numpy
+        data = json.loads(body)
+        return {key: np.array(value) if key != 'times' else value for key, value in data.items()}
+
+    def decode_json_stream(body):
+        # Trozos de 1 MB como los de la descarga; cada fotograma se descarta tras usarlo
+        chunks = (body[i:i + 1024 * 1024] for i in range(0, len(body), 1024 * 1024))
+        frames = 0
+        for event in iter_json_events(chunks):
+            frames += event[0] == 'frame'
+        return frames
+
+    decoders = {
+        'json': decode_json,
+        'json_stream': decode_json_stream,
+        'npz': decode_npz,
+        'raw': decode_raw_arrays,
+    }
+
+    results = {
+        'grid_shape': list(grid_shape),
+        'frames': frames,
+        'variable': var_name,
+        'formats': {},
+    }
+    for name, body in bodies.items():
+        decoder = decoders[name]
+        data, seconds, peak = measure(lambda: decoder(body), repeat=repeat)
+        results['formats'][name] = {
+            'bytes': len(body),
+            'decode_seconds': round(seconds, 4),
+            'peak_memory_bytes': peak,
+        }
+    return results
+
+
+def benchmark_contours(grid_shape=(300, 700), frames=5, var_name='slp', repeat=3):
+    """
+    Compara el tiempo por fotograma de contourf (más isolíneas en slp/PSFC) y dibujo de la
+    figura reproyectando cada contorno con Cartopy (transform=PlateCarree) frente a la
+    malla proyectada una vez (ver GridGeometry)
+    """
+    from .plot_generators import DPI, FIGSIZE
+
+    payload = build_synthetic_payload('2026020400', var_name, grid_shape, frames)
+    lats = np.asarray(payload['lats'])
+    longs = np.asarray(payload['longs'])
+    var_frames = [var_frame for _, var_frame, _, _ in iter_payload_frames(payload)]
+    plot_config = get_plot_config(var_name)
+
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(projection=ccrs.PlateCarree())
+    ax.set_extent(get_map_extent(lats, longs), crs=ccrs.PlateCarree())
+
+    def draw_frames(x, y, transform):
+        for var_frame in var_frames:
+            artists = [ax.contourf(
+                x, y, var_frame, levels=plot_config.get('levels', 20), cmap=plot_config['cmap'],
+                extend=plot_config.get('extend', 'neither'), transform=transform,
+            )]
+            if var_name in ['slp', 'PSFC']:
+                artists.append(ax.contour(
+                    x, y, var_frame, levels=np.arange(950, 1051, 2), colors='black',
+                    linewidths=0.5, transform=transform,
+                ))
+            fig.canvas.draw()
+            for artist in artists:
+                artist.remove()
+
+    geometry, geometry_seconds, _ = measure(lambda: GridGeometry(lats, longs, ax.projection), repeat=repeat)
+    modes = {
+        'reproject': lambda: draw_frames(longs, lats, ccrs.PlateCarree()),
+        'precomputed': lambda: draw_frames(geometry.x, geometry.y, ax.transData),
+    }
+
+    results = {
+        'grid_shape': list(grid_shape),
+        'frames': frames,
+        'variable': var_name,
+        'geometry_seconds': round(geometry_seconds, 4),
+        'modes': {},
+    }
+    for name, func in modes.items():
+        _, seconds, peak = measure(func, repeat=repeat)
+        results['modes'][name] = {
+            'frame_seconds': round(seconds / frames, 4),
+            'peak_memory_bytes': peak,
+        }
+    results['speedup'] = round(
+        results['modes']['reproject']['frame_seconds'] / results['modes']['precomputed']['frame_seconds'], 2
+    )
+    return results
+
+
+def benchmark_layout(grid_shape=(300, 700), frames=5, var_name='wd10', repeat=3):
+    """
+    Compara el tiempo por fotograma de MeteoFrameRenderer calculando el recorte con
+    bbox_inches='tight' en cada savefig frente a calcularlo una vez por figura
+    (WRF_IMG_FIXED_LAYOUT) y comprueba que las imágenes son idénticas
+    """
+    from django.utils import timezone
+
+    from .plot_generators import MeteoFrameRenderer
+
+    payload = build_synthetic_payload('2026020400', var_name, grid_shape, frames)
+    initial_datetime = timezone.make_aware(timezone.datetime(2026, 2, 4, 0))
+    frame_list = list(iter_payload_frames(payload))
+
+    def render_frames():
+        renderer = MeteoFrameRenderer(var_name, payload['lats'], payload['longs'], initial_datetime)
+        try:
+            # El primer fotograma crea la figura; se mide el resto
+            renderer.render(payload['times'][0], *frame_list[0][1:])
+            start = time.perf_counter()
+            images = [renderer.render(payload['times'][i], *frame[1:]) for i, frame in enumerate(frame_list)]
+            return images, time.perf_counter() - start
+        finally:
+            renderer.close()
+
+    results = {
+        'grid_shape': list(grid_shape),
+        'frames': frames,
+        'variable': var_name,
+        'modes': {},
+    }
+    images = {}
+    for name, fixed_layout in (('tight', False), ('fixed', True)):
+        with override_settings(WRF_IMG_FIXED_LAYOUT=fixed_layout):
+            runs = [render_frames() for _ in range(repeat)]
+        images[name] = runs[0][0]
+        results['modes'][name] = {'frame_seconds': round(min(seconds for _, seconds in runs) / frames, 4)}
+    results['identical'] = images['tight'] == images['fixed']
+    results['saved_frame_seconds'] = round(
+        results['modes']['tight']['frame_seconds'] - results['modes']['fixed']['frame_seconds'], 4
+    )
+    results['speedup'] = round(
+        results['modes']['tight']['frame_seconds'] / results['modes']['fixed']['frame_seconds'], 2
+    )
+    return results
+
+
+def benchmark_pipeline(grid_shape=(300, 700), frames=5, variables=PIPELINE_VARIABLES, workers=1,
+                       formats=('json',), repeat=1):
+    """
+    Ejecuta la ruta completa de generate_images (descarga desde StandInModelAPI, renderizado,
+    escritura de las imágenes y de las filas) y retorna fotogramas por segundo, pico de
+    memoria residente (RSS) y tiempos por etapa (ver wrf_img.utils.timing).
+
+    Cada repetición se ejecuta en una transacción que se revierte y con MEDIA_ROOT en un
+    directorio temporal, así que no deja datos; sin caché de campos, para medir la descarga.
+    El pico de RSS es el del proceso desde que se inició (ru_maxrss), más el de los procesos
+    de render si workers != 1. image_bytes es el tamaño total de las imágenes por formato.
+    """
+    datetime_init = '2026020400'
+    variables = list(variables)
+    baseline_rss = _get_peak_rss()
+
+    runs = []
+    with StandInModelAPI(grid_shape=grid_shape, frames=frames, formats=formats) as api:
+        client = ModelDataClient(base_url=api.url, cache=False, binary=formats != ('json',))
+        engine = RenderEngine(workers=workers)
+        if engine.workers == 1:
+            engine = None
+        try:
+            with engine or nullcontext():
+                for _ in range(repeat):
+                    runs.append(_run_pipeline(client, engine, datetime_init, variables))
+        finally:
+            client.close()
+
+    best = min(runs, key=lambda run: run['seconds'])
+    return {
+        'grid_shape': list(grid_shape),
+        'frames': frames,
+        'variables': variables,
+        'workers': engine.workers if engine else 1,
+        'formats': list(formats),
+        'seconds': best['seconds'],
+        'frames_per_second': best['frames_per_second'],
+        'runs': [{key: run[key] for key in ('seconds', 'frames', 'frames_per_second')} for run in runs],
+        'image_bytes': best['image_bytes'],
+        'baseline_rss_bytes': baseline_rss,
+        'peak_rss_bytes': _get_peak_rss(),
+        'peak_rss_children_bytes': _get_peak_rss(resource.RUSAGE_CHILDREN),
+        'stages': best['stages'],
+        'variable_stages': best['variable_stages'],
+    }
+
+
+def _run_pipeline(client, engine, datetime_init, variables):
+    from .plot_generators import MeteoPlotJob
+
+    timings = StageTimings()
+    variable_stages = {}
+    image_bytes = {}
+    saved = 0
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+        with transaction.atomic():
+            start = time.perf_counter()
+            for var_name, data in client.iter_variables(datetime_init, variables):
+                if isinstance(data, Exception):
+                    raise data
+                job = MeteoPlotJob(datetime_init, var_name, engine=engine, data=data)
+                meteo_images = job.save()
+                saved += len(meteo_images)
+                for meteo_image in meteo_images:
+                    for image_format in meteo_image.available_formats():
+                        image_bytes[image_format] = (
+                            image_bytes.get(image_format, 0) + meteo_image.get_image_file(image_format).size
+                        )
+                timings.merge(job.timings)
+                variable_stages[var_name] = job.timings.as_dict()
+            seconds = time.perf_counter() - start
+            transaction.set_rollback(True)
+
+    return {
+        'seconds': round(seconds, 4),
+        'frames': saved,
+        'frames_per_second': round(saved / seconds, 3),
+        'image_bytes': image_bytes,
+        'stages': timings.as_dict(),
+        'variable_stages': variable_stages,
+    }
+
+
+def _get_peak_rss(who=resource.RUSAGE_SELF):
+    # En Linux ru_maxrss está en KB
+    return resource.getrusage(who).ru_maxrss * 1024
@@ -0,0 +1,277 @@
+"""
+Bloqueo por ciclo (initial_datetime) para la generación de imágenes.
+
+Un CycleLease es un bloqueo con caducidad: quien lo obtiene debe renovarlo (heartbeat)
+antes de que expire; si el proceso se cae, el bloqueo caduca solo y otra ejecución puede
+retomar el ciclo. Además se guarda qué variables del ciclo ya están completas, de modo que
+una ejecución interrumpida continúa por las que faltan.
+
+En producción se usa Redis (WRF_IMG_CYCLE_LOCK_URL, por defecto el broker de Celery);
+con 'memory://' el estado se guarda en el proceso, para tests o desarrollo sin Redis.
+"""
+import contextlib
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'wrf_img:cycle'
+
+# Tiempo que se conservan las marcas de variables completas
+DONE_MARKER_TTL = 7 * 24 * 3600
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class CycleLocked(Exception):
+    """El ciclo está bloqueado por otra ejecución"""
+
+
+class LeaseLost(Exception):
+    """El bloqueo caducó o lo tomó otra ejecución"""
+
+
+class LockUnavailable(Exception):
+    """No se puede acceder al backend de los bloqueos (Redis de WRF_IMG_CYCLE_LOCK_URL)"""
+
+
+class RedisLockBackend:
+    """Bloqueos y marcas en Redis (SET NX PX y scripts Lua para renovar y liberar)"""
+
+    # Sólo el dueño puede renovar o liberar el bloqueo
+    RENEW_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('pexpire', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+    RELEASE_SCRIPT = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self._renew = self.redis.register_script(self.RENEW_SCRIPT)
+        self._release = self.redis.register_script(self.RELEASE_SCRIPT)
+        self._connection_errors = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+    def acquire(self, key, owner, ttl):
+        with self._connection():
+            return bool(self.redis.set(key, owner, nx=True, px=int(ttl * 1000)))
+
+    def renew(self, key, owner, ttl):
+        with self._connection():
+            return bool(self._renew(keys=[key], args=[owner, int(ttl * 1000)]))
+
+    def release(self, key, owner):
+        with self._connection():
+            return bool(self._release(keys=[key], args=[owner]))
+
+    def get_owner(self, key):
+        with self._connection():
+            owner = self.redis.get(key)
+        return owner.decode() if owner is not None else None
+
+    def add_marker(self, key, member, ttl):
+        with self._connection():
+            pipeline = self.redis.pipeline()
+            pipeline.sadd(key, member)
+            pipeline.expire(key, int(ttl))
+            pipeline.execute()
+
+    def get_markers(self, key):
+        with self._connection():
+            return {member.decode() for member in self.redis.smembers(key)}
+
+    def clear_markers(self, key):
+        with self._connection():
+            self.redis.delete(key)
+
+    @contextlib.contextmanager
+    def _connection(self):
+        # Los errores de conexión se lanzan como LockUnavailable: quien llama no necesita importar redis
+        try:
+            yield
+        except self._connection_errors as e:
+            raise LockUnavailable(f"No se puede conectar con el Redis de WRF_IMG_CYCLE_LOCK_URL: {str(e)}") from e
+
+
+class MemoryLockBackend:
+    """Bloqueos y marcas en memoria del proceso (tests y desarrollo)"""
+
+    def __init__(self):
+        self._locks = {}
+        self._markers = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, owner, ttl):
+        with self._lock:
+            if self._get_owner(key) is not None:
+                return False
+            self._locks[key] = (owner, time.monotonic() + ttl)
+            return True
+
+    def renew(self, key, owner, ttl):
+        with self._lock:
+            if self._get_owner(key) != owner:
+                return False
+            self._locks[key] = (owner, time.monotonic() + ttl)
+            return True
+
+    def release(self, key, owner):
+        with self._lock:
+            if self._get_owner(key) != owner:
+                return False
+            del self._locks[key]
+            return True
+
+    def get_owner(self, key):
+        with self._lock:
+            return self._get_owner(key)
+
+    def add_marker(self, key, member, ttl):
+        with self._lock:
+            self._markers.setdefault(key, set()).add(member)
+
+    def get_markers(self, key):
+        with self._lock:
+            return set(self._markers.get(key, ()))
+
+    def clear_markers(self, key):
+        with self._lock:
+            self._markers.pop(key, None)
+
+    def _get_owner(self, key):
+        owner, expires_at = self._locks.get(key, (None, 0))
+        if owner is not None and expires_at <= time.monotonic():
+            del self._locks[key]
+            return None
+        return owner
+
+
+class CycleLease:
+    """
+    Bloqueo con caducidad de un ciclo.
+
+    El dueño se identifica con un token (owner) que puede pasarse a otras tareas para que
+    renueven el mismo bloqueo con heartbeat():
+
+        lease = CycleLease('2026020400')
+        if lease.acquire():
+            ...
+            CycleLease('2026020400', owner=lease.owner).heartbeat()
+
+    Como gestor de contexto obtiene el bloqueo (o lanza CycleLocked), lo renueva en un hilo
+    mientras dura el bloque y lo libera al salir.
+    """
+
+    def __init__(self, datetime_init, owner=None, ttl=None, backend=None):
+        self.datetime_init = datetime_init
+        self.owner = owner or uuid.uuid4().hex
+        self.ttl = ttl or getattr(settings, 'WRF_IMG_CYCLE_LOCK_TTL', 900)
+        self.backend = backend or get_lock_backend()
+        self.key = f'{KEY_PREFIX}:{datetime_init}:lock'
+        self.lost = False
+        self._stop = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise CycleLocked(f"El ciclo {self.datetime_init} está en proceso en otra ejecución")
+        self.start_heartbeat()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_heartbeat()
+        try:
+            self.release()
+        except LockUnavailable as e:
+            # El trabajo ya terminó: el bloqueo caduca solo al cumplir su ttl
+            logger.warning(f"No se pudo liberar el bloqueo del ciclo {self.datetime_init}: {str(e)}")
+
+    def acquire(self):
+        return self.backend.acquire(self.key, self.owner, self.ttl)
+
+    def heartbeat(self):
+        """Renueva el bloqueo; lanza LeaseLost si ya no pertenece a este dueño"""
+        if self.lost or not self.backend.renew(self.key, self.owner, self.ttl):
+            self.lost = True
+            raise LeaseLost(f"Se perdió el bloqueo del ciclo {self.datetime_init}")
+
+    def check(self):
+        """Lanza LeaseLost si el hilo de heartbeat detectó que se perdió el bloqueo"""
+        if self.lost:
+            raise LeaseLost(f"Se perdió el bloqueo del ciclo {self.datetime_init}")
+
+    def release(self):
+        return self.backend.release(self.key, self.owner)
+
+    def start_heartbeat(self, interval=None):
+        """Renueva el bloqueo en un hilo cada ttl/3 segundos hasta stop_heartbeat()"""
+        interval = interval or self.ttl / 3
+        self._stop = threading.Event()
+
+        def run(stop):
+            while not stop.wait(interval):
+                try:
+                    self.heartbeat()
+                except LeaseLost as e:
+                    logger.error(str(e))
+                    return
+                except Exception as e:
+                    # Error transitorio (por ejemplo de conexión): se reintenta en el siguiente intervalo
+                    logger.warning(f"No se pudo renovar el bloqueo del ciclo {self.datetime_init}: {str(e)}")
+
+        threading.Thread(target=run, args=(self._stop,), daemon=True).start()
+
+    def stop_heartbeat(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+def mark_variable_done(datetime_init, var_name):
+    """Marca una variable del ciclo como completa"""
+    get_lock_backend().add_marker(_get_done_key(datetime_init), var_name, DONE_MARKER_TTL)
+
+
+def get_done_variables(datetime_init):
+    """Variables del ciclo marcadas como completas"""
+    return get_lock_backend().get_markers(_get_done_key(datetime_init))
+
+
+def clear_done_variables(datetime_init):
+    get_lock_backend().clear_markers(_get_done_key(datetime_init))
+
+
+def _get_done_key(datetime_init):
+    return f'{KEY_PREFIX}:{datetime_init}:done'
+
+
+def get_lock_backend():
+    """Backend compartido del proceso según WRF_IMG_CYCLE_LOCK_URL"""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            url = getattr(settings, 'WRF_IMG_CYCLE_LOCK_URL', 'memory://')
+            if url.startswith('memory://'):
+                _backend = MemoryLockBackend()
+            else:
+                _backend = RedisLockBackend(url)
+        return _backend
+
+
+def reset_lock_backend():
+    """Descarta el backend compartido (por ejemplo al cambiar la configuración)"""
+    global _backend
+    with _backend_lock:
+        _backend = None
@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+
+# Directorios temporales de escrituras interrumpidas que se eliminan al limpiar la caché
+STALE_TMP_SECONDS = 24 * 3600
+
+# Sólo se guardan en caché claves con caracteres seguros para usarse como nombre de directorio
+_SAFE_KEY = re.compile(r'^\w+$')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class FieldCache:
+    """
+    Caché en disco de los campos descargados de la API del modelo.
+
+    Cada variable de un ciclo (datetime_init, var_name) se guarda en un directorio con un
+    .npy por array y un meta.json con los tiempos. Al leerse, los arrays se abren con
+    memory-mapping, así que volver a renderizar sólo cuesta CPU. El tamaño total está
+    limitado: al superarse se eliminan las entradas usadas hace más tiempo (LRU).
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def get(self, datetime_init, var_name):
+        """Retorna el payload guardado (arrays en memory-mapping) o None si no está en caché"""
+        path = self._get_entry_path(datetime_init, var_name)
+        if path is None:
+            return None
+
+        try:
+            with open(os.path.join(path, META_FILE)) as fh:
+                meta = json.load(fh)
+            payload = {'times': meta['times']}
+            for name in meta['arrays']:
+                payload[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+            # La fecha de modificación de meta.json marca el último uso (orden LRU)
+            os.utime(os.path.join(path, META_FILE))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Entrada de caché corrupta en {path}: {str(e)}")
+            self.delete(datetime_init, var_name)
+            return None
+
+        return payload
+
+    def put(self, datetime_init, var_name, payload):
+        """Guarda un payload completo (arrays var, U10, V10 ya reunidos)"""
+        writer = self.writer(datetime_init, var_name, payload['lats'], payload['longs'], payload['times'])
+        if writer is None:
+            return
+        try:
+            for name in ('var', 'U10', 'V10'):
+                if name in payload:
+                    writer.write_array(name, payload[name])
+        except Exception:
+            writer.abort()
+            raise
+        writer.commit()
+
+    def writer(self, datetime_init, var_name, lats, longs, times):
+        """
+        Retorna un FieldCacheWriter para guardar la variable fotograma a fotograma
+        (respuestas en streaming), o None si la clave no se puede guardar.
+        """
+        path = self._get_entry_path(datetime_init, var_name)
+        if path is None:
+            return None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.directory)
+        except OSError as e:
+            logger.warning(f"No se pudo escribir en la caché de campos: {str(e)}")
+            return None
+        return FieldCacheWriter(self, path, tmp_dir, lats, longs, times)
+
+    def delete(self, datetime_init, var_name):
+        path = self._get_entry_path(datetime_init, var_name)
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def evict(self):
+        """Elimina las entradas menos usadas hasta que la caché quepa en max_bytes"""
+        with self._lock:
+            entries = []
+            total = 0
+            try:
+                names = os.listdir(self.directory)
+            except FileNotFoundError:
+                return
+
+            for name in names:
+                path = os.path.join(self.directory, name)
+                if not os.path.isdir(path):
+                    continue
+                if name.startswith('.tmp_'):
+                    self._remove_stale(path)
+                    continue
+                try:
+                    last_used = os.path.getmtime(os.path.join(path, META_FILE))
+                    size = sum(entry.stat().st_size for entry in os.scandir(path))
+                except OSError:
+                    continue
+                entries.append((last_used, size, path))
+                total += size
+
+            entries.sort()
+            while entries and total > self.max_bytes:
+                _, size, path = entries.pop(0)
+                logger.info(f"Eliminando de la caché de campos: {os.path.basename(path)}")
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+
+    def _remove_stale(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > STALE_TMP_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+    def _get_entry_path(self, datetime_init, var_name):
+        datetime_init = str(datetime_init)
+        if not (_SAFE_KEY.match(datetime_init) and _SAFE_KEY.match(var_name)):
+            return None
+        return os.path.join(self.directory, f'{datetime_init}_{var_name}')
+
+
+class FieldCacheWriter:
+    """
+    Escritura de una entrada de la caché en un directorio temporal que se publica al
+    llamar a commit(). Si la descarga se interrumpe, abort() descarta lo escrito.
+    """
+
+    def __init__(self, cache, path, tmp_dir, lats, longs, times):
+        self.cache = cache
+        self.path = path
+        self.tmp_dir = tmp_dir
+        self.times = list(times)
+        self.arrays = []
+        self._memmaps = {}
+        self._written = {}
+        self.write_array('lats', lats)
+        self.write_array('longs', longs)
+
+    def write_array(self, name, array):
+        np.save(os.path.join(self.tmp_dir, f'{name}.npy'), np.asarray(array))
+        self.arrays.append(name)
+
+    def write_frame(self, name, index, frame):
+        """Escribe un fotograma 2D del array 3D name (tiempo, y, x)"""
+        memmap = self._memmaps.get(name)
+        if memmap is None:
+            memmap = np.lib.format.open_memmap(
+                os.path.join(self.tmp_dir, f'{name}.npy'), mode='w+',
+                dtype=frame.dtype, shape=(len(self.times),) + frame.shape,
+            )
+            self._memmaps[name] = memmap
+            self._written[name] = set()
+            self.arrays.append(name)
+        memmap[index] = frame
+        self._written[name].add(index)
+
+    def commit(self):
+        # Una respuesta incompleta no se guarda (los tiempos que faltan quedarían a cero)
+        if any(len(indexes) != len(self.times) for indexes in self._written.values()):
+            logger.warning(f"Datos incompletos, no se guardan en caché: {os.path.basename(self.path)}")
+            self.abort()
+            return
+
+        try:
+            for memmap in self._memmaps.values():
+                memmap.flush()
+            self._memmaps = {}
+            with open(os.path.join(self.tmp_dir, META_FILE), 'w') as fh:
+                json.dump({'times': self.times, 'arrays': self.arrays, 'created': time.time()}, fh)
+
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.replace(self.tmp_dir, self.path)
+        except OSError as e:
+            logger.warning(f"No se pudo guardar {os.path.basename(self.path)} en la caché de campos: {str(e)}")
+            self.abort()
+            return
+        self.cache.evict()
+
+    def abort(self):
+        self._memmaps = {}
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def get_field_cache():
+    """Caché de campos configurada en settings (None si está desactivada)"""
+    global _cache
+    max_mb = getattr(settings, 'WRF_IMG_FIELD_CACHE_MAX_MB', 0)
+    if not max_mb:
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            directory = getattr(settings, 'WRF_IMG_FIELD_CACHE_DIR', None) or os.path.join(
+                settings.MEDIA_ROOT, 'cache', 'fields'
+            )
+            _cache = FieldCache(directory, max_mb * 1024 * 1024)
+        return _cache
+
+
+def reset_field_cache():
+    """Descarta la caché compartida (por ejemplo al cambiar la configuración)"""
+    global _cache
+    with _cache_lock:
+        _cache = None
@@ -0,0 +1,191 @@
+"""
+Estadísticas de los fotogramas de una variable.
+
+Además de data_min/data_max/data_mean, cada MeteoImage guarda la desviación típica, el número
+de celdas sin dato (NaN), percentiles, el área por encima de umbrales (STAT_THRESHOLDS, por
+ejemplo RAINC > 20 mm o ws10 con temporal) y el histograma sobre los niveles de PLOT_CONFIGS,
+de modo que los paneles no necesitan abrir las imágenes ni volver a descargar los campos.
+
+Las estadísticas de varios fotogramas se calculan juntas sobre un array (fotogramas, celdas):
+una única partición por fila da mínimo, máximo y percentiles, un digitize con bincount da el
+histograma y las áreas, y las medias salen de dos sumas. Los valores están en las unidades
+de los datos (como data_min); los niveles y umbrales, en las de las imágenes.
+"""
+import threading
+
+import numpy as np
+
+from .plot_config import get_plot_config
+from .render_engine import grid_signature
+
+EARTH_RADIUS_KM = 6371.0
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Umbrales del área por encima (unidades de las imágenes). Viento: temporal, temporal fuerte
+# y huracán en la escala Beaufort (8, 10 y 12)
+STAT_THRESHOLDS = {
+    'RAINC': (20, 50, 100),
+    'RAINC3H': (10, 20, 50),
+    'ws10': (62, 89, 118),
+    'T2': (32, 35),
+}
+
+# Fotogramas que se reúnen para calcular sus estadísticas juntos (ver FrameStatsBatch)
+STATS_BATCH_FRAMES = 8
+
+# Áreas de las celdas por malla: {firma de la malla: array (ny, nx) en km²}
+MAX_CACHED_GRIDS = 4
+
+_AREA_CACHE = {}
+_area_lock = threading.Lock()
+
+
+def get_cell_areas(lats, longs):
+    """Área aproximada de cada celda de la malla en km² (calculada una vez por malla)"""
+    signature = grid_signature(lats, longs)
+    with _area_lock:
+        areas = _AREA_CACHE.get(signature)
+    if areas is None:
+        lats = np.asarray(lats, dtype=float)
+        longs = np.asarray(longs, dtype=float)
+        dlat_dj, dlat_di = np.gradient(lats)
+        dlon_dj, dlon_di = np.gradient(longs)
+        # Determinante del jacobiano de (lon, lat) respecto a (i, j), en km² por celda
+        degree_km = np.radians(1.0) * EARTH_RADIUS_KM
+        areas = np.abs(dlon_di * dlat_dj - dlon_dj * dlat_di) * np.cos(np.radians(lats)) * degree_km ** 2
+        with _area_lock:
+            if len(_AREA_CACHE) >= MAX_CACHED_GRIDS:
+                _AREA_CACHE.pop(next(iter(_AREA_CACHE)))
+            _AREA_CACHE[signature] = areas
+    return areas
+
+
+def get_stat_bins(var_name):
+    """Niveles del histograma y umbrales de una variable en las unidades de las imágenes"""
+    plot_config = get_plot_config(var_name)
+    levels = plot_config.get('levels')
+    if not isinstance(levels, (list, tuple, np.ndarray)):
+        # Sin niveles fijos (número de niveles de matplotlib) no hay histograma
+        levels = []
+    return [float(level) for level in levels], [float(t) for t in STAT_THRESHOLDS.get(var_name, ())]
+
+
+def compute_field_stats(var_name, fields, cell_areas=None):
+    """
+    Estadísticas de los fotogramas de fields (array (fotogramas, ny, nx)): una lista con
+    los valores de los campos de MeteoImage de cada fotograma (data_min, data_max,
+    data_mean, data_std, nan_count y field_stats). Sin cell_areas no se calculan las áreas.
+    """
+    fields = np.asarray(fields)
+    values = fields.reshape(len(fields), -1)
+    frames, cells = values.shape
+    finite = np.isfinite(values)
+    valid = finite.sum(axis=1)
+    rows = np.arange(frames)
+
+    # Extremos y percentiles (interpolación lineal, como np.percentile) de una sola partición
+    # por fotograma en las posiciones que hacen falta; los NaN quedan al final
+    last = np.maximum(valid - 1, 0)
+    positions = np.outer(last, np.asarray(PERCENTILES, dtype=float) / 100)
+    below = np.floor(positions).astype(int)
+    fraction = positions - below
+    kth = np.unique(np.concatenate([[0], last, below.ravel(), np.minimum(below + 1, last[:, None]).ravel()]))
+    ordered = np.partition(np.where(finite, values, np.nan), kth, axis=1)
+    data_min = ordered[:, 0]
+    data_max = ordered[rows, last]
+    lower = np.take_along_axis(ordered, below, axis=1)
+    upper = np.take_along_axis(ordered, np.minimum(below + 1, last[:, None]), axis=1)
+    percentiles = lower + (upper - lower) * fraction
+
+    filled = np.where(finite, values, 0).astype(float)
+    count = np.maximum(valid, 1)
+    data_mean = filled.sum(axis=1) / count
+    data_std = np.sqrt(np.maximum((filled ** 2).sum(axis=1) / count - data_mean ** 2, 0))
+
+    # Histograma y áreas: el intervalo de cada celda en un solo digitize por lista de límites
+    scale_factor = get_plot_config(var_name).get('scale_factor', 1)
+    levels, thresholds = get_stat_bins(var_name)
+    histogram = _bin_counts(values, finite, np.asarray(levels) / scale_factor)
+    areas = None
+    if thresholds and cell_areas is not None:
+        weights = np.broadcast_to(np.asarray(cell_areas, dtype=float).ravel(), values.shape)
+        # Celdas estrictamente por encima de cada umbral: suma acumulada desde el último intervalo
+        binned = _bin_counts(values, finite, np.asarray(thresholds) / scale_factor, weights, right=True)
+        areas = binned[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+
+    stats = []
+    for k in range(frames):
+        empty = valid[k] == 0
+        field_stats = {
+            'percentiles': {f'p{p}': _value(percentiles[k, n], empty) for n, p in enumerate(PERCENTILES)},
+        }
+        if levels:
+            field_stats['histogram'] = {'levels': levels, 'counts': histogram[k].astype(int).tolist()}
+        if areas is not None:
+            field_stats['areas_km2'] = {
+                f'{threshold:g}': round(float(areas[k, n]), 1) for n, threshold in enumerate(thresholds)
+            }
+        stats.append({
+            'data_min': _value(data_min[k], empty),
+            'data_max': _value(data_max[k], empty),
+            'data_mean': _value(data_mean[k], empty),
+            'data_std': _value(data_std[k], empty),
+            'nan_count': int(cells - valid[k]),
+            'field_stats': field_stats,
+        })
+    return stats
+
+
+def _bin_counts(values, finite, edges, weights=None, right=False):
+    # Conteos (o suma de weights) de cada fotograma en los intervalos de edges, incluidos los
+    # de los extremos: array (fotogramas, len(edges) + 1)
+    frames = values.shape[0]
+    bins = len(edges) + 1
+    if len(edges) == 0:
+        return np.zeros((frames, 0))
+    index = np.digitize(values, edges, right=right) + np.arange(frames)[:, None] * bins
+    counts = np.bincount(
+        index[finite], weights=None if weights is None else weights[finite], minlength=frames * bins
+    )
+    return counts.reshape(frames, bins)
+
+
+def _value(value, empty):
+    return None if empty or not np.isfinite(value) else float(value)
+
+
+class FrameStatsBatch:
+    """
+    Reúne los fotogramas de una variable a medida que llegan y calcula sus estadísticas
+    juntas cada batch_size fotogramas (sin conservar el array 3D completo)
+    """
+
+    def __init__(self, var_name, lats, longs, batch_size=STATS_BATCH_FRAMES):
+        self.var_name = var_name
+        self.cell_areas = get_cell_areas(lats, longs)
+        self.batch_size = batch_size
+        self.stats = {}
+        self._indexes = []
+        self._frames = None
+
+    def add(self, index, frame):
+        if self._frames is None:
+            self._frames = np.empty((self.batch_size,) + frame.shape, dtype=frame.dtype)
+        self._frames[len(self._indexes)] = frame
+        self._indexes.append(index)
+        if len(self._indexes) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._indexes:
+            return
+        stats = compute_field_stats(self.var_name, self._frames[:len(self._indexes)], self.cell_areas)
+        self.stats.update(zip(self._indexes, stats))
+        self._indexes = []
+
+    def pop(self, index):
+        """Estadísticas de un fotograma (calcula las pendientes si hace falta)"""
+        if index not in self.stats:
+            self.flush()
+        return self.stats.pop(index)
@@ -0,0 +1,325 @@
+"""
+Almacén de los campos de cada simulación.
+
+Las imágenes sólo conservan estadísticas de cada fotograma (ver field_stats). Con
+WRF_IMG_FIELD_STORE_FORMAT los campos de cada variable se guardan además con xarray en
+meteo_fields/[datetime simulacion]/[nombre variable].nc (o .zarr): un array (time, y, x) por
+campo (la variable y, en las de viento, U10 y V10) con las latitudes y longitudes de la malla
+como coordenadas, fragmentado por tiempo para que leer un fotograma no lea el resto. El
+directorio queda en Simulation.field_store; volver a renderizar, extraer puntos o calcular
+estadísticas puede leer los campos sin descargarlos de nuevo (ver load_field_payload).
+
+NetCDF se escribe comprimido (zlib) con netCDF4 o h5netcdf si están instalados. Sólo con scipy
+se escribe NetCDF3, sin compresión, con el tiempo como dimensión de registro (cada tiempo es
+contiguo en el fichero) y se lee con memory-mapping. Zarr usa el compresor por defecto de zarr.
+"""
+import contextlib
+import importlib.util
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from wrf_img.models import Simulation
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+FIELD_STORE_DIR = 'meteo_fields'
+
+# Extensión de cada formato
+STORE_FORMATS = {'netcdf': 'nc', 'zarr': 'zarr'}
+
+# Motores de xarray para NetCDF por orden de preferencia (módulos que necesita cada uno; desde
+# h5netcdf 1.8 h5py es opcional)
+NETCDF_ENGINES = (('netcdf4', ('netCDF4',)), ('h5netcdf', ('h5netcdf', 'h5py')), ('scipy', ('scipy',)))
+
+# Formato de los tiempos válidos, el mismo de la API del modelo
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+_unavailable_warned = set()
+
+
+def get_field_store_format():
+    """Formato de WRF_IMG_FIELD_STORE_FORMAT ('netcdf' o 'zarr') o None si no se guardan los campos"""
+    store_format = str(getattr(settings, 'WRF_IMG_FIELD_STORE_FORMAT', '')).strip().lower()
+    if not store_format:
+        return None
+    if store_format not in STORE_FORMATS:
+        raise ValueError(f"Formato de almacén de campos no soportado: {store_format}")
+    if store_format == 'zarr' and importlib.util.find_spec('zarr') is None:
+        _warn_once('zarr', "No está instalado zarr; los campos se guardan en NetCDF")
+        store_format = 'netcdf'
+    return store_format
+
+
+def get_netcdf_engine():
+    """Primer motor de NetCDF disponible (h5netcdf, dependencia del proyecto, comprime con zlib)"""
+    for engine, modules in NETCDF_ENGINES:
+        if all(importlib.util.find_spec(module) is not None for module in modules):
+            return engine
+    raise RuntimeError("No hay ningún motor de xarray para escribir NetCDF")
+
+
+def get_field_store_dir(simulation):
+    """Directorio de los campos de una simulación: meteo_fields/[datetime simulacion]"""
+    return '/'.join([FIELD_STORE_DIR, simulation.initial_datetime.strftime("%Y%m%d_%H%M%S")])
+
+
+def get_field_store_path(simulation, var_name):
+    """Ruta del almacén de una variable o None si no se guardaron sus campos"""
+    if not simulation.field_store:
+        return None
+    for extension in STORE_FORMATS.values():
+        path = default_storage.path(f"{simulation.field_store}/{var_name}.{extension}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class FieldStoreWriter:
+    """
+    Escritura del almacén de una variable. Los fotogramas se reúnen a medida que llegan en
+    arrays con memory-mapping de un directorio temporal (como FieldCacheWriter) y commit()
+    escribe el almacén y reemplaza el anterior. abort() descarta lo escrito.
+    """
+
+    def __init__(self, simulation, var_name, lats, longs, times, store_format):
+        self.simulation = simulation
+        self.var_name = var_name
+        self.lats = np.asarray(lats)
+        self.longs = np.asarray(longs)
+        self.times = list(times)
+        self.store_format = store_format
+        self.store_dir = get_field_store_dir(simulation)
+        directory = default_storage.path(self.store_dir)
+        os.makedirs(directory, exist_ok=True)
+        # En el mismo directorio, para publicar el almacén con un rename
+        self.tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=directory)
+        self._memmaps = {}
+        self._written = {}
+
+    def write_frame(self, name, index, frame):
+        """Escribe un fotograma 2D del campo name ('var', 'U10' o 'V10')"""
+        memmap = self._memmaps.get(name)
+        if memmap is None:
+            memmap = np.lib.format.open_memmap(
+                os.path.join(self.tmp_dir, f'{name}.npy'), mode='w+',
+                dtype=frame.dtype, shape=(len(self.times),) + frame.shape,
+            )
+            self._memmaps[name] = memmap
+            self._written[name] = set()
+        memmap[index] = frame
+        self._written[name].add(index)
+
+    def write_frames(self, frames):
+        """Guarda los fotogramas (índice, var, u, v) a medida que se consumen"""
+        for i, var_frame, u_frame, v_frame in frames:
+            with span('storage'):
+                self.write_frame('var', i, var_frame)
+                if u_frame is not None and v_frame is not None:
+                    self.write_frame('U10', i, u_frame)
+                    self.write_frame('V10', i, v_frame)
+            yield i, var_frame, u_frame, v_frame
+
+    def commit(self):
+        """Escribe el almacén y retorna su ruta, o None si faltan fotogramas o falla la escritura"""
+        if not self._written or any(len(indexes) != len(self.times) for indexes in self._written.values()):
+            logger.warning(f"Campos incompletos de {self.var_name}, no se guardan")
+            self.abort()
+            return None
+
+        extension = STORE_FORMATS[self.store_format]
+        path = default_storage.path(f"{self.store_dir}/{self.var_name}.{extension}")
+        try:
+            with span('storage'):
+                tmp_path = os.path.join(self.tmp_dir, os.path.basename(path))
+                self._write(tmp_path)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.replace(tmp_path, path)
+                # El almacén en el otro formato, si lo había, queda obsoleto
+                for other in STORE_FORMATS.values():
+                    if other != extension:
+                        _remove(default_storage.path(f"{self.store_dir}/{self.var_name}.{other}"))
+        except Exception as e:
+            logger.error(f"No se pudieron guardar los campos de {self.var_name}: {str(e)}")
+            return None
+        finally:
+            self.abort()
+
+        if self.simulation.field_store != self.store_dir:
+            with span('db'):
+                Simulation.objects.filter(pk=self.simulation.pk).update(field_store=self.store_dir)
+            self.simulation.field_store = self.store_dir
+        self._index_grid()
+        self._aggregate_regions()
+        return path
+
+    def abort(self):
+        self._memmaps = {}
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _index_grid(self):
+        # Posición de las estaciones y municipios en la malla, si es nueva (ver grid_index)
+        from .grid_index import ensure_grid_point_index
+
+        try:
+            ensure_grid_point_index(self.lats, self.longs)
+        except Exception as e:
+            logger.error(f"Error calculando el índice de la malla: {str(e)}")
+
+    def _aggregate_regions(self):
+        # Media, máximo y suma por municipio y provincia (ver regions)
+        from .regions import update_region_aggregates
+
+        try:
+            update_region_aggregates(self.simulation, self.var_name)
+        except Exception as e:
+            logger.error(f"Error calculando los agregados por región de {self.var_name}: {str(e)}")
+
+    def _write(self, path):
+        from .plot_generators import parse_valid_datetime
+
+        names = {'var': self.var_name, 'U10': 'U10', 'V10': 'V10'}
+        dataset = xr.Dataset(
+            {names[name]: (('time', 'y', 'x'), memmap) for name, memmap in self._memmaps.items()},
+            coords={
+                'time': pd.DatetimeIndex([parse_valid_datetime(t).replace(tzinfo=None) for t in self.times]),
+                'lat': (('y', 'x'), self.lats, {'units': 'degrees_north'}),
+                'lon': (('y', 'x'), self.longs, {'units': 'degrees_east'}),
+            },
+            attrs={
+                'variable': self.var_name,
+                'initial_datetime': self.simulation.initial_datetime.strftime(TIME_FORMAT),
+            },
+        )
+        # Un fragmento por tiempo
+        chunks = (1,) + self.lats.shape
+        if self.store_format == 'zarr':
+            encoding = {name: {'chunks': chunks} for name in dataset.data_vars}
+            dataset.to_zarr(path, mode='w', encoding=encoding)
+            return
+
+        engine = get_netcdf_engine()
+        if engine == 'scipy':
+            _warn_once('scipy', "Sin netCDF4 ni h5netcdf los campos se guardan en NetCDF3 sin comprimir")
+            dataset.to_netcdf(path, engine=engine, unlimited_dims=['time'])
+            return
+        complevel = int(getattr(settings, 'WRF_IMG_FIELD_STORE_COMPLEVEL', 4))
+        encoding = {
+            name: {'zlib': True, 'complevel': complevel, 'shuffle': True, 'chunksizes': chunks}
+            for name in dataset.data_vars
+        }
+        dataset.to_netcdf(path, engine=engine, encoding=encoding)
+
+
+def get_field_store_writer(simulation, var_name, lats, longs, times):
+    """FieldStoreWriter de una variable o None si no se guardan los campos"""
+    store_format = get_field_store_format()
+    if store_format is None:
+        return None
+    return FieldStoreWriter(simulation, var_name, lats, longs, times, store_format)
+
+
+def write_field_store(simulation, var_name, payload):
+    """Guarda los campos de un payload completo (arrays var, U10 y V10 ya reunidos)"""
+    from .model_api import iter_payload_frames
+
+    writer = get_field_store_writer(simulation, var_name, payload['lats'], payload['longs'], payload['times'])
+    if writer is None:
+        return None
+    try:
+        for _ in writer.write_frames(iter_payload_frames(payload)):
+            pass
+    except Exception:
+        writer.abort()
+        raise
+    return writer.commit()
+
+
+def open_field_store(simulation, var_name):
+    """Dataset de xarray con los campos de una variable (lectura perezosa) o None si no se guardaron"""
+    path = get_field_store_path(simulation, var_name)
+    if path is None:
+        return None
+    if path.endswith('.zarr'):
+        return xr.open_dataset(path, engine='zarr', chunks=None, cache=False)
+    return xr.open_dataset(path, cache=False)
+
+
+def load_field_grid(simulation):
+    """Latitudes y longitudes de la malla de los campos guardados de una simulación, o None"""
+    if not simulation.field_store:
+        return None
+    try:
+        names = sorted(os.listdir(default_storage.path(simulation.field_store)))
+    except FileNotFoundError:
+        return None
+    for name in names:
+        var_name, extension = os.path.splitext(name)
+        if extension[1:] in STORE_FORMATS.values():
+            with open_field_store(simulation, var_name) as dataset:
+                return dataset['lat'].values, dataset['lon'].values
+    return None
+
+
+class FieldFrames:
+    """Fotogramas de un campo del almacén: cada índice lee sólo ese tiempo"""
+
+    def __init__(self, data_array):
+        self.data_array = data_array
+
+    def __len__(self):
+        return self.data_array.shape[0]
+
+    def __getitem__(self, index):
+        return self.data_array[index].values
+
+    @property
+    def shape(self):
+        return self.data_array.shape
+
+
+@contextlib.contextmanager
+def load_field_payload(simulation, var_name):
+    """
+    Payload con los campos guardados de una variable, con las mismas claves que
+    ModelDataClient.fetch_variable (los fotogramas se leen al acceder a cada uno), o None
+    si no se guardaron. Sirve como data de MeteoPlotJob para volver a renderizar sin la API.
+    Se usa con with: el almacén se cierra al salir del bloque.
+    """
+    dataset = open_field_store(simulation, var_name)
+    if dataset is None:
+        yield None
+        return
+    with dataset:
+        payload = {
+            'lats': dataset['lat'].values,
+            'longs': dataset['lon'].values,
+            'times': [t.strftime(TIME_FORMAT) for t in pd.DatetimeIndex(dataset['time'].values)],
+            'var': FieldFrames(dataset[var_name]),
+        }
+        for name in ('U10', 'V10'):
+            if name != var_name and name in dataset.data_vars:
+                payload[name] = FieldFrames(dataset[name])
+        yield payload
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _warn_once(key, message):
+    if key not in _unavailable_warned:
+        _unavailable_warned.add(key)
+        logger.warning(message)
@@ -0,0 +1,59 @@
+import threading
+
+import cartopy.crs as ccrs
+import numpy as np
+
+from .render_engine import grid_signature
+
+# Sistema de coordenadas de las mallas de la API (longitud/latitud)
+DATA_CRS = ccrs.PlateCarree()
+
+# Geometrías por malla (todas las variables y tiempos de un ciclo comparten la malla)
+MAX_CACHED_GRIDS = 4
+
+# Geometrías en memoria: {(firma de la malla, proyección): GridGeometry}
+_GEOMETRY_CACHE = {}
+_geometry_lock = threading.Lock()
+
+
+class GridGeometry:
+    """
+    Malla del modelo proyectada una sola vez a las coordenadas del mapa.
+
+    Los contornos se calculan directamente sobre x/y con transform=ax.transData, de modo
+    que Cartopy no vuelve a proyectar los polígonos de cada contourf al calcular los
+    límites y al dibujar. Con la misma proyección el resultado es idéntico píxel a píxel.
+    """
+
+    def __init__(self, lats, longs, projection):
+        self.signature = grid_signature(lats, longs)
+        self.lats = lats
+        self.longs = longs
+        points = projection.transform_points(DATA_CRS, np.asarray(longs, dtype=float), np.asarray(lats, dtype=float))
+        self.x = np.ascontiguousarray(points[..., 0])
+        self.y = np.ascontiguousarray(points[..., 1])
+        self._subsamples = {}
+
+    def subsample(self, step):
+        """Retorna (longs, lats) cada step puntos (posiciones de las barbas de viento)"""
+        points = self._subsamples.get(step)
+        if points is None:
+            points = (
+                np.ascontiguousarray(self.longs[::step, ::step]),
+                np.ascontiguousarray(self.lats[::step, ::step]),
+            )
+            self._subsamples[step] = points
+        return points
+
+
+def get_grid_geometry(lats, longs, projection=DATA_CRS):
+    """Retorna la GridGeometry de una malla, calculándola la primera vez"""
+    key = (grid_signature(lats, longs), projection)
+    with _geometry_lock:
+        geometry = _GEOMETRY_CACHE.get(key)
+        if geometry is None:
+            geometry = GridGeometry(lats, longs, projection)
+            if len(_GEOMETRY_CACHE) >= MAX_CACHED_GRIDS:
+                _GEOMETRY_CACHE.pop(next(iter(_GEOMETRY_CACHE)))
+            _GEOMETRY_CACHE[key] = geometry
+        return geometry
@@ -0,0 +1,95 @@
+"""
+Índice de las estaciones y municipios en la malla del modelo.
+
+La verificación y los productos en puntos necesitan la posición en la malla de cada Station
+y Town. Se calcula una vez por malla con su KD-tree (ver get_grid_locator) y se guarda en
+GridPointIndex, de modo que ubicar un punto es una consulta por (firma de la malla,
+estación). El índice de una malla se construye la primera vez que se guardan sus campos (ver
+FieldStoreWriter.commit) y add_stations_data lo reconstruye para la malla más reciente (ver
+refresh_grid_point_indexes). Los puntos fuera del dominio no tienen fila.
+"""
+import logging
+
+import numpy as np
+from django.db import transaction
+
+from station_data.models import Station, Town
+from wrf_img.models import GridPointIndex, Simulation
+from .field_store import load_field_grid
+from .point_forecast import PointLocation, get_grid_locator
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+
+def build_grid_point_index(lats, longs):
+    """Reconstruye el índice de todas las estaciones y municipios en una malla; retorna las filas"""
+    locator = get_grid_locator(lats, longs)
+    rows = []
+    for field, places in (('station', Station.objects.all()), ('town', Town.objects.all())):
+        for place in places:
+            try:
+                location = locator.locate(place.latitude, place.longitude, 'bilinear')
+            except ValueError:
+                # Fuera del dominio
+                continue
+            j, i = location.nearest
+            rows.append(GridPointIndex(
+                grid_signature=locator.signature,
+                latitude=place.latitude,
+                longitude=place.longitude,
+                nearest_row=j,
+                nearest_column=i,
+                distance_km=float(location.distance_km),
+                row=location.rows.start,
+                column=location.columns.start,
+                weights=np.round(location.weights, 6).tolist(),
+                **{field: place},
+            ))
+
+    with span('db'), transaction.atomic():
+        GridPointIndex.objects.filter(grid_signature=locator.signature).delete()
+        GridPointIndex.objects.bulk_create(rows)
+    logger.info(f"Índice de la malla {locator.signature}: {len(rows)} estaciones y municipios")
+    return rows
+
+
+def ensure_grid_point_index(lats, longs):
+    """Construye el índice de una malla si todavía no existe"""
+    signature = get_grid_locator(lats, longs).signature
+    if not GridPointIndex.objects.filter(grid_signature=signature).exists():
+        build_grid_point_index(lats, longs)
+
+
+def refresh_grid_point_indexes():
+    """
+    Reconstruye el índice de la malla de la simulación más reciente con campos guardados
+    (por ejemplo al añadir o mover estaciones). Retorna las filas o None si no hay malla.
+    """
+    for simulation in Simulation.objects.exclude(field_store='').order_by('-initial_datetime'):
+        grid = load_field_grid(simulation)
+        if grid is not None:
+            return build_grid_point_index(*grid)
+    return None
+
+
+def get_point_index(grid_signature, station=None, town=None):
+    """GridPointIndex de una estación o un municipio en una malla, o None si no está indexado"""
+    if station is not None:
+        return GridPointIndex.objects.filter(grid_signature=grid_signature, station=station).first()
+    return GridPointIndex.objects.filter(grid_signature=grid_signature, town=town).first()
+
+
+def get_index_location(point_index, method='bilinear'):
+    """PointLocation de un GridPointIndex (sin volver a buscar en el KD-tree)"""
+    j, i = point_index.nearest_row, point_index.nearest_column
+    if method == 'nearest':
+        # Sólo la celda más cercana
+        return PointLocation(slice(j, j + 1), slice(i, i + 1), np.ones((1, 1)), (j, i), point_index.distance_km)
+    return PointLocation(
+        slice(point_index.row, point_index.row + 2),
+        slice(point_index.column, point_index.column + 2),
+        np.asarray(point_index.weights, dtype=float),
+        (j, i),
+        point_index.distance_km,
+    )
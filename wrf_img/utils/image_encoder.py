@@ -0,0 +1,123 @@
+"""
+Codificación de las imágenes renderizadas.
+
+La figura se dibuja a un buffer RGBA (ver render_rgba) y se escribe como PNG indexado con
+una paleta adaptativa: los mapas tienen pocos colores (rellenos de los contornos, mapa base
+y texto), así que el PNG de 8 bits ocupa varias veces menos que el RGBA de savefig.
+Opcionalmente se escriben también versiones WebP/AVIF, que se guardan junto al PNG
+(ver MeteoImage.image_webp/image_avif) y la API sirve según la cabecera Accept.
+"""
+import io
+import logging
+
+import numpy as np
+from django.conf import settings
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# Formatos en orden de preferencia de la API (ver get_preferred_format); el PNG siempre se genera
+IMAGE_FORMATS = ('avif', 'webp', 'png')
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+}
+
+_unavailable_warned = set()
+
+
+def get_png_colors():
+    """Colores de la paleta del PNG (0 = PNG RGBA sin cuantizar)"""
+    return min(256, max(0, int(getattr(settings, 'WRF_IMG_PNG_COLORS', 256))))
+
+
+def get_image_formats():
+    """Formatos a generar: PNG y los adicionales de WRF_IMG_IMAGE_FORMATS que Pillow soporte"""
+    formats = ['png']
+    for image_format in getattr(settings, 'WRF_IMG_IMAGE_FORMATS', '').split(','):
+        image_format = image_format.strip().lower()
+        if not image_format or image_format in formats:
+            continue
+        if image_format not in CONTENT_TYPES:
+            raise ValueError(f"Formato de imagen no soportado: {image_format}")
+        if not _is_available(image_format):
+            if image_format not in _unavailable_warned:
+                _unavailable_warned.add(image_format)
+                logger.warning(f"Pillow no soporta {image_format.upper()}; sólo se genera PNG")
+            continue
+        formats.append(image_format)
+    return formats
+
+
+def get_encoder_signature():
+    """Parámetros de codificación (forman parte del hash de cada imagen, ver get_render_key)"""
+    return repr((get_png_colors(), get_image_formats(), getattr(settings, 'WRF_IMG_IMAGE_QUALITY', 80)))
+
+
+def render_rgba(fig, **savefig_kwargs):
+    """
+    Dibuja la figura con savefig (mismo recorte y resolución que el PNG) y retorna el
+    buffer RGBA como array (alto, ancho, 4). El array apunta al buffer del canvas y sólo es
+    válido hasta el siguiente dibujo de la figura.
+    """
+    fig.savefig(io.BytesIO(), format='rgba', **savefig_kwargs)
+    # savefig deja en el canvas el renderer usado, con el tamaño ya recortado (bbox_inches)
+    return np.asarray(fig.canvas.buffer_rgba())
+
+
+def encode_image(rgba, formats=None):
+    """Codifica un buffer RGBA en los formatos indicados y retorna {formato: bytes}"""
+    if formats is None:
+        formats = get_image_formats()
+
+    # Las figuras son opacas: sin canal alfa la cuantización admite median cut, que conserva
+    # exactos los colores de los rellenos (octree los desplaza ligeramente)
+    image = Image.fromarray(np.ascontiguousarray(rgba))
+    if image.mode == 'RGBA' and rgba[..., 3].min() == 255:
+        image = image.convert('RGB')
+
+    quality = int(getattr(settings, 'WRF_IMG_IMAGE_QUALITY', 80))
+    images = {}
+    for image_format in formats:
+        buffer = io.BytesIO()
+        if image_format == 'png':
+            encode_png(image, buffer)
+        elif image_format == 'webp':
+            image.save(buffer, format='WEBP', quality=quality, method=4)
+        elif image_format == 'avif':
+            image.save(buffer, format='AVIF', quality=quality)
+        else:
+            raise ValueError(f"Formato de imagen no soportado: {image_format}")
+        images[image_format] = buffer.getvalue()
+    return images
+
+
+def encode_png(image, buffer):
+    colors = get_png_colors()
+    if colors:
+        method = Image.Quantize.MEDIANCUT if image.mode == 'RGB' else Image.Quantize.FASTOCTREE
+        image = image.quantize(colors, method=method, dither=Image.Dither.NONE)
+    image.save(buffer, format='PNG')
+
+
+def get_preferred_format(accept, available):
+    """
+    Formato a servir según la cabecera Accept entre los disponibles de una imagen: AVIF o
+    WebP si el cliente los acepta explícitamente y existen, si no PNG
+    """
+    accept = (accept or '').lower()
+    for image_format in IMAGE_FORMATS[:-1]:
+        if image_format in available and CONTENT_TYPES[image_format] in accept:
+            return image_format
+    return 'png'
+
+
+def _is_available(image_format):
+    if image_format == 'png':
+        return True
+    try:
+        return features.check(image_format)
+    except ValueError:
+        # Versiones de Pillow que no conocen el módulo (por ejemplo AVIF en las antiguas)
+        return False
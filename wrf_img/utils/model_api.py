@@ -0,0 +1,705 @@
+import io
+import itertools
+import json
+import logging
+import re
+import struct
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .field_cache import get_field_cache
+from .timing import StageTimings, span
+
+logger = logging.getLogger(__name__)
+
+# Ciclos cuya malla se conserva en memoria (00, 06, 12 y 18 UTC de un día)
+GRID_CACHE_SIZE = 4
+
+# Variable que se solicita cuando sólo se necesita la malla del ciclo
+GRID_VARIABLE = 'T2'
+
+# Tipos de contenido aceptados. Los binarios se piden primero y, si el servidor no los
+# soporta, responde en JSON (formato original de la API).
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_NPZ = 'application/x-npz'
+CONTENT_TYPE_RAW = 'application/x-wrf-array'
+BINARY_ACCEPT = f'{CONTENT_TYPE_RAW}, {CONTENT_TYPE_NPZ};q=0.9, {CONTENT_TYPE_JSON};q=0.5'
+
+# Cabecera del formato raw: longitud (uint32 little-endian) de la cabecera JSON
+RAW_HEADER_SIZE = struct.Struct('<I')
+RAW_ALIGNMENT = 8
+
+# Lectura incremental de las respuestas JSON
+STREAM_CHUNK_SIZE = 1024 * 1024
+GRID_KEYS = ('lats', 'longs', 'times')
+FRAME_KEYS = ('var', 'U10', 'V10')
+WIND_VARIABLES = ['wd10']
+_STRUCTURAL = re.compile(rb'[\[\]{}"]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_SCALAR_END = re.compile(rb'[,}\]\s]')
+_NON_WHITESPACE = re.compile(rb'\S')
+_FRAME_END = re.compile(rb'\]\s*\]')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class ModelDataClient:
+    """
+    Cliente de la API de datos del modelo WRF.
+
+    Usa una única requests.Session con pool de conexiones, guarda la malla
+    (lats, longs, times) una vez por ciclo y descarga varias variables a la vez.
+
+    Las variables descargadas se guardan en la caché de campos en disco (ver FieldCache);
+    cache=False la desactiva y refresh=True vuelve a descargar aunque estén en caché.
+    """
+
+    def __init__(self, base_url=None, timeout=None, max_workers=None, verify=None, binary=None,
+                 stream_json=None, cache=None, refresh=False):
+        self.base_url = base_url or getattr(
+            settings, 'WRF_IMG_MODEL_API_URL', 'https://modelo.cmw.insmet.cu/api/data/'
+        )
+        self.timeout = timeout or getattr(settings, 'WRF_IMG_MODEL_API_TIMEOUT', 30)
+        self.max_workers = max(1, max_workers or getattr(settings, 'WRF_IMG_MODEL_API_WORKERS', 4))
+        if verify is None:
+            verify = getattr(settings, 'WRF_IMG_MODEL_API_VERIFY_SSL', False)
+        if binary is None:
+            binary = getattr(settings, 'WRF_IMG_MODEL_API_BINARY', True)
+        if stream_json is None:
+            stream_json = getattr(settings, 'WRF_IMG_MODEL_API_STREAM_JSON', True)
+        self.stream_json = stream_json
+        if cache is None:
+            cache = get_field_cache()
+        self.cache = cache or None
+        self.refresh = refresh
+
+        self.session = requests.Session()
+        self.session.verify = verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept'] = BINARY_ACCEPT if binary else CONTENT_TYPE_JSON
+
+        self._grids = OrderedDict()
+        self._grids_lock = threading.Lock()
+
+    def close(self):
+        self.session.close()
+
+    def get_grid(self, datetime_init):
+        """Retorna la malla (lats, longs, times) del ciclo, descargándola si no está en caché"""
+        grid = self._get_cached_grid(datetime_init)
+        if grid is None:
+            payload = self.fetch_variable(datetime_init, GRID_VARIABLE, stream=True)
+            grid = (payload['lats'], payload['longs'], payload['times'])
+            # Sólo se necesita la malla: se cierra la respuesta sin leer los campos
+            if 'frames' in payload:
+                payload['frames'].close()
+        return grid
+
+    def fetch_variable(self, datetime_init, var_name, stream=None):
+        """
+        Descarga una variable y retorna un diccionario con arrays de numpy:
+        lats, longs, times, var y, para las variables de viento, U10 y V10.
+
+        Las respuestas JSON se decodifican de forma incremental. Con stream=True (por defecto
+        WRF_IMG_MODEL_API_STREAM_JSON) el diccionario trae, en lugar de 'var', 'U10' y 'V10',
+        'frames': un generador que entrega cada tiempo a medida que se lee la respuesta
+        (ver iter_payload_frames).
+
+        El diccionario incluye además 'timings' (StageTimings) con los tiempos de descarga,
+        decodificación y caché medidos hasta aquí; en streaming el resto se mide al consumir
+        los fotogramas.
+        """
+        timings = StageTimings()
+        with timings.activate():
+            payload = self._fetch_variable(datetime_init, var_name, stream)
+        payload['timings'] = timings
+        return payload
+
+    def _fetch_variable(self, datetime_init, var_name, stream):
+        if stream is None:
+            stream = self.stream_json
+
+        if self.cache is not None and not self.refresh:
+            with span('cache'):
+                payload = self.cache.get(datetime_init, var_name)
+            if payload is not None:
+                logger.debug(f"{var_name} ({datetime_init}) leído de la caché de campos")
+                return self._use_cached_grid(datetime_init, payload)
+
+        response = self._request(datetime_init, var_name)
+
+        if _get_content_type(response) not in (CONTENT_TYPE_RAW, CONTENT_TYPE_NPZ):
+            payload = self._stream_payload(datetime_init, var_name, response)
+            if self.cache is not None:
+                writer = self.cache.writer(datetime_init, var_name, payload['lats'], payload['longs'], payload['times'])
+                if writer is not None:
+                    frames = payload['frames']
+                    payload['frames'] = _FrameStream(_cache_frames(frames, writer), frames.close, writer.abort)
+            return payload if stream else collect_frames(payload)
+
+        try:
+            with span('fetch'):
+                response.content  # Lee el cuerpo completo de la respuesta
+            with span('decode'):
+                data = decode_response(response)
+        finally:
+            response.close()
+
+        grid = self._get_cached_grid(datetime_init)
+        if grid is None:
+            grid = self._store_grid(datetime_init, data)
+        lats, longs, times = grid
+
+        payload = {
+            'lats': lats,
+            'longs': longs,
+            'times': times,
+            'var': np.asarray(data['var']),
+        }
+
+        # Para variables de viento
+        if 'U10' in data and 'V10' in data:
+            payload['U10'] = np.asarray(data['U10'])
+            payload['V10'] = np.asarray(data['V10'])
+
+        if self.cache is not None:
+            with span('cache'):
+                self.cache.put(datetime_init, var_name, payload)
+
+        return payload
+
+    def _use_cached_grid(self, datetime_init, payload):
+        """Sustituye la malla leída de la caché por la del ciclo si ya está en memoria"""
+        grid = self._get_cached_grid(datetime_init)
+        if grid is None:
+            grid = self._store_grid(datetime_init, payload)
+        payload['lats'], payload['longs'], payload['times'] = grid
+        return payload
+
+    def _stream_payload(self, datetime_init, var_name, response):
+        """Lee la respuesta JSON hasta tener la malla y deja los campos 3D para el generador"""
+        grid = self._get_cached_grid(datetime_init)
+        skip = GRID_KEYS if grid is not None else ()
+        events = iter_json_events(_timed_chunks(response.iter_content(STREAM_CHUNK_SIZE)), skip=skip)
+
+        values = {}
+        early_frames = []
+        try:
+            if grid is None:
+                with span('decode'):
+                    for event in events:
+                        if event[0] == 'value':
+                            values[event[1]] = event[2]
+                            if all(key in values for key in GRID_KEYS):
+                                break
+                        else:
+                            # Campos que llegan antes que la malla (el orden de las claves no está garantizado)
+                            early_frames.append(event)
+                grid = self._store_grid(datetime_init, values)
+        except Exception:
+            response.close()
+            raise
+
+        lats, longs, times = grid
+        return {
+            'lats': lats,
+            'longs': longs,
+            'times': times,
+            'frames': _FrameStream(_iter_stream_frames(var_name, early_frames, events, response), response.close),
+        }
+
+    def fetch_variables(self, datetime_init, var_names):
+        """Descarga varias variables de un ciclo en paralelo y las retorna en un diccionario"""
+        return {var_name: payload for var_name, payload in self.iter_variables(datetime_init, var_names, stream=False)
+                if not isinstance(payload, Exception)}
+
+    def iter_variables(self, datetime_init, var_names, stream=None):
+        """
+        Itera (var_name, payload) en el orden indicado mientras las siguientes variables
+        se descargan en segundo plano. Como mucho hay max_workers descargas en curso, para
+        que la memoria no crezca con el número de variables. Si una descarga falla se
+        entrega la excepción en lugar del payload.
+
+        Con stream=True las respuestas JSON quedan abiertas hasta que se consumen sus
+        fotogramas, así que cada payload debe procesarse antes de pedir el siguiente.
+        """
+        var_names = list(var_names)
+        if not var_names:
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            remaining = iter(var_names)
+            try:
+                for var_name in remaining:
+                    pending.append((var_name, executor.submit(self.fetch_variable, datetime_init, var_name, stream)))
+                    if len(pending) >= self.max_workers:
+                        break
+
+                while pending:
+                    var_name, future = pending.popleft()
+                    try:
+                        payload = future.result()
+                    except Exception as e:
+                        payload = e
+                    next_var = next(remaining, None)
+                    if next_var is not None:
+                        pending.append((next_var, executor.submit(self.fetch_variable, datetime_init, next_var, stream)))
+                    yield var_name, payload
+            finally:
+                # Si se deja de iterar antes de tiempo, las respuestas ya abiertas de las
+                # variables siguientes no se entregan a nadie: se cierran aquí
+                for _, future in pending:
+                    if not future.cancel():
+                        _close_payload(future)
+
+    def _request(self, datetime_init, var_name):
+        params = {'datetime_init': datetime_init, 'var_name': var_name}
+        with span('fetch'):
+            response = self.session.get(self.base_url, params=params, timeout=self.timeout, stream=True)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError:
+            response.close()
+            raise
+        return response
+
+    def _get_cached_grid(self, datetime_init):
+        with self._grids_lock:
+            grid = self._grids.get(datetime_init)
+            if grid is not None:
+                self._grids.move_to_end(datetime_init)
+            return grid
+
+    def _store_grid(self, datetime_init, data):
+        grid = (np.asarray(data['lats']), np.asarray(data['longs']), list(data['times']))
+        with self._grids_lock:
+            # Si otra descarga guardó la malla primero se reutiliza la misma copia
+            if datetime_init in self._grids:
+                return self._grids[datetime_init]
+            self._grids[datetime_init] = grid
+            while len(self._grids) > GRID_CACHE_SIZE:
+                self._grids.popitem(last=False)
+        return grid
+
+
+def decode_response(response):
+    """Decodifica la respuesta de la API según su Content-Type (JSON por defecto)"""
+    content_type = _get_content_type(response)
+    if content_type == CONTENT_TYPE_RAW:
+        return decode_raw_arrays(response.content)
+    if content_type == CONTENT_TYPE_NPZ:
+        return decode_npz(response.content)
+    return response.json()
+
+
+def decode_npz(content):
+    """Decodifica un fichero .npz (sin pickle); 'times' se guarda como array de cadenas"""
+    with np.load(io.BytesIO(content), allow_pickle=False) as npz:
+        data = {name: npz[name] for name in npz.files}
+    data['times'] = [str(t) for t in data['times']]
+    return data
+
+
+def decode_raw_arrays(content):
+    """
+    Decodifica el formato raw sin copiar los datos (np.frombuffer).
+
+    Estructura: longitud de la cabecera (uint32 little-endian), cabecera JSON y bloque de
+    datos. La cabecera contiene 'times' y, por cada array, su dtype, forma y desplazamiento
+    dentro del bloque de datos:
+
+        {"times": [...], "arrays": {"var": {"dtype": "<f4", "shape": [t, y, x], "offset": 0}, ...}}
+
+    Los arrays resultantes son vistas de solo lectura sobre el contenido de la respuesta.
+    """
+    buffer = memoryview(content)
+    (header_size,) = RAW_HEADER_SIZE.unpack_from(buffer, 0)
+    header_end = RAW_HEADER_SIZE.size + header_size
+    header = json.loads(bytes(buffer[RAW_HEADER_SIZE.size:header_end]))
+    data_start = _align(header_end)
+
+    data = {'times': header['times']}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        shape = tuple(spec['shape'])
+        count = int(np.prod(shape))
+        data[name] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + spec['offset']
+        ).reshape(shape)
+    return data
+
+
+def encode_raw_arrays(payload, dtype='<f4'):
+    """Codifica un payload (lats, longs, times, var, ...) en el formato raw"""
+    arrays = {}
+    blocks = []
+    offset = 0
+    for name, value in payload.items():
+        if name == 'times':
+            continue
+        array = np.ascontiguousarray(value, dtype=dtype)
+        arrays[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        blocks.append(array.tobytes())
+        padding = _align(offset + array.nbytes) - (offset + array.nbytes)
+        blocks.append(b'\0' * padding)
+        offset += array.nbytes + padding
+
+    header = json.dumps({'times': list(payload['times']), 'arrays': arrays}).encode()
+    header_end = RAW_HEADER_SIZE.size + len(header)
+    prefix = RAW_HEADER_SIZE.pack(len(header)) + header + b'\0' * (_align(header_end) - header_end)
+    return prefix + b''.join(blocks)
+
+
+def encode_npz(payload, dtype='<f4'):
+    """Codifica un payload en un .npz sin comprimir"""
+    buffer = io.BytesIO()
+    arrays = {
+        name: np.asarray(value, dtype=dtype) for name, value in payload.items() if name != 'times'
+    }
+    np.savez(buffer, times=np.array(payload['times']), **arrays)
+    return buffer.getvalue()
+
+
+def iter_payload_frames(data):
+    """
+    Itera (índice, var, u, v) con los campos 2D de cada tiempo del payload, tanto si está
+    completo en memoria como si se decodifica en streaming. u y v son None salvo en las
+    variables de viento.
+    """
+    if 'frames' in data:
+        return data['frames']
+
+    var_data = data['var']
+    u_data = data.get('U10')
+    v_data = data.get('V10')
+    return (
+        (i, var_data[i],
+         u_data[i] if u_data is not None else None,
+         v_data[i] if v_data is not None else None)
+        for i in range(len(data['times']))
+    )
+
+
+def collect_frames(payload):
+    """Reúne los fotogramas de un payload en streaming en los arrays 3D var, U10 y V10"""
+    if 'frames' not in payload:
+        return payload
+
+    collected = {key: [] for key in FRAME_KEYS}
+    for _, var_frame, u_frame, v_frame in payload.pop('frames'):
+        collected['var'].append(var_frame)
+        if u_frame is not None:
+            collected['U10'].append(u_frame)
+            collected['V10'].append(v_frame)
+
+    for key, frames in collected.items():
+        if frames:
+            payload[key] = np.stack(frames)
+    if 'var' not in payload:
+        payload['var'] = np.empty((0,) + np.shape(payload['lats']))
+    return payload
+
+
+def iter_json_events(chunks, frame_keys=FRAME_KEYS, skip=()):
+    """
+    Decodifica de forma incremental el objeto JSON de la API a partir de trozos de bytes.
+
+    Produce ('value', clave, valor) para cada clave de primer nivel y, para las claves de
+    frame_keys (arrays 3D tiempo × y × x), ('frame', clave, índice, array 2D) por cada tiempo,
+    sin llegar a tener el array completo en memoria. Las claves de skip se recorren sin
+    decodificarse.
+    """
+    return _JSONEventReader(chunks, frame_keys, skip).events()
+
+
+class _JSONEventReader:
+    """Lector incremental usado por iter_json_events"""
+
+    def __init__(self, chunks, frame_keys, skip):
+        self.chunks = iter(chunks)
+        self.frame_keys = frame_keys
+        self.skip = skip
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def events(self):
+        self._expect(b'{')
+        if self._peek() == ord('}'):
+            return
+
+        while True:
+            end = self._scan_string(self.pos + 1)
+            key = json.loads(bytes(self.buffer[self.pos:end]))
+            self.pos = end
+            self._expect(b':')
+
+            if key in self.frame_keys and self._peek() == ord('['):
+                yield from self._frames(key)
+            else:
+                start = self.pos
+                end = self._scan_value(start)
+                if key not in self.skip:
+                    yield 'value', key, json.loads(bytes(self.buffer[start:end]))
+                self.pos = end
+
+            self._compact()
+            separator = self._peek()
+            self.pos += 1
+            if separator == ord('}'):
+                return
+            if separator != ord(','):
+                raise ValueError(f"JSON inválido: se esperaba ',' o '}}' en la posición {self.pos}")
+            self._peek()
+
+    def _frames(self, key):
+        self.pos += 1  # '['
+        index = 0
+        if self._peek() == ord(']'):
+            self.pos += 1
+            return
+
+        while True:
+            start = self.pos
+            end = self._scan_frame(start)
+            if key not in self.skip:
+                yield 'frame', key, index, np.array(json.loads(bytes(self.buffer[start:end])))
+            self.pos = end
+            index += 1
+            self._compact()
+
+            separator = self._peek()
+            self.pos += 1
+            if separator == ord(']'):
+                return
+            if separator != ord(','):
+                raise ValueError(f"JSON inválido: se esperaba ',' o ']' en la posición {self.pos}")
+            self._peek()
+
+    def _fill(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer.extend(chunk)
+                return True
+        return False
+
+    def _compact(self):
+        # Descarta lo ya decodificado para que el buffer no crezca con la respuesta
+        if self.pos > STREAM_CHUNK_SIZE:
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+    def _peek(self):
+        """Avanza hasta el siguiente carácter que no sea espacio y lo retorna (como entero)"""
+        while True:
+            match = _NON_WHITESPACE.search(self.buffer, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return self.buffer[self.pos]
+            self.pos = len(self.buffer)
+            if not self._fill():
+                raise ValueError('JSON incompleto')
+
+    def _expect(self, char):
+        if self._peek() != char[0]:
+            raise ValueError(f"JSON inválido: se esperaba '{char.decode()}' en la posición {self.pos}")
+        self.pos += 1
+        self._peek()
+
+    def _scan_string(self, position):
+        """Retorna la posición siguiente a las comillas que cierran la cadena"""
+        while True:
+            match = _STRING_SPECIAL.search(self.buffer, position)
+            if match is None or (self.buffer[match.start()] == ord('\\') and match.start() + 1 >= len(self.buffer)):
+                if not self._fill():
+                    raise ValueError('JSON incompleto')
+                continue
+            if self.buffer[match.start()] == ord('\\'):
+                position = match.start() + 2
+                continue
+            return match.end()
+
+    def _scan_frame(self, start):
+        """
+        Retorna la posición donde termina el campo 2D que empieza en start. En una lista de
+        filas numéricas el primer ']]' cierra el campo, lo que evita recorrer cada corchete.
+        """
+        if self.buffer[start] != ord('['):
+            return self._scan_value(start)
+
+        position = start
+        while True:
+            match = _FRAME_END.search(self.buffer, position)
+            if match is not None:
+                return match.end()
+            # Se retoma desde el último ']' por si el cierre quedó partido entre dos trozos
+            position = max(start, self.buffer.rfind(b']', start))
+            if not self._fill():
+                raise ValueError('JSON incompleto')
+
+    def _scan_value(self, start):
+        """Retorna la posición donde termina el valor que empieza en start"""
+        first = self.buffer[start]
+        if first == ord('"'):
+            return self._scan_string(start + 1)
+
+        if first not in (ord('['), ord('{')):
+            # Número, true, false o null
+            while True:
+                match = _SCALAR_END.search(self.buffer, start)
+                if match is not None:
+                    return match.start()
+                if not self._fill():
+                    return len(self.buffer)
+
+        depth = 0
+        position = start
+        while True:
+            match = _STRUCTURAL.search(self.buffer, position)
+            if match is None:
+                if not self._fill():
+                    raise ValueError('JSON incompleto')
+                continue
+            char = self.buffer[match.start()]
+            position = match.end()
+            if char == ord('"'):
+                position = self._scan_string(position)
+            elif char in (ord('['), ord('{')):
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return position
+
+
+def _iter_stream_frames(var_name, early_frames, events, response):
+    """
+    Combina los eventos de var, U10 y V10 en tuplas (índice, var, u, v) en orden. La API
+    envía cada campo completo antes del siguiente, así que en las variables de viento todos
+    los tiempos de var y U10 quedan en memoria hasta que llegan los de V10.
+    """
+    keys = FRAME_KEYS if var_name in WIND_VARIABLES else ('var',)
+    buffers = {key: {} for key in keys}
+    next_index = 0
+
+    try:
+        for event in itertools.chain(early_frames, events):
+            if event[0] != 'frame' or event[1] not in buffers:
+                continue
+            _, key, index, frame = event
+            buffers[key][index] = frame
+
+            # En las variables de viento los tiempos de var y U10 se guardan hasta que llega V10
+            while all(next_index in buffers[key] for key in keys):
+                frames = [buffers[key].pop(next_index) for key in keys]
+                u_frame, v_frame = (frames[1], frames[2]) if len(frames) == 3 else (None, None)
+                yield next_index, frames[0], u_frame, v_frame
+                next_index += 1
+
+        # Respuesta sin componentes de viento: se entregan los tiempos restantes de var
+        for index in sorted(buffers['var']):
+            yield index, buffers['var'][index], None, None
+    finally:
+        response.close()
+
+
+def _close_payload(future):
+    try:
+        payload = future.result()
+    except Exception:
+        return
+    frames = payload.get('frames')
+    if frames is not None:
+        frames.close()
+
+
+class _FrameStream:
+    """
+    Iterador de fotogramas de una respuesta en streaming. close() libera la conexión (y lo
+    que se indique en on_close) aunque no se haya empezado a iterar, cosa que un generador
+    no garantiza.
+    """
+
+    def __init__(self, frames, *on_close):
+        self._frames = frames
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Incluye la lectura de la red (fetch) y la caché, que se descuentan de decode
+        with span('decode'):
+            return next(self._frames)
+
+    def close(self):
+        self._frames.close()
+        for callback in self._on_close:
+            callback()
+
+
+def _cache_frames(frames, writer):
+    """Guarda en la caché los fotogramas a medida que se consumen; sólo se publica si se leen todos"""
+    completed = False
+    try:
+        for i, var_frame, u_frame, v_frame in frames:
+            with span('cache'):
+                writer.write_frame('var', i, var_frame)
+                if u_frame is not None and v_frame is not None:
+                    writer.write_frame('U10', i, u_frame)
+                    writer.write_frame('V10', i, v_frame)
+            yield i, var_frame, u_frame, v_frame
+        completed = True
+    finally:
+        frames.close()
+        if completed:
+            with span('cache'):
+                writer.commit()
+        else:
+            writer.abort()
+
+
+def _timed_chunks(chunks):
+    """Mide como fetch la espera de cada trozo de la respuesta"""
+    chunks = iter(chunks)
+    while True:
+        with span('fetch'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _get_content_type(response):
+    return response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+
+def _align(position):
+    return -(-position // RAW_ALIGNMENT) * RAW_ALIGNMENT
+
+
+def get_model_client():
+    """Cliente compartido del proceso (reutiliza conexiones y la caché de mallas)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ModelDataClient()
+        return _client
+
+
+def reset_model_client():
+    """Descarta el cliente compartido (por ejemplo al cambiar la configuración)"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
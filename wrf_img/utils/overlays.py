@@ -0,0 +1,188 @@
+"""
+Producto por capas: capa de datos transparente por fotograma, leyenda por variable y mapa
+base por dominio.
+
+Cada imagen compuesta repite el mapa base, la barra de colores, la cuadrícula y el título.
+Con WRF_IMG_OVERLAYS cada fotograma guarda además sólo sus datos (contornos y barbas) sobre
+fondo transparente (MeteoImage.overlay), con la extensión y el tamaño en píxeles del mapa
+base rasterizado (ver get_basemap_layers). La leyenda de cada variable se genera a partir de
+PLOT_CONFIGS y el mapa base de cada dominio se escribe una sola vez; ambos ficheros se
+comparten entre simulaciones. Un cliente compone: mapa base inferior, capa de datos, mapa
+base superior (costas y fronteras) y leyenda (ver MeteoLayerSet).
+"""
+import hashlib
+import io
+
+import cartopy.crs as ccrs
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from wrf_img.models import MeteoLayerSet
+from .basemap import get_basemap_key, get_basemap_layers, get_basemap_size, get_map_extent
+from .grid_geometry import get_grid_geometry
+from .image_encoder import encode_image, render_rgba
+from .plot_config import get_plot_config, get_plot_config_signature
+from .timing import span
+
+# Directorio de los ficheros compartidos (leyendas y mapas base)
+LAYERS_DIR = 'meteo_layers'
+
+
+def is_overlay_enabled():
+    return bool(getattr(settings, 'WRF_IMG_OVERLAYS', False))
+
+
+class MeteoOverlayRenderer:
+    """
+    Renderiza la capa de datos de los fotogramas de una variable en PNG transparente.
+
+    Los ejes ocupan toda la figura, con la extensión del dominio y el tamaño del raster del
+    mapa base, de modo que la capa se superpone píxel a píxel sobre él. La figura se crea una
+    vez y en cada fotograma sólo se reemplazan los contornos y las barbas.
+    """
+
+    def __init__(self, var_name, lats, longs):
+        self.var_name = var_name
+        self.lats = lats
+        self.longs = longs
+        self.plot_config = get_plot_config(var_name)
+        self.extent = get_map_extent(lats, longs)
+        self.fig = None
+        self.ax = None
+
+    def render(self, var_frame, u_frame=None, v_frame=None):
+        """Renderiza un fotograma y retorna la capa de datos en PNG (bytes)"""
+        from .plot_generators import DPI, draw_plot
+
+        if self.fig is None:
+            with span('figure'):
+                self._setup_figure()
+        with span('contour'):
+            artists = draw_plot(
+                self.ax, self.var_name, self.plot_config, self.lats, self.longs,
+                var_frame, u_frame, v_frame, get_grid_geometry(self.lats, self.longs, self.ax.projection)
+            )
+        try:
+            with span('savefig'):
+                rgba = render_rgba(self.fig, dpi=DPI, transparent=True)
+            with span('encode'):
+                return encode_image(rgba, ['png'])['png']
+        finally:
+            for artist in artists:
+                if artist is not None:
+                    artist.remove()
+
+    def _setup_figure(self):
+        from .plot_generators import DPI, FIGSIZE
+
+        width_px, height_px = get_basemap_size(self.extent, FIGSIZE, DPI)
+        self.fig = Figure(figsize=(width_px / DPI, height_px / DPI), dpi=DPI)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1], projection=ccrs.PlateCarree())
+        self.ax.set_extent(self.extent, crs=ccrs.PlateCarree())
+        self.ax.set_aspect('auto')
+        # Sin marco ni fondo: sólo se dibujan los datos
+        self.ax.set_axis_off()
+
+
+def render_legend(var_name):
+    """
+    Leyenda (barra de colores) de una variable en PNG, igual a la de las imágenes compuestas.
+    Retorna None si la variable no tiene niveles fijos (su escala depende de cada fotograma).
+    """
+    from .plot_generators import DPI, FIGSIZE, draw_plot, setup_colorbar
+
+    plot_config = get_plot_config(var_name)
+    levels = plot_config.get('levels')
+    if not isinstance(levels, (list, tuple, np.ndarray)):
+        return None
+
+    # Contornos de un campo mínimo que recorre los niveles, en unos ejes que no se dibujan:
+    # la barra de colores sale del mismo contourf que en las imágenes
+    values = np.asarray(levels, dtype=float) / plot_config.get('scale_factor', 1)
+    longs, lats = np.meshgrid(np.arange(len(values), dtype=float), np.arange(2, dtype=float))
+    var_frame = np.vstack([values, values])
+
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0.05, 0.05, 0.85, 0.9])
+    contour = draw_plot(
+        ax, var_name, plot_config, lats, longs, var_frame,
+        geometry=get_grid_geometry(lats, longs), barbs=False
+    )[0]
+    cbar = setup_colorbar(fig, ax, contour, plot_config, var_name)
+    ax.set_visible(False)
+
+    renderer = fig.canvas.get_renderer()
+    bbox = cbar.ax.get_tightbbox(renderer).transformed(fig.dpi_scale_trans.inverted())
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=DPI, bbox_inches=bbox.padded(0.05))
+    return buffer.getvalue()
+
+
+def ensure_legend(var_name):
+    """Nombre del fichero de la leyenda de una variable, generándolo si no existe"""
+    name = f"{LAYERS_DIR}/legends/{var_name}_{get_plot_config_signature(var_name)}.png"
+    return _ensure_file(name, lambda: render_legend(var_name))
+
+
+def ensure_basemap(extent):
+    """
+    Nombres de los ficheros (inferior, superior) del mapa base de un dominio, escribiéndolos
+    si no existen. Son las mismas capas cacheadas que componen las imágenes.
+    """
+    from .plot_generators import DPI, FIGSIZE
+
+    key = get_basemap_key(extent, FIGSIZE, DPI)
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    names = []
+    for index, layer in enumerate(('under', 'over')):
+        names.append(_ensure_file(
+            f"{LAYERS_DIR}/basemaps/{digest}_{layer}.png",
+            lambda index=index: _encode_layer(get_basemap_layers(extent, FIGSIZE, DPI)[index])
+        ))
+    return tuple(names)
+
+
+def update_meteo_layer_set(simulation, var_name, extent):
+    """
+    Guarda la MeteoLayerSet de una variable (leyenda, mapa base y extensión del dominio),
+    generando los ficheros compartidos que falten
+    """
+    with span('storage'):
+        legend = ensure_legend(var_name)
+        basemap_under, basemap_over = ensure_basemap(extent)
+    lon_min, lon_max, lat_min, lat_max = (float(x) for x in extent)
+    with span('db'):
+        layer_set, _ = MeteoLayerSet.objects.update_or_create(
+            simulation=simulation, variable_name=var_name,
+            defaults={
+                'legend': legend or '',
+                'basemap_under': basemap_under,
+                'basemap_over': basemap_over,
+                'lon_min': lon_min, 'lon_max': lon_max,
+                'lat_min': lat_min, 'lat_max': lat_max,
+            },
+        )
+    return layer_set
+
+
+def _encode_layer(rgba):
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(rgba)).save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _ensure_file(name, render):
+    if default_storage.exists(name):
+        return name
+    content = render()
+    if content is None:
+        return None
+    # Si otro proceso lo escribió a la vez el almacenamiento le da otro nombre
+    return default_storage.save(name, ContentFile(content))
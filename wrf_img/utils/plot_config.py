@@ -1,7 +1,9 @@
+import hashlib
+
 import matplotlib
 import numpy as np
 from matplotlib import pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.colors import Colormap, LinearSegmentedColormap
 
 # Definir el nuevo colormap para nubosidad
 colors_cloud = [
@@ -297,3 +299,22 @@ def get_plot_config(var_name):
         'units': '',
         'levels': 20
     })
+
+
+def get_plot_config_signature(var_name):
+    """Firma de la configuración de una variable (cambia si cambian niveles, colores, etc.)"""
+    return hashlib.sha1(_describe(get_plot_config(var_name)).encode()).hexdigest()[:16]
+
+
+def _describe(value):
+    # Representación estable: los colormaps por sus colores, no por su repr (incluye la dirección)
+    if isinstance(value, dict):
+        return '{' + ','.join(f'{key!r}:{_describe(value[key])}' for key in sorted(value)) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(_describe(item) for item in value) + ']'
+    if isinstance(value, np.ndarray):
+        return repr(value.tolist())
+    if isinstance(value, Colormap):
+        colors = value(np.linspace(0, 1, value.N))
+        return f'{value.name}:{hashlib.sha1(colors.tobytes()).hexdigest()}'
+    return repr(value)
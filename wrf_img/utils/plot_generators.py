@@ -1,15 +1,31 @@
 import requests
-import io
+import hashlib
 from datetime import datetime
 from django.utils import timezone
 import cartopy.crs as ccrs
-import cartopy.feature as cfeature
+from django.conf import settings
 from django.core.files.base import ContentFile
-from wrf_img.models import Simulation, MeteoImage
-from .plot_config import get_plot_config
+from django.core.files.storage import default_storage
+from django.db import transaction
+from wrf_img.models import Simulation, MeteoImage, MeteoTileSet
+from .animations import refresh_meteo_animations
+from .basemap import draw_basemap, get_map_extent
+from .field_stats import FrameStatsBatch, compute_field_stats, get_cell_areas
+from .field_store import get_field_store_path, get_field_store_writer
+from .grid_geometry import get_grid_geometry
+from .image_encoder import encode_image, get_encoder_signature, render_rgba
+from .model_api import get_model_client, iter_payload_frames
+from .overlays import MeteoOverlayRenderer, is_overlay_enabled, update_meteo_layer_set
+from .plot_config import get_plot_config, get_plot_config_signature
+from .render_engine import grid_signature
+from .tiles import (
+    MeteoTileRenderer, delete_tile_dir, get_tile_dir, get_tile_name, get_tile_signature, get_tile_zooms,
+)
+from .timing import StageTimings, span
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib.transforms import Affine2D, Bbox, TransformedBbox
 import base64
 from io import BytesIO
 import logging
@@ -20,126 +36,605 @@ from metpy.units import units
 matplotlib.use('Agg')
 logger = logging.getLogger(__name__)
 
+# Tamaño y resolución de las figuras generadas
+FIGSIZE = (12, 8)
+DPI = 100
 
-def generate_and_save_meteo_plot(datetime_init, var_name):
-    # URL de la API
-    api_url = f'https://modelo.cmw.insmet.cu/api/data/?datetime_init={datetime_init}&var_name={var_name}'
+# Variables de nubosidad (se representan en porcentaje y con fondo oscuro)
+CLOUD_VARIABLES = ['clflo', 'clfmi', 'clfhi']
 
-    try:
-        # Hacer la solicitud a la API
-        response = requests.get(api_url, timeout=30, verify=False)
-        response.raise_for_status()
+# Renderer reutilizado entre fotogramas en los procesos de render (ver get_frame_renderer)
+_frame_renderer = None
 
-        data = response.json()
+# Forma parte del hash de cada imagen (ver get_render_hash): cámbiela al modificar el dibujo
+# para que se vuelvan a renderizar los fotogramas que no cambiaron
+RENDER_VERSION = '1'
 
-        # Convertir los datos a arrays de numpy
-        lats = np.array(data['lats'])
-        longs = np.array(data['longs'])
-        times = data['times']
-        var_data = np.array(data['var'])
 
-        # Para variables de viento
-        u_data = np.array(data['U10']) if 'U10' in data else None
-        v_data = np.array(data['V10']) if 'V10' in data else None
+def generate_and_save_meteo_plot(datetime_init, var_name, engine=None, data=None):
+    try:
+        job = MeteoPlotJob(datetime_init, var_name, engine=engine, data=data)
+        return job.save()
 
-        plot_config = get_plot_config(var_name)
-        saved_images = []
+    except requests.exceptions.RequestException as e:
+        raise Exception(f"Error al acceder a la API: {str(e)}")
+    except Exception as e:
+        raise Exception(str(e))
 
-        # Convertir la cadena a objeto datetime
-        datetime_obj = datetime.strptime(datetime_init, '%Y%m%d%H')
-        datetime_obj = timezone.make_aware(datetime_obj)
 
-        # Crear o obtener la simulación
+class MeteoPlotJob:
+    """
+    Generación de las imágenes de una variable para una simulación.
+
+    Al crearse descarga los datos y obtiene la simulación. Los fotogramas se renderizan
+    en el proceso actual o, si se indica un RenderEngine, en su pool de procesos; en
+    ambos casos save() es el único punto que escribe en la base de datos.
+
+    Los fotogramas cuya imagen ya existe con el mismo hash de datos y configuración no se
+    vuelven a renderizar (ver get_render_hash); se cuentan en skipped. Después de guardar se
+    actualizan las animaciones de la variable (ver update_meteo_animations).
+
+    Si WRF_IMG_TILE_ZOOMS indica zooms, cada fotograma también se renderiza en teselas XYZ
+    (ver wrf_img.utils.tiles), que se guardan junto con las imágenes. Con WRF_IMG_OVERLAYS se
+    guarda además la capa de datos de cada fotograma (ver wrf_img.utils.overlays).
+
+    Los campos de todos los fotogramas, también los que no se renderizan, se guardan en el
+    almacén de la simulación (ver wrf_img.utils.field_store) si cambió alguna imagen o si
+    todavía no estaban guardados.
+    """
+
+    def __init__(self, datetime_init, var_name, engine=None, data=None):
+        # Tiempos por etapa de la variable (ver wrf_img.utils.timing)
+        self.timings = StageTimings()
+        with self.timings.activate():
+            # Descargar los datos si no se recibieron ya descargados (ver ModelDataClient.iter_variables)
+            if data is None:
+                data = get_model_client().fetch_variable(datetime_init, var_name)
+            # Tiempos de la descarga, medidos en el hilo que la hizo
+            self.timings.merge(data.get('timings'))
+
+            lats = data['lats']
+            longs = data['longs']
+            times = data['times']
+
+            simulation = get_or_create_simulation(datetime_init)
+
+            self.var_name = var_name
+            self.simulation = simulation
+            self.extent = get_map_extent(lats, longs)
+            self.times = times
+            self.stats = FrameStatsBatch(var_name, lats, longs)
+            self.hashes = {}
+            self.skipped = 0
+            self.render_key = get_render_key(var_name, lats, longs)
+            self.existing_hashes = get_existing_hashes(simulation, var_name)
+
+            # Los campos llegan tiempo a tiempo (ver iter_payload_frames); las estadísticas se
+            # calculan por lotes de fotogramas para no tener que conservar el array 3D completo
+            frames = iter_payload_frames(data)
+            self.field_writer = get_field_store_writer(simulation, var_name, lats, longs, times)
+            if self.field_writer is not None:
+                frames = self.field_writer.write_frames(frames)
+            frames = self._record_stats(frames)
+
+            if engine is not None:
+                self._frames = engine.submit(var_name, lats, longs, times, simulation.initial_datetime, frames)
+            else:
+                self._frames = self._render(MeteoFrameRenderer(var_name, lats, longs, simulation.initial_datetime), frames)
+
+    def _render(self, renderer, frames):
+        # La figura se crea una vez y se reutiliza para todos los fotogramas de la variable
+        tile_renderer = MeteoTileRenderer(self.var_name, renderer.lats, renderer.longs) if get_tile_zooms() else None
+        try:
+            for i, var_frame, u_frame, v_frame in frames:
+                images = renderer.render_images(self.times[i], var_frame, u_frame, v_frame)
+                tiles = tile_renderer.render(var_frame, u_frame, v_frame) if tile_renderer else None
+                yield i, images, tiles
+        finally:
+            renderer.close()
+            if tile_renderer is not None:
+                tile_renderer.close()
+
+    def _record_stats(self, frames):
+        for i, var_frame, u_frame, v_frame in frames:
+            with span('stats'):
+                render_hash = get_render_hash(self.render_key, self.times[i], var_frame, u_frame, v_frame)
+                if self.existing_hashes.get(parse_valid_datetime(self.times[i])) == render_hash:
+                    # Imagen al día: no se renderiza ni se vuelve a guardar
+                    self.skipped += 1
+                    continue
+                self.hashes[i] = render_hash
+                self.stats.add(i, var_frame)
+            yield i, var_frame, u_frame, v_frame
+
+    def save(self, before_save=None):
+        """
+        Escribe las imágenes a medida que se terminan de renderizar y guarda las filas de
+        toda la variable al final, en una sola sentencia (ver upsert_meteo_images).
+
+        before_save se llama justo antes de guardar las filas; si lanza una excepción no se
+        guarda nada y se eliminan las imágenes escritas.
+        """
+        meteo_images = []
+        tile_sets = []
+        try:
+            with self.timings.activate():
+                frame_indexes = []
+                for i, images, tiles in self._frames:
+                    meteo_images.append(write_meteo_image(
+                        self.simulation, self.var_name, self.times[i], images, None, self.hashes.pop(i)
+                    ))
+                    frame_indexes.append(i)
+                    if tiles is not None:
+                        tile_sets.append(write_meteo_tiles(self.simulation, self.var_name, self.times[i], tiles))
+                # Estadísticas calculadas por lotes al recibir los fotogramas
+                with span('stats'):
+                    for i, meteo_image in zip(frame_indexes, meteo_images):
+                        set_frame_stats(meteo_image, self.stats.pop(i))
+
+                if before_save is not None:
+                    before_save()
+                with transaction.atomic():
+                    result = upsert_meteo_images(meteo_images)
+                    upsert_meteo_tile_sets(tile_sets)
+                    # Leyenda y mapa base de las capas de datos
+                    if any(meteo_image.overlay for meteo_image in meteo_images):
+                        update_meteo_layer_set(self.simulation, self.var_name, self.extent)
+                self._save_fields(bool(meteo_images))
+                # Animación de todos los fotogramas (sólo si cambió alguno)
+                refresh_meteo_animations(self.simulation, self.var_name)
+
+        except Exception:
+            if self.field_writer is not None:
+                self.field_writer.abort()
+            # Ninguna fila apunta a los ficheros nuevos: se eliminan
+            for meteo_image in meteo_images:
+                for image_format in meteo_image.available_formats():
+                    meteo_image.get_image_file(image_format).delete(save=False)
+            for tile_set in tile_sets:
+                delete_tile_dir(tile_set.tile_dir)
+            raise
+
+        logger.info(f"Tiempos de {self.var_name}: {self.timings.format()}")
+        return result
+
+    def _save_fields(self, changed):
+        if self.field_writer is None:
+            return
+        if changed or get_field_store_path(self.simulation, self.var_name) is None:
+            self.field_writer.commit()
+        else:
+            self.field_writer.abort()
+
+
+def get_or_create_simulation(datetime_init):
+    """Retorna la simulación del ciclo datetime_init (YYYYMMDDHH), creándola si no existe"""
+    # Convertir la cadena a objeto datetime
+    datetime_obj = datetime.strptime(datetime_init, '%Y%m%d%H')
+    datetime_obj = timezone.make_aware(datetime_obj)
+
+    # Crear o obtener la simulación
+    with span('db'):
         simulation, created = Simulation.objects.get_or_create(
             initial_datetime=datetime_obj,
             defaults={'description': f'Simulación generada automáticamente el {timezone.now()}'}
         )
-
-        for i in range(len(times)):
-            fig, ax = setup_figure(lats, longs, var_name)
-            contour, barbs, contour_lines = draw_plot(
-                ax, var_name, plot_config,
-                lats, longs, var_data, times, i,
-                u_data, v_data
+    return simulation
+
+
+def get_frame_stats(var_name, var_frame, lats=None, longs=None):
+    """
+    Retorna las estadísticas de un fotograma: valores de los campos de MeteoImage
+    (ver wrf_img.utils.field_stats). Sin la malla no se calculan las áreas por umbral.
+    """
+    cell_areas = get_cell_areas(lats, longs) if lats is not None else None
+    return compute_field_stats(var_name, np.asarray(var_frame)[np.newaxis], cell_areas)[0]
+
+
+def set_frame_stats(meteo_image, stats):
+    """Asigna a una MeteoImage las estadísticas de get_frame_stats"""
+    for field, value in stats.items():
+        setattr(meteo_image, field, value)
+
+
+def write_meteo_image(simulation, var_name, time_str, images, stats, render_hash=''):
+    """
+    Escribe los ficheros de un fotograma (images: {formato: bytes}, ver encode_image) y
+    retorna su MeteoImage sin guardar en la base de datos (ver upsert_meteo_images)
+    """
+    # Crear nombre de archivo
+    safe_time = time_str.replace(':', '-').replace(' ', '_')
+    # La capa de datos es un PNG junto a la imagen compuesta
+    suffixes = {'overlay': '_overlay.png'}
+
+    meteo_image = MeteoImage(
+        simulation=simulation,
+        valid_datetime=parse_valid_datetime(time_str),
+        variable_name=var_name,
+        render_hash=render_hash,
+    )
+    # Sin estadísticas (None) se asignan después (ver MeteoPlotJob.save)
+    if stats is not None:
+        set_frame_stats(meteo_image, stats)
+
+    # Los ficheros se escriben fuera de la transacción
+    with span('storage'):
+        for image_format, image_bytes in images.items():
+            meteo_image.get_image_file(image_format).save(
+                f"{var_name}_{safe_time}{suffixes.get(image_format, '.' + image_format)}", ContentFile(image_bytes),
+                save=False
             )
-            cbar = setup_colorbar(fig, ax, contour, plot_config, var_name)
+    return meteo_image
+
+
+def upsert_meteo_images(meteo_images):
+    """
+    Inserta o actualiza las imágenes de una variable en una sola sentencia (INSERT ... ON
+    CONFLICT DO UPDATE sobre simulación, tiempo válido y variable). Al confirmarse la
+    transacción se borran los ficheros de las filas reemplazadas.
+    """
+    if not meteo_images:
+        return []
+
+    simulation = meteo_images[0].simulation
+    var_name = meteo_images[0].variable_name
+
+    with span('db'), transaction.atomic():
+        # Filas de ejecuciones anteriores, para retirar sus ficheros al reemplazarlas
+        existing_images = {
+            image.valid_datetime: image
+            for image in MeteoImage.objects.filter(simulation=simulation, variable_name=var_name)
+        }
+
+        MeteoImage.objects.bulk_create(
+            meteo_images,
+            update_conflicts=True,
+            unique_fields=['simulation', 'valid_datetime', 'variable_name'],
+            update_fields=[*MeteoImage.IMAGE_FIELDS.values(), *MeteoImage.STATS_FIELDS, 'render_hash'],
+        )
 
-            # Convertir el tiempo válido a formato datetime
-            time_str = times[i]
-            if 'T' in time_str:
-                valid_dt_naive = datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%S')
-            else:
-                valid_dt_naive = datetime.strptime(time_str, '%Y%m%d%H')
-
-            valid_dt = timezone.make_aware(valid_dt_naive)
-
-            # Calcular la hora de pronóstico
-            forecast_hour = (valid_dt - simulation.initial_datetime).total_seconds() / 3600
-
-            # Formatear la fecha inicial
-            initial_dt_str = simulation.initial_datetime.strftime('%Y-%m-%d %H:%M UTC')
-
-            # Configurar ejes
-            setup_axes(ax, plot_config, time_str, initial_dt_str, forecast_hour)
-
-            # Guardar imagen en buffer
-            buffer = io.BytesIO()
-            plt.savefig(buffer, format='png', bbox_inches='tight', dpi=100)
-            plt.close(fig)
-
-            # Crear nombre de archivo
-            safe_time = times[i].replace(':', '-').replace(' ', '_')
-            filename = f"{var_name}_{safe_time}.png"
-
-            # Verificar si ya existe una imagen
-            existing_image = MeteoImage.objects.filter(
-                simulation=simulation,
-                valid_datetime=valid_dt,
-                variable_name=var_name
-            ).first()
-
-            # Calcular estadísticas
-            data_min = float(np.min(var_data[i]))
-            data_max = float(np.max(var_data[i]))
-            data_mean = float(np.mean(var_data[i]))
-
-            if existing_image:
-                # Actualizar imagen existente
-                meteo_image = existing_image
-                meteo_image.data_min = data_min
-                meteo_image.data_max = data_max
-                meteo_image.data_mean = data_mean
-            else:
-                # Crear nueva imagen
-                meteo_image = MeteoImage(
-                    simulation=simulation,
-                    valid_datetime=valid_dt,
-                    variable_name=var_name,
-                    data_min=data_min,
-                    data_max=data_max,
-                    data_mean=data_mean
-                )
+        # Ficheros de las filas reemplazadas en cada formato (también los de formatos que ya no se generan)
+        replaced_files = []
+        for meteo_image in meteo_images:
+            existing_image = existing_images.get(meteo_image.valid_datetime)
+            if existing_image is None:
+                continue
+            for image_format in existing_image.available_formats():
+                image_file = existing_image.get_image_file(image_format)
+                if image_file.name != meteo_image.get_image_file(image_format).name:
+                    replaced_files.append(image_file)
+        if replaced_files:
+            transaction.on_commit(lambda: _delete_image_files(replaced_files))
+
+    return meteo_images
+
+
+def write_meteo_tiles(simulation, var_name, time_str, tiles):
+    """
+    Escribe las teselas de un fotograma (tiles: {(z, x, y): bytes}, ver MeteoTileRenderer)
+    en un directorio nuevo y retorna su MeteoTileSet sin guardar (ver upsert_meteo_tile_sets)
+    """
+    valid_datetime = parse_valid_datetime(time_str)
+    zooms = get_tile_zooms()
+    tile_set = MeteoTileSet(
+        simulation=simulation,
+        valid_datetime=valid_datetime,
+        variable_name=var_name,
+        tile_dir=get_tile_dir(simulation, var_name, valid_datetime),
+        min_zoom=zooms[0],
+        max_zoom=zooms[-1],
+        tile_count=len(tiles),
+    )
+    with span('storage'):
+        for (zoom, x, y), tile_bytes in tiles.items():
+            default_storage.save(get_tile_name(tile_set.tile_dir, zoom, x, y), ContentFile(tile_bytes))
+    return tile_set
+
+
+def upsert_meteo_tile_sets(tile_sets):
+    """
+    Inserta o actualiza las teselas de una variable en una sola sentencia, como
+    upsert_meteo_images. Al confirmarse la transacción se borran los directorios reemplazados.
+    """
+    if not tile_sets:
+        return []
+
+    simulation = tile_sets[0].simulation
+    var_name = tile_sets[0].variable_name
+
+    with span('db'), transaction.atomic():
+        existing_dirs = dict(
+            MeteoTileSet.objects.filter(simulation=simulation, variable_name=var_name)
+            .values_list('valid_datetime', 'tile_dir')
+        )
 
-            # Guardar imagen
-            buffer.seek(0)
-            meteo_image.image.save(filename, ContentFile(buffer.getvalue()), save=False)
-            meteo_image.save()
+        MeteoTileSet.objects.bulk_create(
+            tile_sets,
+            update_conflicts=True,
+            unique_fields=['simulation', 'valid_datetime', 'variable_name'],
+            update_fields=['tile_dir', 'min_zoom', 'max_zoom', 'tile_count'],
+        )
 
-            saved_images.append(meteo_image)
+        replaced_dirs = [
+            existing_dirs[tile_set.valid_datetime] for tile_set in tile_sets
+            if existing_dirs.get(tile_set.valid_datetime, tile_set.tile_dir) != tile_set.tile_dir
+        ]
+        if replaced_dirs:
+            transaction.on_commit(lambda: [delete_tile_dir(tile_dir) for tile_dir in replaced_dirs])
+
+    return tile_sets
+
+
+def get_render_key(var_name, lats, longs):
+    """
+    Parte del hash común a todos los fotogramas de una variable: dibujo, configuración,
+    malla, codificación, teselas y capa de datos
+    """
+    return ':'.join([
+        RENDER_VERSION, var_name, repr((FIGSIZE, DPI)),
+        get_plot_config_signature(var_name), grid_signature(lats, longs), get_encoder_signature(),
+        get_tile_signature(), repr(is_overlay_enabled()),
+    ])
+
+
+def get_render_hash(render_key, time_str, var_frame, u_frame=None, v_frame=None):
+    """
+    Hash de los datos de entrada de un fotograma. Si coincide con el guardado en su
+    MeteoImage la imagen no cambiaría al volver a renderizarla.
+    """
+    digest = hashlib.sha256(f'{render_key}:{time_str}'.encode())
+    for frame in (var_frame, u_frame, v_frame):
+        if frame is None:
+            continue
+        frame = np.ascontiguousarray(frame)
+        digest.update(repr((frame.dtype.str, frame.shape)).encode())
+        digest.update(frame.tobytes())
+    return digest.hexdigest()
+
+
+def get_stale_frames(simulation, var_name, data):
+    """Índices de los fotogramas de un payload completo cuya imagen falta o está desactualizada"""
+    render_key = get_render_key(var_name, data['lats'], data['longs'])
+    existing_hashes = get_existing_hashes(simulation, var_name)
+    return [
+        i for i, var_frame, u_frame, v_frame in iter_payload_frames(data)
+        if existing_hashes.get(parse_valid_datetime(data['times'][i]))
+        != get_render_hash(render_key, data['times'][i], var_frame, u_frame, v_frame)
+    ]
+
+
+def get_existing_hashes(simulation, var_name):
+    """Hashes de las imágenes ya guardadas de una variable: {valid_datetime: render_hash}"""
+    with span('db'):
+        meteo_images = list(MeteoImage.objects.filter(
+            simulation=simulation, variable_name=var_name
+        ).exclude(render_hash=''))
+    with span('storage'):
+        return {
+            meteo_image.valid_datetime: meteo_image.render_hash
+            for meteo_image in meteo_images
+            # Si falta el fichero la imagen se vuelve a generar
+            if meteo_image.image and meteo_image.image.storage.exists(meteo_image.image.name)
+        }
+
+
+def _delete_image_files(image_files):
+    for image_file in image_files:
+        try:
+            image_file.delete(save=False)
+        except OSError as e:
+            logger.warning(f"No se pudo eliminar {image_file.name}: {str(e)}")
+
+
+def parse_valid_datetime(time_str):
+    """Convierte el tiempo válido de la API a un datetime con zona horaria"""
+    if 'T' in time_str:
+        valid_dt_naive = datetime.strptime(time_str, '%Y-%m-%dT%H:%M:%S')
+    else:
+        valid_dt_naive = datetime.strptime(time_str, '%Y%m%d%H')
 
-        return saved_images
+    return timezone.make_aware(valid_dt_naive)
 
-    except requests.exceptions.RequestException as e:
-        raise Exception(f"Error al acceder a la API: {str(e)}")
-    except Exception as e:
-        raise Exception(str(e))
+
+def render_meteo_frame(var_name, lats, longs, time_str, initial_datetime, var_frame,
+                       u_frame=None, v_frame=None):
+    """Renderiza un fotograma (campo 2D de un tiempo) y retorna la imagen PNG en bytes"""
+    renderer = MeteoFrameRenderer(var_name, lats, longs, initial_datetime)
+    try:
+        return renderer.render(time_str, var_frame, u_frame, v_frame)
+    finally:
+        renderer.close()
+
+
+class MeteoFrameRenderer:
+    """
+    Renderiza los fotogramas de una variable sobre una misma figura.
+
+    La figura, el mapa base, la barra de colores y la cuadrícula se crean con el primer
+    fotograma; en los siguientes sólo se reemplazan los contornos, las barbas y el título.
+    Si los niveles o la escala de colores cambian (variables sin niveles fijos) la barra de
+    colores ya no serviría y la figura se vuelve a crear. El resultado es idéntico, píxel a
+    píxel, al de crear una figura por fotograma.
+
+    El recorte de la imagen (bbox_inches='tight') también se calcula una sola vez por figura,
+    ver _get_bbox_inches.
+    """
+
+    def __init__(self, var_name, lats, longs, initial_datetime):
+        self.var_name = var_name
+        self.lats = lats
+        self.longs = longs
+        self.initial_datetime = initial_datetime
+        self.plot_config = get_plot_config(var_name)
+        self.geometry = None
+        self.fig = None
+        self.ax = None
+        self._artists = []
+        self._colorbar_key = None
+        self._draw_positions = None
+        self._gridliner = None
+        self._layout_bbox = None
+        self._overlay = None
+
+    def render(self, time_str, var_frame, u_frame=None, v_frame=None):
+        """Renderiza un fotograma y retorna la imagen PNG en bytes"""
+        return self.render_images(time_str, var_frame, u_frame, v_frame, formats=['png'])['png']
+
+    def render_images(self, time_str, var_frame, u_frame=None, v_frame=None, formats=None):
+        """
+        Renderiza un fotograma y retorna {formato: bytes} con la imagen en los formatos
+        indicados (por defecto los configurados, ver get_image_formats y, con WRF_IMG_OVERLAYS,
+        la capa de datos en 'overlay')
+        """
+        if self.fig is not None and not isinstance(self.plot_config.get('levels'), (list, tuple, np.ndarray)):
+            # Sin niveles fijos la barra de colores depende de los datos de cada fotograma
+            self.close()
+
+        if self.fig is not None:
+            with span('contour'):
+                self._remove_artists()
+            # Las etiquetas de las isolíneas (clabel) se colocan según el tamaño de los ejes, que
+            # en una figura nueva aún no se ha reducido para la barra de colores
+            current_positions = _get_positions(self.ax)
+            _set_positions(self.ax, self._draw_positions)
+            with span('contour'):
+                artists = self._draw(var_frame, u_frame, v_frame)
+            _set_positions(self.ax, current_positions)
+            # La cuadrícula se dibuja encima de los contornos, como en una figura nueva
+            self._gridliner.remove()
+            self.ax.add_artist(self._gridliner)
+            if _get_colorbar_key(artists[0]) != self._colorbar_key:
+                self.close()
+
+        created = self.fig is None
+        if created:
+            with span('figure'):
+                self.fig, self.ax = setup_figure(self.lats, self.longs, self.var_name)
+                if self.geometry is None:
+                    self.geometry = get_grid_geometry(self.lats, self.longs, self.ax.projection)
+                self._draw_positions = _get_positions(self.ax)
+            with span('contour'):
+                artists = self._draw(var_frame, u_frame, v_frame)
+            with span('figure'):
+                setup_colorbar(self.fig, self.ax, artists[0], self.plot_config, self.var_name)
+                self._colorbar_key = _get_colorbar_key(artists[0])
+
+        self._artists = [artist for artist in artists if artist is not None]
+
+        # Calcular la hora de pronóstico
+        valid_dt = parse_valid_datetime(time_str)
+        forecast_hour = (valid_dt - self.initial_datetime).total_seconds() / 3600
+
+        # Formatear la fecha inicial
+        initial_dt_str = self.initial_datetime.strftime('%Y-%m-%d %H:%M UTC')
+
+        # Configurar ejes (la cuadrícula sólo la primera vez)
+        gridliner = setup_axes(self.ax, self.plot_config, time_str, initial_dt_str, forecast_hour, gridlines=created)
+        if created:
+            self._gridliner = gridliner
+
+        # Dibujo de la figura a un buffer RGBA y codificación (PNG con paleta y WebP/AVIF)
+        with span('savefig'):
+            rgba = render_rgba(self.fig, bbox_inches=self._get_bbox_inches(), dpi=DPI)
+        with span('encode'):
+            images = encode_image(rgba, formats)
+
+        if formats is None and is_overlay_enabled():
+            if self._overlay is None:
+                self._overlay = MeteoOverlayRenderer(self.var_name, self.lats, self.longs)
+            images['overlay'] = self._overlay.render(var_frame, u_frame, v_frame)
+        return images
+
+    def close(self):
+        if self.fig is not None:
+            plt.close(self.fig)
+        self.fig = None
+        self.ax = None
+        self._artists = []
+        self._colorbar_key = None
+        self._layout_bbox = None
+
+    def _get_bbox_inches(self):
+        """
+        Recorte de la figura, idéntico al de bbox_inches='tight'.
+
+        Con 'tight' savefig hace en cada fotograma un dibujo extra (sin rasterizar) para
+        calcular el recorte. Entre fotogramas de una figura sólo cambia el título, así que el
+        recorte del resto (mapa, ejes, cuadrícula y barra de colores) se calcula con el primero
+        y en los siguientes se une a la extensión del título, que no necesita dibujar la figura.
+        """
+        if not getattr(settings, 'WRF_IMG_FIXED_LAYOUT', True):
+            return 'tight'
+
+        renderer = self.fig.canvas.get_renderer()
+        pad_inches = plt.rcParams['savefig.pad_inches']
+        title = self.ax.title
+        if self._layout_bbox is None:
+            with span('layout'):
+                self.fig.draw_without_rendering()
+                title.set_visible(False)
+                try:
+                    self._layout_bbox = self.fig.get_tightbbox(renderer)
+                finally:
+                    title.set_visible(True)
+                # Con el título oculto get_tightbbox lo descoloca; calcularlo visible lo repone
+                return self.fig.get_tightbbox(renderer).padded(pad_inches)
+
+        # Mismas operaciones que Figure.get_tightbbox y savefig (unión, pulgadas y margen)
+        title_bbox = TransformedBbox(title.get_window_extent(renderer), Affine2D().scale(1 / self.fig.dpi))
+        return Bbox.union([self._layout_bbox, title_bbox]).padded(pad_inches)
+
+    def _draw(self, var_frame, u_frame, v_frame):
+        return draw_plot(
+            self.ax, self.var_name, self.plot_config,
+            self.lats, self.longs, var_frame,
+            u_frame, v_frame, self.geometry
+        )
+
+    def _remove_artists(self):
+        for artist in self._artists:
+            artist.remove()
+        self._artists = []
+
+
+def get_frame_renderer(var_name, lats, longs, initial_datetime, grid_key):
+    """
+    MeteoFrameRenderer compartido por las llamadas de un mismo proceso (workers del pool o
+    de Celery, que reciben los fotogramas de uno en uno). Se crea uno nuevo al cambiar la
+    variable, la malla (grid_key) o el ciclo.
+    """
+    global _frame_renderer
+    key = (var_name, grid_key, initial_datetime)
+    if _frame_renderer is None or _frame_renderer[0] != key:
+        if _frame_renderer is not None:
+            _frame_renderer[1].close()
+        _frame_renderer = (key, MeteoFrameRenderer(var_name, lats, longs, initial_datetime))
+    return _frame_renderer[1]
+
+
+def _get_positions(ax):
+    return ax.get_position(original=True), ax.get_position(original=False)
+
+
+def _set_positions(ax, positions):
+    original, active = positions
+    ax._set_position(original, which='original')
+    ax._set_position(active, which='active')
+
+
+def _get_colorbar_key(contour):
+    # Lo que determina el dibujo de la barra de colores de un contourf
+    return (
+        tuple(np.asarray(contour.levels).tolist()), contour.norm.vmin, contour.norm.vmax,
+        contour.extend, contour.cmap.name,
+    )
 
 
 def setup_figure(lats, longs, var_name=None):
-    fig = plt.figure(figsize=(12, 8))  # , frameon=False Para el borde transparente
+    fig = plt.figure(figsize=FIGSIZE, dpi=DPI)  # , frameon=False Para el borde transparente
 
     # Configurar fondo negro para variables de nubosidad
-    if var_name in ['clflo', 'clfmi', 'clfhi']:
+    if var_name in CLOUD_VARIABLES:
         # fig.patch.set_facecolor('black')
         # plt.rcParams['savefig.facecolor'] = 'black'
         plt.rcParams['axes.facecolor'] = 'black'
@@ -153,22 +648,15 @@ def setup_figure(lats, longs, var_name=None):
     ax = plt.axes(projection=ccrs.PlateCarree())
 
     # Configurar fondo del eje para variables de nubosidad
-    if var_name in ['clflo', 'clfmi', 'clfhi']:
+    if var_name in CLOUD_VARIABLES:
         ax.set_facecolor('white')  # Fondo del mapa en blanco para contraste
 
     # Ajustar extensión del mapa al área de los datos
-    ax.set_extent([
-        np.min(longs), np.max(longs),
-        np.min(lats), np.max(lats)
-    ], crs=ccrs.PlateCarree())
-
-    # Configuración del mapa
-    resolution = '10m'
-    ax.add_feature(cfeature.LAND.with_scale(resolution), facecolor='#f5f5f5')
-    ax.add_feature(cfeature.OCEAN.with_scale(resolution), facecolor='#c8e4ff')
-    ax.add_feature(cfeature.COASTLINE.with_scale(resolution), linewidth=0.8)
-    ax.add_feature(cfeature.BORDERS.with_scale(resolution), linestyle=':', linewidth=0.5)
-    ax.add_feature(cfeature.STATES.with_scale(resolution), linewidth=0.3, edgecolor='gray')
+    extent = get_map_extent(lats, longs)
+    ax.set_extent(extent, crs=ccrs.PlateCarree())
+
+    # Mapa base (tierra, océano, costas, fronteras y provincias) rasterizado una vez por dominio
+    draw_basemap(ax, extent, FIGSIZE, DPI)
 
     plt.tight_layout(pad=0)
     fig.subplots_adjust(left=0.05, right=0.9, bottom=0.05, top=0.95)
@@ -176,7 +664,13 @@ def setup_figure(lats, longs, var_name=None):
     return fig, ax
 
 
-def draw_plot(ax, var_name, plot_config, lats, longs, var_data, times, frame_idx, u_data=None, v_data=None):
+def draw_plot(ax, var_name, plot_config, lats, longs, var_frame, u_frame=None, v_frame=None,
+              geometry=None, barbs=True):
+    # Malla ya proyectada a las coordenadas del mapa (se calcula una vez por malla)
+    if geometry is None:
+        geometry = get_grid_geometry(lats, longs, ax.projection)
+    x, y = geometry.x, geometry.y
+
     levels = plot_config.get('levels', 20)
     current_contour = None
     current_barbs = None
@@ -189,67 +683,70 @@ def draw_plot(ax, var_name, plot_config, lats, longs, var_data, times, frame_idx
         norm = BoundaryNorm(plot_config['levels'], cmap_custom.N)
 
         current_contour = ax.contourf(
-            longs, lats, var_data[frame_idx],
+            x, y, var_frame,
             levels=plot_config['levels'],
             cmap=cmap_custom,
             norm=norm,
             extend=plot_config['extend'],
-            transform=ccrs.PlateCarree()
+            transform=ax.transData
         )
 
     # Caso especial para dirección del viento (wd10)
     elif var_name == 'wd10':
         current_contour = ax.contourf(
-            longs, lats, var_data[frame_idx],
+            x, y, var_frame,
             cmap=plot_config['cmap'],
             levels=plot_config['levels'],
             extend=plot_config.get('extend', 'neither'),
-            transform=ccrs.PlateCarree()
+            transform=ax.transData
         )
 
-        step = 2
-        current_barbs = ax.barbs(
-            longs[::step, ::step], lats[::step, ::step],
-            u_data[frame_idx][::step, ::step],
-            v_data[frame_idx][::step, ::step],
-            length=6,
-            barb_increments={'half': 2, 'full': 4, 'flag': 20},
-            color=plot_config.get('barb_color'),
-            transform=ccrs.PlateCarree()
-        )
+        # Las teselas dibujan las barbas con la densidad de cada zoom (ver MeteoTileRenderer)
+        if barbs:
+            step = 2
+            barb_longs, barb_lats = geometry.subsample(step)
+            current_barbs = ax.barbs(
+                barb_longs, barb_lats,
+                u_frame[::step, ::step],
+                v_frame[::step, ::step],
+                length=6,
+                barb_increments={'half': 2, 'full': 4, 'flag': 20},
+                color=plot_config.get('barb_color'),
+                transform=ccrs.PlateCarree()
+            )
 
     # Caso para nubosidad (convertir a porcentaje)
-    elif var_name in ['clflo', 'clfmi', 'clfhi']:
+    elif var_name in CLOUD_VARIABLES:
         current_contour = ax.contourf(
-            longs, lats, var_data[frame_idx] * 100,
+            x, y, var_frame * 100,
             levels=levels,
             cmap=plot_config['cmap'],
             vmin=plot_config.get('vmin'),
             vmax=plot_config.get('vmax'),
             extend=plot_config.get('extend', 'neither'),
-            transform=ccrs.PlateCarree()
+            transform=ax.transData
         )
 
     # Para todas las demás variables
     else:
         current_contour = ax.contourf(
-            longs, lats, var_data[frame_idx],
+            x, y, var_frame,
             levels=levels,
             cmap=plot_config['cmap'],
             vmin=plot_config.get('vmin'),
             vmax=plot_config.get('vmax'),
             extend=plot_config.get('extend', 'neither'),
-            transform=ccrs.PlateCarree()
+            transform=ax.transData
         )
 
     # Añadir líneas de contorno para slp y PSFC
     if var_name in ['slp', 'PSFC']:
         current_contour_lines = ax.contour(
-            longs, lats, var_data[frame_idx],
+            x, y, var_frame,
             levels=np.arange(950, 1051, 2),
             colors='black',
             linewidths=0.5,
-            transform=ccrs.PlateCarree()
+            transform=ax.transData
         )
         ax.clabel(current_contour_lines, inline=True, fontsize=8, fmt='%1.0f hPa')
 
@@ -258,7 +755,7 @@ def draw_plot(ax, var_name, plot_config, lats, longs, var_data, times, frame_idx
 
 def setup_colorbar(fig, ax, contour, plot_config, var_name):
     # Configurar colorbar para nubosidad
-    if var_name in ['clflo', 'clfmi', 'clfhi']:
+    if var_name in CLOUD_VARIABLES:
         cbar = fig.colorbar(
             contour, ax=ax,
             orientation='vertical',
@@ -288,7 +785,7 @@ def setup_colorbar(fig, ax, contour, plot_config, var_name):
         cbar.ax.axhline(y=0.1, color='gray', linestyle='--', linewidth=0.5)
 
         # Configuración para nubosidad
-    if var_name in ['clflo', 'clfmi', 'clfhi']:
+    if var_name in CLOUD_VARIABLES:
         cbar.set_ticks(plot_config['levels'])
         cbar.set_ticklabels(plot_config['tick_labels'])
 
@@ -308,15 +805,17 @@ def setup_colorbar(fig, ax, contour, plot_config, var_name):
     return cbar
 
 
-def setup_axes(ax, plot_config, time_str, initial_dt_str, forecast_hour):
-    ax.set_xlabel('Longitud', fontsize=9, labelpad=8)
-    ax.set_ylabel('Latitud', fontsize=9, labelpad=8)
+def setup_axes(ax, plot_config, time_str, initial_dt_str, forecast_hour, gridlines=True):
+    gl = None
+    if gridlines:
+        ax.set_xlabel('Longitud', fontsize=9, labelpad=8)
+        ax.set_ylabel('Latitud', fontsize=9, labelpad=8)
 
-    gl = ax.gridlines(draw_labels=True, linestyle='--', alpha=0.5)
-    gl.top_labels = False
-    gl.right_labels = False
-    gl.xlabel_style = {'size': 8}
-    gl.ylabel_style = {'size': 8}
+        gl = ax.gridlines(draw_labels=True, linestyle='--', alpha=0.5)
+        gl.top_labels = False
+        gl.right_labels = False
+        gl.xlabel_style = {'size': 8}
+        gl.ylabel_style = {'size': 8}
 
     # Crear título con información completa
     title = (
@@ -324,6 +823,8 @@ def setup_axes(ax, plot_config, time_str, initial_dt_str, forecast_hour):
 
     ax.set_title(title, pad=12, fontsize=11)
 
+    return gl
+
 
 def generate_skewt(sounding_data):
     """Genera un diagrama Skew-T y Hodógrafo a partir de datos de sondeo"""
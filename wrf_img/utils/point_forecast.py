@@ -0,0 +1,227 @@
+"""
+Pronóstico en un punto a partir de los campos guardados (ver wrf_img.utils.field_store).
+
+La celda de la malla más cercana a un punto se busca con un KD-tree sobre las latitudes y
+longitudes de la malla, construido una vez por malla (ver get_grid_locator). El valor en el
+punto es el de esa celda o la interpolación bilineal de las cuatro celdas que lo rodean. Como
+el almacén está fragmentado por tiempo, la serie de un punto sólo lee un bloque de 2x2
+celdas de cada tiempo.
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from .field_store import TIME_FORMAT, get_field_store_path, open_field_store
+from .plot_config import get_plot_config
+from .render_engine import grid_signature
+
+EARTH_RADIUS_KM = 6371.0
+
+POINT_METHODS = ('nearest', 'bilinear')
+
+# KD-trees en memoria: {firma de la malla: GridLocator}
+MAX_CACHED_GRIDS = 4
+
+# Almacenes abiertos (la malla ya ubicada): {ruta: (fecha de modificación, StoreReader)}
+MAX_OPEN_STORES = 64
+
+_LOCATOR_CACHE = {}
+_OPEN_STORES = {}
+_locator_lock = threading.Lock()
+
+
+def to_cartesian(lats, longs):
+    """Coordenadas 3D en la esfera unidad (distancias sin la distorsión de lat/lon)"""
+    lats = np.radians(np.asarray(lats, dtype=float))
+    longs = np.radians(np.asarray(longs, dtype=float))
+    cos_lats = np.cos(lats)
+    return np.stack([cos_lats * np.cos(longs), cos_lats * np.sin(longs), np.sin(lats)], axis=-1)
+
+
+class PointLocation:
+    """
+    Posición de un punto en la malla: bloque de celdas (filas y columnas; 2x2 al interpolar,
+    1x1 con la celda más cercana) con el peso de cada celda, y la celda más cercana (j, i) con
+    su distancia en km
+    """
+
+    def __init__(self, rows, columns, weights, nearest, distance_km):
+        self.rows = rows
+        self.columns = columns
+        self.weights = weights
+        self.nearest = nearest
+        self.distance_km = distance_km
+
+
+class GridLocator:
+    """KD-tree de una malla del modelo para ubicar puntos (lat, lon) en ella"""
+
+    def __init__(self, lats, longs):
+        self.signature = grid_signature(lats, longs)
+        self.lats = np.asarray(lats, dtype=float)
+        self.longs = np.asarray(longs, dtype=float)
+        self.shape = self.lats.shape
+        if min(self.shape) < 2:
+            raise ValueError("La malla debe tener al menos 2x2 celdas")
+        points = to_cartesian(self.lats, self.longs)
+        self.tree = cKDTree(points.reshape(-1, 3))
+        # Un punto más lejos que dos celdas de la más cercana está fuera del dominio
+        spacing = np.linalg.norm(np.diff(points, axis=1), axis=-1)
+        self.max_distance = 2 * float(np.nanmedian(spacing))
+
+    def locate(self, lat, lon, method='bilinear'):
+        """PointLocation de un punto; ValueError si está fuera del dominio"""
+        if method not in POINT_METHODS:
+            raise ValueError(f"Método de interpolación no soportado: {method}")
+        distance, index = self.tree.query(to_cartesian(lat, lon))
+        if distance > self.max_distance:
+            raise ValueError(f"El punto ({lat}, {lon}) está fuera del dominio del modelo")
+        j, i = (int(index) for index in np.unravel_index(index, self.shape))
+        # Distancia de la cuerda en la esfera unidad, en km
+        distance_km = 2 * EARTH_RADIUS_KM * np.arcsin(min(1.0, distance / 2))
+        if method == 'nearest':
+            return PointLocation(slice(j, j + 1), slice(i, i + 1), np.ones((1, 1)), (j, i), distance_km)
+
+        j0, i0, ty, tx = self._fractional_index(lat, lon, j, i)
+        weights = np.array([[(1 - ty) * (1 - tx), (1 - ty) * tx], [ty * (1 - tx), ty * tx]])
+        return PointLocation(slice(j0, j0 + 2), slice(i0, i0 + 2), weights, (j, i), distance_km)
+
+    def _fractional_index(self, lat, lon, j, i):
+        # La malla es curvilínea (proyección del modelo): la posición dentro de la celda se
+        # obtiene invirtiendo la interpolación bilineal de lat/lon con unas iteraciones de
+        # Newton desde la celda más cercana. Las longitudes se escalan por cos(lat) (metros).
+        scale = np.cos(np.radians(lat))
+        target = np.array([lon * scale, lat])
+        fj, fi = float(j), float(i)
+        for _ in range(4):
+            j0 = int(np.clip(np.floor(fj), 0, self.shape[0] - 2))
+            i0 = int(np.clip(np.floor(fi), 0, self.shape[1] - 2))
+            ty, tx = fj - j0, fi - i0
+            corners = np.stack([
+                self.longs[j0:j0 + 2, i0:i0 + 2] * scale, self.lats[j0:j0 + 2, i0:i0 + 2]
+            ], axis=-1)
+            (p00, p01), (p10, p11) = corners
+            position = (1 - ty) * ((1 - tx) * p00 + tx * p01) + ty * ((1 - tx) * p10 + tx * p11)
+            jacobian = np.column_stack([
+                (1 - ty) * (p01 - p00) + ty * (p11 - p10),
+                (1 - tx) * (p10 - p00) + tx * (p11 - p01),
+            ])
+            try:
+                dx, dy = np.linalg.solve(jacobian, target - position)
+            except np.linalg.LinAlgError:
+                break
+            fi, fj = fi + dx, fj + dy
+            if abs(dx) < 1e-6 and abs(dy) < 1e-6:
+                break
+
+        j0 = int(np.clip(np.floor(fj), 0, self.shape[0] - 2))
+        i0 = int(np.clip(np.floor(fi), 0, self.shape[1] - 2))
+        # En el borde del dominio el punto puede quedar algo fuera de la última celda
+        return j0, i0, float(np.clip(fj - j0, 0, 1)), float(np.clip(fi - i0, 0, 1))
+
+
+def get_grid_locator(lats, longs):
+    """Retorna el GridLocator de una malla, construyendo su KD-tree la primera vez"""
+    signature = grid_signature(lats, longs)
+    with _locator_lock:
+        locator = _LOCATOR_CACHE.get(signature)
+    if locator is None:
+        locator = GridLocator(lats, longs)
+        with _locator_lock:
+            if len(_LOCATOR_CACHE) >= MAX_CACHED_GRIDS:
+                _LOCATOR_CACHE.pop(next(iter(_LOCATOR_CACHE)))
+            _LOCATOR_CACHE[signature] = locator
+    return locator
+
+
+class StoreReader:
+    """Almacén de una variable abierto, con el GridLocator de su malla y sus tiempos"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.locator = get_grid_locator(dataset['lat'].values, dataset['lon'].values)
+        self.times = list(pd.DatetimeIndex(dataset['time'].values).strftime(TIME_FORMAT))
+
+
+def get_store_reader(simulation, var_name):
+    """
+    StoreReader del almacén de una variable. Los almacenes quedan abiertos entre consultas
+    (hasta MAX_OPEN_STORES) y se vuelven a abrir si el fichero cambió; LookupError si la
+    variable no tiene campos guardados.
+    """
+    path = get_field_store_path(simulation, var_name)
+    if path is None:
+        raise LookupError(f"No hay campos guardados de la variable {var_name}")
+    modified = os.stat(path).st_mtime_ns
+    with _locator_lock:
+        entry = _OPEN_STORES.get(path)
+    if entry is not None and entry[0] == modified:
+        return entry[1]
+
+    reader = StoreReader(open_field_store(simulation, var_name))
+    with _locator_lock:
+        # Se cierran el almacén anterior del mismo fichero y el más antiguo si no hay sitio
+        stale = [_OPEN_STORES.pop(path, None)]
+        if len(_OPEN_STORES) >= MAX_OPEN_STORES:
+            stale.append(_OPEN_STORES.pop(next(iter(_OPEN_STORES))))
+        _OPEN_STORES[path] = (modified, reader)
+    for entry in stale:
+        if entry is not None:
+            entry[1].dataset.close()
+    return reader
+
+
+def get_location(locator, lat, lon, method, station=None, town=None):
+    """PointLocation de un punto, del índice de la malla si es una estación o un municipio"""
+    from .grid_index import get_index_location, get_point_index
+
+    if station is not None or town is not None:
+        point_index = get_point_index(locator.signature, station=station, town=town)
+        # Si el punto se movió después de calcular el índice se vuelve a ubicar
+        if point_index is not None and (point_index.latitude, point_index.longitude) == (lat, lon):
+            return get_index_location(point_index, method)
+    return locator.locate(lat, lon, method)
+
+
+def extract_point_series(dataset, name, location):
+    """Serie temporal del campo name en el punto: sólo se lee el bloque de celdas de cada tiempo"""
+    block = np.asarray(dataset[name].variable[:, location.rows, location.columns].values, dtype=float)
+    used = location.weights > 0
+    return block[:, used] @ location.weights[used]
+
+
+def get_point_forecast(simulation, var_names, lat, lon, method='bilinear', station=None, town=None):
+    """
+    Pronóstico de las variables en un punto: {'times', 'grid_point', 'series'}, con los
+    valores en las unidades de las imágenes (ver PLOT_CONFIGS). LookupError si una variable
+    no tiene campos guardados y ValueError si el punto está fuera del dominio. La posición
+    de una estación o un municipio se toma de su GridPointIndex si la malla está indexada.
+    """
+    times = None
+    grid_point = None
+    series = {}
+    for var_name in var_names:
+        reader = get_store_reader(simulation, var_name)
+        location = get_location(reader.locator, lat, lon, method, station, town)
+        values = extract_point_series(reader.dataset, var_name, location)
+        if times is None:
+            times = reader.times
+
+        plot_config = get_plot_config(var_name)
+        values = values * plot_config.get('scale_factor', 1)
+        series[var_name] = {
+            'units': plot_config.get('units'),
+            'values': [None if np.isnan(value) else round(float(value), 3) for value in values],
+        }
+        if grid_point is None:
+            j, i = location.nearest
+            grid_point = {
+                'j': j, 'i': i,
+                'lat': float(reader.locator.lats[j, i]), 'lon': float(reader.locator.longs[j, i]),
+                'distance_km': round(float(location.distance_km), 3),
+            }
+
+    return {'times': times, 'grid_point': grid_point, 'series': series}
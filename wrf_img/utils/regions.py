@@ -0,0 +1,289 @@
+"""
+Valores de las variables por municipio y provincia.
+
+Province y Town no tienen contornos, sólo la posición de cada municipio: cada celda de la
+malla se asigna al municipio más cercano (a menos de WRF_IMG_REGION_MAX_KM; más lejos, en el
+mar, no pertenece a ninguno) y una provincia son las celdas de sus municipios. Las máscaras se
+calculan una vez por malla con un KD-tree y se guardan como mapas de bits en RegionMask (ver
+ensure_region_masks); add_stations_data las reconstruye para la malla más reciente.
+
+Con las máscaras de una malla se arma una matriz dispersa (regiones, celdas): la media
+ponderada por área y la suma de todas las regiones en todos los fotogramas de un lote salen de
+un solo producto de matrices; el máximo, de un reduceat sobre las celdas ordenadas por región
+(las regiones de cada tipo no se solapan). Los resultados se guardan en RegionAggregate al
+guardar los campos de la simulación (ver FieldStoreWriter.commit).
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from station_data.models import Town
+from wrf_img.models import RegionAggregate, RegionMask, Simulation
+from .field_stats import get_cell_areas
+from .field_store import TIME_FORMAT, load_field_grid, open_field_store
+from .point_forecast import EARTH_RADIUS_KM, get_grid_locator, to_cartesian
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+# Tipos de región: campo de RegionMask y RegionAggregate
+REGION_FIELDS = ('province', 'town')
+
+# Variables sin agregados: la media de una dirección no tiene sentido
+EXCLUDED_VARIABLES = {'wd10'}
+
+# Fotogramas que se leen del almacén y se agregan juntos
+REGION_BATCH_FRAMES = 24
+
+# Matrices de las regiones en memoria: {firma de la malla: (versión de las máscaras, RegionMatrix)}
+MAX_CACHED_GRIDS = 4
+
+_MATRIX_CACHE = {}
+_matrix_lock = threading.Lock()
+
+
+def build_region_masks(lats, longs):
+    """Reconstruye las máscaras de todos los municipios y provincias en una malla; retorna las filas"""
+    locator = get_grid_locator(lats, longs)
+    towns = list(Town.objects.all())
+    shape = locator.shape
+    labels = np.full(shape[0] * shape[1], -1)
+    if towns:
+        # Municipio más cercano de cada celda
+        tree = cKDTree(to_cartesian([town.latitude for town in towns], [town.longitude for town in towns]))
+        distance, nearest = tree.query(to_cartesian(locator.lats, locator.longs).reshape(-1, 3))
+        max_km = float(getattr(settings, 'WRF_IMG_REGION_MAX_KM', 25))
+        inside = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(1.0, distance / 2)) <= max_km
+        labels[inside] = nearest[inside]
+
+    areas = get_cell_areas(lats, longs).ravel()
+    rows = []
+
+    def add_mask(field, place, mask):
+        if mask.any():
+            rows.append(RegionMask(
+                grid_signature=locator.signature,
+                mask=np.packbits(mask).tobytes(),
+                cell_count=int(mask.sum()),
+                area_km2=round(float(areas[mask].sum()), 1),
+                **{field: place},
+            ))
+
+    provinces = {}
+    for k, town in enumerate(towns):
+        add_mask('town', town, labels == k)
+        if town.province is not None:
+            provinces.setdefault(town.province, []).append(k)
+    for province, indexes in provinces.items():
+        add_mask('province', province, np.isin(labels, indexes))
+
+    with span('db'), transaction.atomic():
+        RegionMask.objects.filter(grid_signature=locator.signature).delete()
+        RegionMask.objects.bulk_create(rows)
+    logger.info(f"Máscaras de la malla {locator.signature}: {len(rows)} regiones")
+    return rows
+
+
+def ensure_region_masks(lats, longs):
+    """Construye las máscaras de una malla si todavía no existen"""
+    signature = get_grid_locator(lats, longs).signature
+    if not RegionMask.objects.filter(grid_signature=signature).exists():
+        build_region_masks(lats, longs)
+
+
+def refresh_region_masks():
+    """
+    Reconstruye las máscaras de la malla de la simulación más reciente con campos guardados
+    (por ejemplo al añadir municipios). Retorna las filas o None si no hay malla.
+    """
+    for simulation in Simulation.objects.exclude(field_store='').order_by('-initial_datetime'):
+        grid = load_field_grid(simulation)
+        if grid is not None:
+            return build_region_masks(*grid)
+    return None
+
+
+class RegionMatrix:
+    """
+    Regiones de una malla como matrices: matrix (2 x regiones, celdas) con el área de cada
+    celda y con unos, para la media y la suma en un producto de matrices, y el orden de las
+    celdas por región de cada tipo para el máximo
+    """
+
+    def __init__(self, lats, longs):
+        self.signature = get_grid_locator(lats, longs).signature
+        masks = list(RegionMask.objects.filter(grid_signature=self.signature).order_by('pk'))
+        cells = lats.size
+        # (campo, id de la provincia o el municipio) de cada fila
+        self.regions = [
+            ('province', mask.province_id) if mask.province_id else ('town', mask.town_id) for mask in masks
+        ]
+        # Celdas de cada región
+        members = [
+            np.flatnonzero(np.unpackbits(np.frombuffer(bytes(mask.mask), dtype=np.uint8), count=cells))
+            for mask in masks
+        ]
+        counts = [len(region_cells) for region_cells in members]
+        indicator = sparse.csr_matrix(
+            (np.ones(sum(counts)), (np.repeat(np.arange(len(masks)), counts), np.concatenate(members or [[]]))),
+            shape=(len(masks), cells),
+        )
+        areas = get_cell_areas(lats, longs).ravel()
+        # Filas de la media ponderada (área) seguidas de las de la suma (uno por celda)
+        self.matrix = sparse.vstack([indicator.multiply(areas[np.newaxis]), indicator]).tocsr()
+
+        # Para el máximo: por tipo, las celdas ordenadas por región y el inicio de cada una
+        self.layers = []
+        for field in REGION_FIELDS:
+            layer = [k for k, region in enumerate(self.regions) if region[0] == field]
+            if not layer:
+                continue
+            order = np.concatenate([members[k] for k in layer])
+            starts = np.cumsum([0] + [counts[k] for k in layer[:-1]])
+            self.layers.append((np.array(layer), order, starts))
+
+    def __len__(self):
+        return len(self.regions)
+
+    def aggregate(self, fields):
+        """
+        Media, máximo y suma de cada región en los fotogramas de fields (fotogramas, ny, nx):
+        tres arrays (regiones, fotogramas)
+        """
+        values = np.asarray(fields, dtype=float).reshape(len(fields), -1)
+        finite = np.isfinite(values)
+        regions = len(self)
+        # Un producto para las dos: sumas ponderadas por área y sumas simples
+        sums = self.matrix @ np.where(finite, values, 0).T
+        if finite.all():
+            weights = np.asarray(self.matrix.sum(axis=1))
+        else:
+            weights = self.matrix @ finite.T.astype(float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = sums[:regions] / weights[:regions]
+        total = sums[regions:]
+
+        maximum = np.full((regions, len(values)), np.nan)
+        masked = np.where(finite, values, -np.inf)
+        for members, order, starts in self.layers:
+            maximum[members] = np.maximum.reduceat(masked[:, order], starts, axis=1).T
+        maximum[np.isneginf(maximum)] = np.nan
+        return mean, maximum, total
+
+
+def get_region_matrix(lats, longs):
+    """
+    Retorna la RegionMatrix de una malla (con sus máscaras construidas si no existían). La
+    matriz en memoria se vuelve a armar si las máscaras cambiaron, también en otro proceso.
+    """
+    ensure_region_masks(lats, longs)
+    signature = get_grid_locator(lats, longs).signature
+    version = RegionMask.objects.filter(grid_signature=signature).aggregate(
+        count=Count('pk'), updated_at=Max('updated_at')
+    )
+    with _matrix_lock:
+        entry = _MATRIX_CACHE.get(signature)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    matrix = RegionMatrix(np.asarray(lats), np.asarray(longs))
+    with _matrix_lock:
+        _MATRIX_CACHE.pop(signature, None)
+        if len(_MATRIX_CACHE) >= MAX_CACHED_GRIDS:
+            _MATRIX_CACHE.pop(next(iter(_MATRIX_CACHE)))
+        _MATRIX_CACHE[signature] = (version, matrix)
+    return matrix
+
+
+def update_region_aggregates(simulation, var_name):
+    """
+    Calcula los agregados por región de una variable a partir de sus campos guardados y
+    reemplaza sus filas de RegionAggregate. Retorna las filas guardadas.
+    """
+    if var_name in EXCLUDED_VARIABLES:
+        return []
+    dataset = open_field_store(simulation, var_name)
+    if dataset is None:
+        return []
+    with dataset:
+        matrix = get_region_matrix(dataset['lat'].values, dataset['lon'].values)
+        if not len(matrix):
+            return []
+        times = list(pd.DatetimeIndex(dataset['time'].values).strftime(TIME_FORMAT))
+        variable = dataset[var_name].variable
+        results = []
+        with span('stats'):
+            for start in range(0, len(times), REGION_BATCH_FRAMES):
+                results.append(matrix.aggregate(variable[start:start + REGION_BATCH_FRAMES].values))
+        mean, maximum, total = (np.concatenate(parts, axis=1) for parts in zip(*results))
+
+    aggregates = [
+        RegionAggregate(
+            simulation=simulation, variable_name=var_name, times=times,
+            mean=_to_list(mean[k]), maximum=_to_list(maximum[k]), total=_to_list(total[k]),
+            **{f'{field}_id': pk},
+        )
+        for k, (field, pk) in enumerate(matrix.regions)
+    ]
+    with span('db'), transaction.atomic():
+        RegionAggregate.objects.filter(simulation=simulation, variable_name=var_name).delete()
+        RegionAggregate.objects.bulk_create(aggregates)
+    return aggregates
+
+
+def _to_list(values):
+    return [None if np.isnan(value) else round(float(value), 4) for value in values]
+
+
+def get_region_forecast(simulation, var_names, province=None, town=None, hours=None):
+    """
+    Media, máximo y suma de las variables en una provincia o un municipio (todas las
+    provincias si no se indica ninguno), en las unidades de las imágenes: {'times', 'regions'}.
+    Con hours sólo se incluyen los tiempos hasta hours horas después del inicio. LookupError
+    si una variable no tiene agregados.
+    """
+    from .plot_config import get_plot_config
+
+    times = None
+    regions = {}
+    for var_name in var_names:
+        aggregates = RegionAggregate.objects.filter(
+            simulation=simulation, variable_name=var_name
+        ).select_related('province', 'town')
+        if town is not None:
+            aggregates = aggregates.filter(town=town)
+        elif province is not None:
+            aggregates = aggregates.filter(province=province)
+        else:
+            aggregates = aggregates.filter(province__isnull=False)
+        aggregates = list(aggregates)
+        if not aggregates:
+            raise LookupError(f"No hay agregados por región de la variable {var_name}")
+
+        if times is None:
+            times = aggregates[0].times
+            if hours is not None:
+                # Los tiempos válidos están en la zona horaria del proyecto, sin zona
+                end = timezone.localtime(simulation.initial_datetime).replace(tzinfo=None) + timedelta(hours=hours)
+                times = [t for t in times if datetime.strptime(t, TIME_FORMAT) <= end]
+        plot_config = get_plot_config(var_name)
+        scale_factor = plot_config.get('scale_factor', 1)
+        for aggregate in aggregates:
+            place = aggregate.province or aggregate.town
+            field = 'province' if aggregate.province_id else 'town'
+            region = regions.setdefault((field, place.pk), {field: place.pk, 'name': str(place), 'series': {}})
+            region['series'][var_name] = {'units': plot_config.get('units')}
+            for key, values in (('mean', aggregate.mean), ('max', aggregate.maximum), ('sum', aggregate.total)):
+                region['series'][var_name][key] = [
+                    None if value is None else round(value * scale_factor, 3) for value in values[:len(times)]
+                ]
+    return {'times': times, 'regions': list(regions.values())}
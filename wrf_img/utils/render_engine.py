@@ -0,0 +1,206 @@
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from .timing import StageTimings, record
+
+logger = logging.getLogger(__name__)
+
+# Arrays abiertos en cada proceso del pool: {ruta: array en memoria compartida}
+_WORKER_ARRAYS = {}
+
+
+class RenderEngine:
+    """
+    Motor de renderizado paralelo de fotogramas.
+
+    Reparte los fotogramas de una o varias variables entre un ProcessPoolExecutor.
+    Los arrays se comparten con los procesos como ficheros .npy en memoria compartida
+    (tmpfs) abiertos con memory-mapping, de modo que no se serializan en cada tarea.
+    Los procesos sólo renderizan; las imágenes vuelven al proceso principal, que es
+    el único que escribe en la base de datos.
+
+    Uso:
+        with RenderEngine(workers=16) as engine:
+            jobs = [MeteoPlotJob(datetime_init, var, engine=engine) for var in variables]
+            for job in jobs:
+                job.save()
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = getattr(settings, 'WRF_IMG_RENDER_WORKERS', 1)
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self._executor = None
+        self._shared_dir = None
+        self._grids = {}
+        self._counter = itertools.count()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def start(self):
+        if self._executor is None:
+            self._shared_dir = tempfile.mkdtemp(prefix='wrf_img_', dir=_get_shared_memory_dir())
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=_get_mp_context(), initializer=_init_worker
+            )
+            logger.info(f"Motor de renderizado iniciado con {self.workers} procesos")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._shared_dir is not None:
+            shutil.rmtree(self._shared_dir, ignore_errors=True)
+            self._shared_dir = None
+        self._grids = {}
+
+    def share(self, array, name):
+        """Copia el array a memoria compartida y retorna la ruta con la que lo abren los procesos"""
+        path = os.path.join(self._shared_dir, f"{name}.npy")
+        np.save(path, np.ascontiguousarray(array))
+        return path
+
+    def share_grid(self, lats, longs):
+        """Comparte la malla una sola vez por dominio"""
+        signature = grid_signature(lats, longs)
+        if signature not in self._grids:
+            self._grids[signature] = (
+                self.share(lats, f"lats_{signature}"),
+                self.share(longs, f"longs_{signature}"),
+            )
+        return self._grids[signature]
+
+    def submit(self, var_name, lats, longs, times, initial_datetime, frames):
+        """
+        Encola los fotogramas de una variable, recibidos como (índice, var, u, v) con
+        campos 2D (ver iter_payload_frames), y retorna un iterador de (índice, {formato: bytes},
+        teselas) en el orden de los fotogramas (teselas es None si no se generan, ver
+        render_frame_tiles).
+
+        Cada fotograma se copia a memoria compartida en cuanto llega, de modo que el
+        proceso principal no conserva el array 3D completo.
+        """
+        self.start()
+        grid_paths = self.share_grid(lats, longs)
+        prefix = f"{var_name}_{next(self._counter)}"
+
+        futures = []
+        data_paths = []
+        try:
+            for i, var_frame, u_frame, v_frame in frames:
+                frame_paths = [self.share(var_frame, f"{prefix}_{i}_var")]
+                if u_frame is not None and v_frame is not None:
+                    frame_paths += [
+                        self.share(u_frame, f"{prefix}_{i}_u"),
+                        self.share(v_frame, f"{prefix}_{i}_v"),
+                    ]
+                data_paths.append(frame_paths)
+                futures.append(self._executor.submit(
+                    _render_task, var_name, grid_paths, frame_paths,
+                    times[i], initial_datetime, i
+                ))
+        except Exception:
+            self._discard(futures, data_paths)
+            raise
+
+        return self._collect(futures, data_paths)
+
+    def _collect(self, futures, data_paths):
+        try:
+            for future, frame_paths in zip(futures, data_paths):
+                frame_idx, images, tiles, timings = future.result()
+                _remove_files(frame_paths)
+                # Tiempos medidos en el proceso del pool
+                record(timings)
+                yield frame_idx, images, tiles
+        finally:
+            self._discard(futures, data_paths)
+
+    def _discard(self, futures, data_paths):
+        for future in futures:
+            future.cancel()
+        for frame_paths in data_paths:
+            _remove_files(frame_paths)
+
+
+def grid_signature(lats, longs):
+    """Firma corta que identifica una malla (forma y coordenadas)"""
+    digest = hashlib.sha1()
+    digest.update(repr((lats.shape, longs.shape)).encode())
+    digest.update(np.ascontiguousarray(lats).tobytes())
+    digest.update(np.ascontiguousarray(longs).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _get_mp_context():
+    # Los procesos se crean en el primer submit, con los hilos de la descarga y del bloqueo del
+    # ciclo ya en marcha: con 'fork' heredarían los locks que tengan tomados (logging, urllib3,
+    # redis). 'forkserver' (o 'spawn') arranca procesos limpios.
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _get_shared_memory_dir():
+    shared_dir = getattr(settings, 'WRF_IMG_RENDER_SHM_DIR', None)
+    if shared_dir and os.path.isdir(shared_dir):
+        return shared_dir
+    return None
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _init_worker():
+    # Con 'forkserver' o 'spawn' los procesos no heredan la configuración de Django
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _open_shared(path):
+    array = _WORKER_ARRAYS.get(path)
+    if array is None:
+        array = np.load(path, mmap_mode='r')
+        _WORKER_ARRAYS[path] = array
+    return array
+
+
+def _render_task(var_name, grid_paths, data_paths, time_str, initial_datetime, frame_idx):
+    from .plot_generators import get_frame_renderer
+    from .tiles import render_frame_tiles
+
+    lats, longs = (_open_shared(path) for path in grid_paths)
+    arrays = [np.load(path, mmap_mode='r') for path in data_paths]
+    var_frame = arrays[0]
+    u_frame, v_frame = (arrays[1], arrays[2]) if len(arrays) == 3 else (None, None)
+
+    # Cada proceso reutiliza la figura mientras recibe fotogramas de la misma variable
+    timings = StageTimings()
+    with timings.activate():
+        renderer = get_frame_renderer(var_name, lats, longs, initial_datetime, tuple(grid_paths))
+        images = renderer.render_images(time_str, var_frame, u_frame, v_frame)
+        tiles = render_frame_tiles(var_name, lats, longs, tuple(grid_paths), var_frame, u_frame, v_frame)
+    return frame_idx, images, tiles, timings.as_dict()
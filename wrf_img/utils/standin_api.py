@@ -0,0 +1,176 @@
+"""
+Servidor local que imita la API de datos del modelo (/api/data/).
+
+Genera campos sintéticos con la misma estructura que la API real para poder
+probar la descarga y la generación de imágenes sin conexión:
+
+    with StandInModelAPI(grid_shape=(70, 180), frames=4) as api:
+        client = ModelDataClient(base_url=api.url)
+
+Por defecto sólo responde en JSON, como la API real; con formats=('json', 'npz', 'raw')
+también sirve los formatos binarios según la cabecera Accept.
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from .model_api import (
+    CONTENT_TYPE_JSON, CONTENT_TYPE_NPZ, CONTENT_TYPE_RAW, WIND_VARIABLES, encode_npz, encode_raw_arrays,
+)
+
+# Dominio aproximado del modelo (Cuba)
+DEFAULT_EXTENT = (-85.0, -73.5, 19.5, 23.5)
+
+# Valor base y amplitud de los campos sintéticos por variable
+SYNTHETIC_FIELDS = {
+    'T2': (27.0, 6.0),
+    'td2': (22.0, 4.0),
+    'rh2': (70.0, 25.0),
+    'RAINC': (10.0, 10.0),
+    'RAINC3H': (3.0, 3.0),
+    'slp': (1012.0, 8.0),
+    'PSFC': (1008.0, 8.0),
+    'ws10': (20.0, 15.0),
+    'wd10': (180.0, 170.0),
+    'clflo': (0.5, 0.5),
+    'clfmi': (0.5, 0.5),
+    'clfhi': (0.5, 0.5),
+}
+
+def build_synthetic_grid(grid_shape=(70, 180), extent=DEFAULT_EXTENT):
+    """Retorna las mallas 2D (lats, longs) del dominio"""
+    rows, cols = grid_shape
+    longs, lats = np.meshgrid(
+        np.linspace(extent[0], extent[1], cols),
+        np.linspace(extent[2], extent[3], rows),
+    )
+    return lats, longs
+
+
+def build_synthetic_times(datetime_init, frames, step_hours=1):
+    start = datetime.strptime(datetime_init, '%Y%m%d%H')
+    return [(start + timedelta(hours=step_hours * i)).strftime('%Y-%m-%dT%H:%M:%S') for i in range(frames)]
+
+
+def build_synthetic_field(var_name, lats, longs, frames, seed=0):
+    """Campo 3D (tiempo, y, x) con estructura espacial suave que se desplaza en el tiempo"""
+    base, amplitude = SYNTHETIC_FIELDS.get(var_name, (0.0, 1.0))
+    rng = np.random.default_rng(seed)
+    phase = np.arange(frames)[:, None, None] / 3.0
+    field = base + amplitude * np.sin(longs / 2.0 + phase) * np.cos(lats / 1.5 - phase)
+    field = field + rng.normal(0.0, amplitude * 0.02, size=field.shape)
+    if var_name.startswith('RAINC') or var_name in ('ws10', 'rh2') or var_name.startswith('clf'):
+        field = np.clip(field, 0.0, None)
+    return field
+
+
+def build_synthetic_payload(datetime_init, var_name, grid_shape=(70, 180), frames=4, extent=DEFAULT_EXTENT):
+    """Diccionario con la misma estructura que la respuesta JSON de la API"""
+    lats, longs = build_synthetic_grid(grid_shape, extent)
+    payload = {
+        'lats': lats,
+        'longs': longs,
+        'times': build_synthetic_times(datetime_init, frames),
+        'var': build_synthetic_field(var_name, lats, longs, frames),
+    }
+    if var_name in WIND_VARIABLES:
+        direction = np.deg2rad(payload['var'])
+        speed = build_synthetic_field('ws10', lats, longs, frames, seed=1) / 3.6
+        payload['U10'] = -speed * np.sin(direction)
+        payload['V10'] = -speed * np.cos(direction)
+    return payload
+
+
+def encode_json(payload):
+    """Serializa el payload como JSON (formato de la API real)"""
+    return json.dumps({
+        key: value.tolist() if isinstance(value, np.ndarray) else value
+        for key, value in payload.items()
+    }).encode()
+
+
+class StandInModelAPI:
+    """Servidor HTTP local en un hilo que responde como la API del modelo"""
+
+    def __init__(self, grid_shape=(70, 180), frames=4, extent=DEFAULT_EXTENT, formats=('json',),
+                 host='127.0.0.1', port=0):
+        self.grid_shape = grid_shape
+        self.frames = frames
+        self.extent = extent
+        self.formats = formats
+        self.requests = []
+        self._payloads = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/api/data/'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def get_payload(self, datetime_init, var_name):
+        key = (datetime_init, var_name)
+        with self._lock:
+            if key not in self._payloads:
+                self._payloads[key] = build_synthetic_payload(
+                    datetime_init, var_name, self.grid_shape, self.frames, self.extent
+                )
+            return self._payloads[key]
+
+    def render_response(self, payload, accept):
+        """Serializa el payload en el formato preferido por el cliente entre los soportados"""
+        if 'raw' in self.formats and CONTENT_TYPE_RAW in accept:
+            return CONTENT_TYPE_RAW, encode_raw_arrays(payload)
+        if 'npz' in self.formats and CONTENT_TYPE_NPZ in accept:
+            return CONTENT_TYPE_NPZ, encode_npz(payload)
+        return CONTENT_TYPE_JSON, encode_json(payload)
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                datetime_init = query.get('datetime_init', [''])[0]
+                var_name = query.get('var_name', [''])[0]
+                with api._lock:
+                    api.requests.append((datetime_init, var_name))
+
+                try:
+                    datetime.strptime(datetime_init, '%Y%m%d%H')
+                except ValueError:
+                    self.send_error(400, 'datetime_init inválido')
+                    return
+
+                payload = api.get_payload(datetime_init, var_name)
+                content_type, body = api.render_response(payload, self.headers.get('Accept', ''))
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
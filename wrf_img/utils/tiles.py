@@ -0,0 +1,255 @@
+"""
+Teselas XYZ (Web Mercator) de la capa de datos de cada fotograma.
+
+Además de la imagen completa del dominio, cada fotograma se puede renderizar como una
+pirámide de teselas de TILE_SIZE píxeles para los zooms de WRF_IMG_TILE_ZOOMS, sólo con los
+contornos y barbas (sin mapa base, ejes ni barra de colores) y con fondo transparente, para
+superponerla en un visor web. Las teselas sin datos no se escriben; el endpoint de teselas
+responde por ellas con una tesela transparente (ver wrf_img.views.meteo_tile).
+"""
+import io
+import math
+import shutil
+import uuid
+from functools import lru_cache
+
+import cartopy.crs as ccrs
+import numpy as np
+from django.conf import settings
+from django.core.files.storage import default_storage
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+from .grid_geometry import get_grid_geometry
+from .image_encoder import encode_png, get_png_colors, render_rgba
+from .plot_config import get_plot_config
+from .timing import span
+
+# Proyección de las teselas (EPSG:3857) y mitad del ancho del mundo en metros
+WEB_MERCATOR = ccrs.Mercator.GOOGLE
+MERCATOR_HALF_WIDTH = 20037508.342789244
+
+TILE_SIZE = 256
+MAX_ZOOM = 18
+
+# Teselas por lado de cada bloque rasterizado (limita la memoria del buffer RGBA)
+TILE_BLOCK = 8
+
+# Separación aproximada entre barbas de viento en píxeles, en todos los zooms
+BARB_SPACING = 25
+
+# Renderer reutilizado entre fotogramas en los procesos de render (ver get_tile_renderer)
+_tile_renderer = None
+
+
+def get_tile_zooms():
+    """Zooms de WRF_IMG_TILE_ZOOMS ('5-8' o '5,6,8'); lista vacía si no se generan teselas"""
+    zooms = set()
+    for part in str(getattr(settings, 'WRF_IMG_TILE_ZOOMS', '')).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        zooms.update(range(int(first), int(last or first) + 1))
+    if any(zoom < 0 or zoom > MAX_ZOOM for zoom in zooms):
+        raise ValueError(f"Los zooms de las teselas deben estar entre 0 y {MAX_ZOOM}")
+    return sorted(zooms)
+
+
+def get_tile_signature():
+    """Parámetros de las teselas (forman parte del hash de cada imagen, ver get_render_key)"""
+    return repr((get_tile_zooms(), TILE_SIZE, get_png_colors()))
+
+
+def get_tile_range(bounds, zoom):
+    """
+    Teselas (x_min, y_min, x_max, y_max) del zoom que cubren bounds, la extensión
+    (x_min, y_min, x_max, y_max) en metros de Web Mercator
+    """
+    count = 2 ** zoom
+    size = 2 * MERCATOR_HALF_WIDTH / count
+
+    def index(offset):
+        return min(count - 1, max(0, int(math.floor(offset / size))))
+
+    x_min, y_min, x_max, y_max = bounds
+    return (
+        index(x_min + MERCATOR_HALF_WIDTH), index(MERCATOR_HALF_WIDTH - y_max),
+        index(x_max + MERCATOR_HALF_WIDTH), index(MERCATOR_HALF_WIDTH - y_min),
+    )
+
+
+def iter_tile_blocks(bounds, zoom):
+    """Bloques (x, y, columnas, filas) de hasta TILE_BLOCK x TILE_BLOCK teselas que cubren bounds"""
+    x_min, y_min, x_max, y_max = get_tile_range(bounds, zoom)
+    for y in range(y_min, y_max + 1, TILE_BLOCK):
+        for x in range(x_min, x_max + 1, TILE_BLOCK):
+            yield x, y, min(TILE_BLOCK, x_max + 1 - x), min(TILE_BLOCK, y_max + 1 - y)
+
+
+class MeteoTileRenderer:
+    """
+    Renderiza la capa de datos de los fotogramas de una variable en teselas.
+
+    Los contornos de cada fotograma se dibujan una sola vez sobre unos ejes en Web Mercator
+    que ocupan toda la figura; para cada zoom la figura se ajusta (tamaño y límites de los
+    ejes) a bloques de teselas, que se rasterizan y se dividen en teselas. La malla se
+    proyecta una vez por dominio (ver GridGeometry). Las barbas de viento se dibujan por zoom,
+    con una barba cada BARB_SPACING píxeles: todas las de la imagen completa no cabrían en los
+    zooms bajos y cada bloque las volvería a dibujar todas.
+    """
+
+    def __init__(self, var_name, lats, longs):
+        self.var_name = var_name
+        self.lats = lats
+        self.longs = longs
+        self.plot_config = get_plot_config(var_name)
+        self.geometry = get_grid_geometry(lats, longs, WEB_MERCATOR)
+        finite = np.isfinite(self.geometry.x) & np.isfinite(self.geometry.y)
+        self.bounds = (
+            float(self.geometry.x[finite].min()), float(self.geometry.y[finite].min()),
+            float(self.geometry.x[finite].max()), float(self.geometry.y[finite].max()),
+        )
+        # Tamaño medio de una celda de la malla en metros (densidad de las barbas)
+        self.cell_size = float(np.nanmedian(np.abs(np.diff(self.geometry.x, axis=1))))
+        self.fig = None
+        self.ax = None
+
+    def render(self, var_frame, u_frame=None, v_frame=None, zooms=None):
+        """Renderiza un fotograma y retorna {(z, x, y): PNG en bytes} sin las teselas vacías"""
+        from .plot_generators import draw_plot
+
+        if zooms is None:
+            zooms = get_tile_zooms()
+
+        if self.fig is None:
+            with span('figure'):
+                self._setup_figure()
+        with span('contour'):
+            artists = [
+                artist for artist in draw_plot(
+                    self.ax, self.var_name, self.plot_config, self.lats, self.longs,
+                    var_frame, u_frame, v_frame, self.geometry, barbs=False
+                )
+                if artist is not None
+            ]
+
+        tiles = {}
+        barbs = None
+        try:
+            for zoom in zooms:
+                if 'barb_increments' in self.plot_config and u_frame is not None:
+                    if barbs is not None:
+                        barbs.remove()
+                    with span('contour'):
+                        barbs = self._draw_barbs(zoom, u_frame, v_frame)
+                for x, y, columns, rows in iter_tile_blocks(self.bounds, zoom):
+                    with span('savefig'):
+                        rgba = self._render_block(zoom, x, y, columns, rows)
+                    with span('encode'):
+                        for row in range(rows):
+                            for column in range(columns):
+                                tile = rgba[row * TILE_SIZE:(row + 1) * TILE_SIZE,
+                                            column * TILE_SIZE:(column + 1) * TILE_SIZE]
+                                # Sin ningún píxel opaco la tesela está vacía
+                                if tile[..., 3].any():
+                                    tiles[(zoom, x + column, y + row)] = encode_tile(tile)
+        finally:
+            for artist in artists:
+                artist.remove()
+            if barbs is not None:
+                barbs.remove()
+        return tiles
+
+    def close(self):
+        self.fig = None
+        self.ax = None
+
+    def _setup_figure(self):
+        from .plot_generators import DPI
+
+        self.fig = Figure(dpi=DPI)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1], projection=WEB_MERCATOR)
+        # Sin marco ni fondo: sólo se dibujan los datos
+        self.ax.set_axis_off()
+        self.ax.set_aspect('auto')
+
+    def _draw_barbs(self, zoom, u_frame, v_frame):
+        # En Web Mercator el norte apunta hacia arriba en todo el mapa: las componentes u/v
+        # sirven sin rotarlas
+        cell_pixels = self.cell_size / (2 * MERCATOR_HALF_WIDTH / 2 ** zoom) * TILE_SIZE
+        step = max(1, math.ceil(BARB_SPACING / cell_pixels))
+        return self.ax.barbs(
+            self.geometry.x[::step, ::step], self.geometry.y[::step, ::step],
+            u_frame[::step, ::step], v_frame[::step, ::step],
+            length=6,
+            barb_increments=self.plot_config['barb_increments'],
+            color=self.plot_config.get('barb_color'),
+            transform=WEB_MERCATOR
+        )
+
+    def _render_block(self, zoom, x, y, columns, rows):
+        from .plot_generators import DPI
+
+        size = 2 * MERCATOR_HALF_WIDTH / 2 ** zoom
+        # Con hasta TILE_BLOCK teselas por lado el tamaño en píxeles es exacto (sin redondeo)
+        self.fig.set_size_inches(columns * TILE_SIZE / DPI, rows * TILE_SIZE / DPI)
+        self.ax.set_xlim(x * size - MERCATOR_HALF_WIDTH, (x + columns) * size - MERCATOR_HALF_WIDTH)
+        self.ax.set_ylim(MERCATOR_HALF_WIDTH - (y + rows) * size, MERCATOR_HALF_WIDTH - y * size)
+        return render_rgba(self.fig, dpi=DPI, transparent=True)
+
+
+def encode_tile(rgba):
+    """PNG de una tesela RGBA (con paleta, como las imágenes, ver encode_png)"""
+    buffer = io.BytesIO()
+    encode_png(Image.fromarray(np.ascontiguousarray(rgba)), buffer)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=1)
+def get_empty_tile():
+    """PNG de una tesela transparente (se sirve por las teselas vacías, que no se escriben)"""
+    buffer = io.BytesIO()
+    Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def get_tile_renderer(var_name, lats, longs, grid_key):
+    """
+    MeteoTileRenderer compartido por las llamadas de un mismo proceso (como
+    get_frame_renderer). Se crea uno nuevo al cambiar la variable o la malla (grid_key).
+    """
+    global _tile_renderer
+    key = (var_name, grid_key)
+    if _tile_renderer is None or _tile_renderer[0] != key:
+        _tile_renderer = (key, MeteoTileRenderer(var_name, lats, longs))
+    return _tile_renderer[1]
+
+
+def render_frame_tiles(var_name, lats, longs, grid_key, var_frame, u_frame=None, v_frame=None):
+    """Teselas de un fotograma ({(z, x, y): bytes}) o None si no se generan teselas"""
+    zooms = get_tile_zooms()
+    if not zooms:
+        return None
+    return get_tile_renderer(var_name, lats, longs, grid_key).render(var_frame, u_frame, v_frame, zooms)
+
+
+def get_tile_dir(simulation, var_name, valid_datetime):
+    """
+    Directorio de las teselas de un fotograma:
+    meteo_tiles/[datetime simulacion]/[nombre variable]/[tiempo válido]_[id]. Cada render
+    escribe en un directorio nuevo y el anterior se borra al reemplazar la fila.
+    """
+    simulation_time = simulation.initial_datetime.strftime("%Y%m%d_%H%M%S")
+    frame_dir = f"{valid_datetime.strftime('%Y%m%d%H')}_{uuid.uuid4().hex[:8]}"
+    return '/'.join(['meteo_tiles', simulation_time, var_name, frame_dir])
+
+
+def get_tile_name(tile_dir, zoom, x, y):
+    return f"{tile_dir}/{zoom}/{x}/{y}.png"
+
+
+def delete_tile_dir(tile_dir):
+    shutil.rmtree(default_storage.path(tile_dir), ignore_errors=True)
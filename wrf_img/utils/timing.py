@@ -0,0 +1,86 @@
+"""
+Tiempos por etapa de la generación de imágenes.
+
+Cada etapa se mide con span('etapa'), que no hace nada si no hay un StageTimings activo
+(ver StageTimings.activate). Los tiempos son exclusivos: si una etapa ocurre dentro de otra
+(por ejemplo la lectura de la red mientras se decodifica el JSON) se descuenta de la externa.
+
+Etapas: fetch (red), decode, cache (caché de campos), stats, figure (figura, mapa base y
+barra de colores), contour (contornos y barbas), layout (recorte de la figura), savefig
+(dibujo), encode (codificación PNG/WebP/AVIF), animation (animaciones de cada variable),
+storage (escritura de ficheros) y db.
+"""
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+_current = ContextVar('wrf_img_stage_timings', default=None)
+
+
+class StageTimings:
+    """Segundos y número de llamadas acumulados por etapa"""
+
+    def __init__(self, totals=None):
+        self.totals = {}
+        self._stack = []
+        if totals:
+            self.merge(totals)
+
+    @contextmanager
+    def activate(self):
+        """Hace que span() registre en este objeto dentro del bloque (hilo o contexto actual)"""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            self.add(stage, elapsed - nested)
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def add(self, stage, seconds, count=1):
+        total = self.totals.setdefault(stage, [0.0, 0])
+        total[0] += seconds
+        total[1] += count
+
+    def merge(self, other):
+        """Suma los tiempos de otro StageTimings o de su as_dict() (resultados de otras tareas)"""
+        if isinstance(other, StageTimings):
+            other = other.as_dict()
+        for stage, total in (other or {}).items():
+            self.add(stage, total['seconds'], total['count'])
+
+    def as_dict(self):
+        return {
+            stage: {'seconds': round(seconds, 4), 'count': count}
+            for stage, (seconds, count) in self.totals.items()
+        }
+
+    def format(self):
+        """Resumen en una línea para el log: 'fetch=1.20s decode=0.35s ...'"""
+        return ' '.join(f'{stage}={seconds:.2f}s' for stage, (seconds, _) in self.totals.items())
+
+
+def span(stage):
+    """Mide una etapa en el StageTimings activo (sin efecto si no hay ninguno)"""
+    timings = _current.get()
+    if timings is None:
+        return nullcontext()
+    return timings.span(stage)
+
+
+def record(totals):
+    """Suma al StageTimings activo tiempos medidos en otro proceso (as_dict())"""
+    timings = _current.get()
+    if timings is not None:
+        timings.merge(totals)
@@ -0,0 +1,202 @@
+"""
+Verificación de los pronósticos contra las observaciones SYNOP (station_data).
+
+Cada observación válida de una estación se empareja con el valor pronosticado en su celda de
+la malla (ver GridPointIndex) al mismo tiempo válido, leído de los campos guardados de la
+simulación (ver wrf_img.utils.field_store). Los errores de todos los pares se agrupan por
+estación y plazo con NumPy y se guardan en ForecastVerification: sesgo, MAE, RMSE y aciertos
+(error dentro de la tolerancia de la variable). Sólo se leen los fotogramas de los tiempos que
+tienen observaciones.
+"""
+import logging
+from datetime import timedelta, timezone as dt_timezone
+
+import numpy as np
+import pandas as pd
+from django.db import transaction
+
+from station_data.models import WeatherObservation
+from wrf_img.models import ForecastVerification, GridPointIndex
+from .field_store import get_field_store_path
+from .grid_index import ensure_grid_point_index
+from .plot_config import get_plot_config
+from .point_forecast import get_store_reader
+from .timing import span
+
+logger = logging.getLogger(__name__)
+
+# Variable del modelo: (campo de WeatherObservation, tolerancia de un acierto en sus unidades)
+VERIFICATION_PAIRS = {
+    'T2': ('temperature', 2.0),
+    'rh2': ('relative_humidity', 10.0),
+    'slp': ('pressure_sea_level', 2.0),
+    'ws10': ('wind_speed', 10.0),
+    'wd10': ('wind_direction_degrees', 45.0),
+}
+
+# Variables en grados (0-360): el error se toma en el círculo y se usa la celda más cercana,
+# porque interpolar direcciones a ambos lados del norte no tiene sentido
+CIRCULAR_VARIABLES = {'wd10'}
+
+
+class StationGrid:
+    """Celdas de la malla de las estaciones indexadas (arrays alineados por estación)"""
+
+    def __init__(self, grid_signature):
+        rows = list(GridPointIndex.objects.filter(
+            grid_signature=grid_signature, station__isnull=False
+        ).values_list('station_id', 'row', 'column', 'weights', 'nearest_row', 'nearest_column'))
+        self.station_ids = pd.Index([row[0] for row in rows])
+        offsets = np.array([[0, 0], [0, 1], [1, 0], [1, 1]])
+        corner = np.array([[row[1], row[2]] for row in rows], dtype=int).reshape(-1, 2)
+        # Filas y columnas de las cuatro celdas de cada estación: (estaciones, 4)
+        self.rows = corner[:, :1] + offsets[:, 0]
+        self.columns = corner[:, 1:] + offsets[:, 1]
+        self.weights = np.array([row[3] for row in rows], dtype=float).reshape(-1, 4)
+        self.nearest = np.array([[row[4], row[5]] for row in rows], dtype=int).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def extract(self, variable, frame_indexes, nearest=False):
+        """Valores de la variable en las estaciones para los fotogramas indicados: (fotogramas, estaciones)"""
+        values = np.empty((len(frame_indexes), len(self)))
+        for k, frame_index in enumerate(frame_indexes):
+            frame = np.asarray(variable[frame_index].values, dtype=float)
+            if nearest:
+                values[k] = frame[self.nearest[:, 0], self.nearest[:, 1]]
+            else:
+                # Las celdas con peso cero no cuentan aunque sean NaN
+                corners = np.where(self.weights > 0, frame[self.rows, self.columns], 0.0)
+                values[k] = (corners * self.weights).sum(axis=1)
+        return values
+
+
+def load_observations(station_ids, start, end, fields):
+    """
+    Observaciones válidas de las estaciones entre start y end (datetimes UTC) en un DataFrame
+    con las columnas station_id, time (UTC sin zona) y fields
+    """
+    columns = ['station_id', 'date', 'hour', 'observation_date_utc', 'wind_speed'] + [
+        field for field in fields if field != 'wind_speed'
+    ]
+    with span('db'):
+        records = list(WeatherObservation.objects.filter(
+            station_id__in=list(station_ids), is_valid=True,
+            date__gte=start.date(), date__lte=end.date(),
+        ).values_list(*columns))
+    observations = pd.DataFrame.from_records(records, columns=columns)
+    if observations.empty:
+        observations['time'] = pd.Series(dtype='datetime64[ns]')
+        return observations
+
+    # Los SYNOP se reportan en UTC; observation_date_utc, si existe, tiene prioridad
+    times = pd.to_datetime(
+        observations['date'].astype(str) + ' ' + observations['hour'].astype(str)
+    )
+    utc = pd.to_datetime(observations['observation_date_utc'], utc=True).dt.tz_localize(None)
+    observations['time'] = utc.fillna(times)
+    return observations
+
+
+def verify_simulation(simulation, var_names=None):
+    """
+    Verifica las variables de una simulación (todas las de VERIFICATION_PAIRS con campos
+    guardados si var_names es None) y reemplaza sus filas de ForecastVerification. Retorna
+    las filas guardadas.
+    """
+    var_names = [
+        var_name for var_name in (var_names or VERIFICATION_PAIRS)
+        if var_name in VERIFICATION_PAIRS and get_field_store_path(simulation, var_name) is not None
+    ]
+    if not var_names:
+        return []
+
+    reader = get_store_reader(simulation, var_names[0])
+    ensure_grid_point_index(reader.locator.lats, reader.locator.longs)
+    stations = StationGrid(reader.locator.signature)
+    if not len(stations):
+        return []
+
+    initial = simulation.initial_datetime.astimezone(dt_timezone.utc).replace(tzinfo=None)
+    times = pd.DatetimeIndex(reader.times)
+    observations = load_observations(
+        stations.station_ids, times[0], times[-1], [VERIFICATION_PAIRS[var_name][0] for var_name in var_names]
+    )
+    frame_positions = times.get_indexer(observations['time'])
+    station_positions = stations.station_ids.get_indexer(observations['station_id'])
+
+    verifications = []
+    for var_name in var_names:
+        field, tolerance = VERIFICATION_PAIRS[var_name]
+        observed = observations[field].to_numpy(dtype=float, na_value=np.nan)
+        valid = (frame_positions >= 0) & (station_positions >= 0) & np.isfinite(observed)
+        if var_name in CIRCULAR_VARIABLES:
+            # Sin dirección en calma
+            valid &= ~(observations['wind_speed'].to_numpy(dtype=float, na_value=np.nan) == 0)
+        if not valid.any():
+            continue
+
+        # Sólo se leen los fotogramas con observaciones
+        frames, frame_index = np.unique(frame_positions[valid], return_inverse=True)
+        with span('stats'):
+            variable = get_store_reader(simulation, var_name).dataset[var_name].variable
+            forecast = stations.extract(variable, frames, nearest=var_name in CIRCULAR_VARIABLES)
+            # En las unidades de las imágenes, las mismas de las observaciones
+            forecast *= get_plot_config(var_name).get('scale_factor', 1)
+            errors = forecast[frame_index, station_positions[valid]] - observed[valid]
+            if var_name in CIRCULAR_VARIABLES:
+                errors = (errors + 180) % 360 - 180
+            verifications.extend(aggregate_errors(
+                simulation, var_name, errors, tolerance,
+                stations.station_ids.to_numpy()[station_positions[valid]],
+                ((times[frames] - initial) // timedelta(hours=1))[frame_index],
+            ))
+
+    with span('db'), transaction.atomic():
+        ForecastVerification.objects.filter(simulation=simulation, variable_name__in=var_names).delete()
+        ForecastVerification.objects.bulk_create(verifications)
+    return verifications
+
+
+def aggregate_errors(simulation, var_name, errors, tolerance, station_ids, lead_hours):
+    """Filas de ForecastVerification de los errores agrupados por estación y plazo"""
+    valid = np.isfinite(errors)
+    errors, station_ids, lead_hours = errors[valid], station_ids[valid], np.asarray(lead_hours)[valid]
+    keys, group = np.unique(np.column_stack([station_ids, lead_hours]), axis=0, return_inverse=True)
+    group = group.ravel()
+    count = np.bincount(group, minlength=len(keys))
+    hits = np.bincount(group, weights=np.abs(errors) <= tolerance, minlength=len(keys))
+    bias = np.bincount(group, weights=errors, minlength=len(keys)) / count
+    mae = np.bincount(group, weights=np.abs(errors), minlength=len(keys)) / count
+    rmse = np.sqrt(np.bincount(group, weights=errors ** 2, minlength=len(keys)) / count)
+    return [
+        ForecastVerification(
+            simulation=simulation, variable_name=var_name,
+            station_id=int(station_id), lead_hours=int(lead),
+            count=int(count[k]), hits=int(hits[k]),
+            bias=float(bias[k]), mae=float(mae[k]), rmse=float(rmse[k]),
+        )
+        for k, (station_id, lead) in enumerate(keys)
+    ]
+
+
+def summarize_verification(queryset, by=('variable_name', 'lead_hours')):
+    """
+    Agrega filas de ForecastVerification (por ejemplo meses de ciclos) por las columnas by:
+    DataFrame con count, bias, mae, rmse y hit_rate, ponderados por el número de pares
+    """
+    columns = list(by) + ['count', 'hits', 'bias', 'mae', 'rmse']
+    rows = pd.DataFrame.from_records(list(queryset.values_list(*columns)), columns=columns)
+    # Sumas de cada fila: los promedios se recomponen sin perder exactitud
+    rows['sum_error'] = rows['bias'] * rows['count']
+    rows['sum_abs_error'] = rows['mae'] * rows['count']
+    rows['sum_squared_error'] = rows['rmse'] ** 2 * rows['count']
+    totals = rows.groupby(list(by))[['count', 'hits', 'sum_error', 'sum_abs_error', 'sum_squared_error']].sum()
+    return pd.DataFrame({
+        'count': totals['count'],
+        'bias': totals['sum_error'] / totals['count'],
+        'mae': totals['sum_abs_error'] / totals['count'],
+        'rmse': np.sqrt(totals['sum_squared_error'] / totals['count']),
+        'hit_rate': totals['hits'] / totals['count'],
+    })
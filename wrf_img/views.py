@@ -1,10 +1,25 @@
+import hashlib
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.views.decorators.http import require_GET
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 
-from .models import Simulation, MeteoImage
-from .serializers import SimulationSerializer, MeteoImageSerializer
+from .models import Simulation, MeteoImage, MeteoAnimation, MeteoLayerSet, MeteoTileSet
+from .serializers import (
+    SimulationSerializer, MeteoImageSerializer, MeteoAnimationSerializer, MeteoLayerSetSerializer,
+)
+from .utils.point_forecast import POINT_METHODS, get_point_forecast
+from .utils.regions import get_region_forecast
+from .utils.tiles import get_empty_tile, get_tile_name
 
 
 class SimulationListView(GenericAPIView):
@@ -45,13 +60,32 @@ class SimulationListView(GenericAPIView):
 
                 # Serializar imágenes pasando el request para construir URLs absolutas
                 serializer = MeteoImageSerializer(images, many=True, context={'request': request})
-                return Response({
+                animations = MeteoAnimationSerializer(
+                    MeteoAnimation.objects.filter(simulation=simulation, variable_name=var_name),
+                    many=True, context={'request': request}
+                )
+                layer_set = MeteoLayerSet.objects.filter(simulation=simulation, variable_name=var_name).first()
+                tile_sets = MeteoTileSet.objects.filter(
+                    simulation=simulation, variable_name=var_name
+                ).order_by('valid_datetime')
+                response = Response({
                     'status': 'success',
                     'simulation_date': simulation.initial_datetime.isoformat(),
                     'variable_name': var_name,
                     'image_urls': [item['image_url'] for item in serializer.data],
+                    # Animación de todos los fotogramas por formato (webp, apng, webm)
+                    'animation_urls': {item['animation_format']: item['url'] for item in animations.data},
+                    # Plantillas {z}/{x}/{y} de las teselas de cada tiempo (si se generan)
+                    'tile_urls': [get_tile_url_template(request, tile_set) for tile_set in tile_sets],
+                    # Producto por capas: capa de datos de cada tiempo, leyenda y mapa base compartidos
+                    'layers': get_layers(request, layer_set, serializer.data),
+                    # Estadísticas de cada tiempo: extremos, percentiles, áreas sobre umbrales, histograma
+                    'stats': [item['stats'] for item in serializer.data],
                     'count': len(serializer.data)
                 })
+                # El formato de las imágenes (PNG, WebP o AVIF) depende de la cabecera Accept
+                patch_vary_headers(response, ['Accept'])
+                return response
 
             except ValueError:
                 return Response({
@@ -73,3 +107,237 @@ class SimulationListView(GenericAPIView):
                 'simulations': [item['initial_datetime'] for item in serializer.data],
                 'count': len(serializer.data)
             })
+
+
+class PointForecastView(GenericAPIView):
+    """
+    Pronóstico de una o varias variables en un punto, a partir de los campos guardados de la
+    simulación (ver wrf_img.utils.point_forecast).
+    URL: /api/simulations/point/?datetime_init=YYYYMMDDHH&variables=T2,rh2&lat=23.1&lon=-82.4
+    El punto se indica con lat/lon, town (id del municipio) o station (número de la estación);
+    method es 'bilinear' (por defecto) o 'nearest'.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        datetime_init = request.GET.get('datetime_init')
+        variables = [var for var in request.GET.get('variables', '').split(',') if var]
+        method = request.GET.get('method', 'bilinear')
+        if not datetime_init or not variables:
+            return Response({
+                'status': 'error',
+                'message': 'Los parámetros datetime_init y variables son obligatorios'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if method not in POINT_METHODS:
+            return Response({
+                'status': 'error',
+                'message': f"Método inválido. Use {' o '.join(POINT_METHODS)}"
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            dt_obj = timezone.make_aware(datetime.strptime(datetime_init, '%Y%m%d%H'))
+        except ValueError:
+            return Response({
+                'status': 'error',
+                'message': 'Formato de fecha inválido. Use YYYYMMDDHH'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            location, place = get_point(request)
+        except (ValueError, LookupError) as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        simulation = Simulation.objects.filter(initial_datetime=dt_obj).first()
+        if not simulation:
+            return Response({
+                'status': 'error',
+                'message': f'No se encontró simulación para la fecha: {datetime_init}'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            forecast = get_point_forecast(simulation, variables, location['lat'], location['lon'], method, **place)
+        except LookupError as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_404_NOT_FOUND)
+        except ValueError as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'status': 'success',
+            'simulation_date': simulation.initial_datetime.isoformat(),
+            'location': location,
+            'method': method,
+            **forecast,
+        })
+
+
+class RegionForecastView(GenericAPIView):
+    """
+    Media (ponderada por área), máximo y suma de una o varias variables en cada tiempo válido
+    por provincia o municipio (ver wrf_img.utils.regions).
+    URL: /api/simulations/regions/?datetime_init=YYYYMMDDHH&variables=RAINC&province=1&hours=24
+    La región se indica con province (id o código de la provincia) o town (id del municipio);
+    sin ninguna se devuelven todas las provincias. hours limita los tiempos a las primeras
+    hours horas de la simulación.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        from station_data.models import Province, Town
+
+        datetime_init = request.GET.get('datetime_init')
+        variables = [var for var in request.GET.get('variables', '').split(',') if var]
+        if not datetime_init or not variables:
+            return Response({
+                'status': 'error',
+                'message': 'Los parámetros datetime_init y variables son obligatorios'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            dt_obj = timezone.make_aware(datetime.strptime(datetime_init, '%Y%m%d%H'))
+            hours = int(request.GET['hours']) if request.GET.get('hours') else None
+        except ValueError:
+            return Response({
+                'status': 'error',
+                'message': 'Formato inválido. Use YYYYMMDDHH para datetime_init y un entero para hours'
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        province = town = None
+        if request.GET.get('town'):
+            town = Town.objects.filter(pk=request.GET['town']).first() if request.GET['town'].isdigit() else None
+            if town is None:
+                return Response({
+                    'status': 'error',
+                    'message': f"No se encontró el municipio: {request.GET['town']}"
+                }, status=status.HTTP_404_NOT_FOUND)
+        elif request.GET.get('province'):
+            value = request.GET['province']
+            province = Province.objects.filter(code=value).first()
+            if province is None and value.isdigit():
+                province = Province.objects.filter(pk=value).first()
+            if province is None:
+                return Response({
+                    'status': 'error',
+                    'message': f'No se encontró la provincia: {value}'
+                }, status=status.HTTP_404_NOT_FOUND)
+
+        simulation = Simulation.objects.filter(initial_datetime=dt_obj).first()
+        if not simulation:
+            return Response({
+                'status': 'error',
+                'message': f'No se encontró simulación para la fecha: {datetime_init}'
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            forecast = get_region_forecast(simulation, variables, province=province, town=town, hours=hours)
+        except LookupError as e:
+            return Response({
+                'status': 'error',
+                'message': str(e)
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        return Response({
+            'status': 'success',
+            'simulation_date': simulation.initial_datetime.isoformat(),
+            **forecast,
+        })
+
+
+def get_point(request):
+    """
+    Punto de la consulta ({'lat', 'lon', 'name'}) a partir de lat/lon, town o station, y la
+    estación o el municipio ({'station': ...} o {'town': ...}) para usar su índice en la malla
+    """
+    from station_data.models import Station, Town
+
+    town = request.GET.get('town')
+    station = request.GET.get('station')
+    if town:
+        place = Town.objects.filter(pk=int(town)).first()
+        if place is None:
+            raise LookupError(f'No se encontró el municipio: {town}')
+        field = 'town'
+    elif station:
+        place = Station.objects.filter(number=int(station)).first()
+        if place is None:
+            raise LookupError(f'No se encontró la estación: {station}')
+        field = 'station'
+    else:
+        lat = request.GET.get('lat')
+        lon = request.GET.get('lon')
+        if lat is None or lon is None:
+            raise ValueError('Indique lat y lon, town o station')
+        lat, lon = float(lat), float(lon)
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError('Coordenadas fuera de rango')
+        return {'lat': lat, 'lon': lon, 'name': None}, {}
+    return {'lat': place.latitude, 'lon': place.longitude, 'name': str(place)}, {field: place}
+
+
+def get_layers(request, layer_set, images):
+    """Producto por capas de una variable (None si no se generan capas de datos)"""
+    if layer_set is None:
+        return None
+    layers = MeteoLayerSetSerializer(layer_set, context={'request': request}).data
+    layers['overlay_urls'] = [item['overlay_url'] for item in images if item['overlay_url']]
+    return layers
+
+
+def get_tile_url_template(request, tile_set):
+    """URL de las teselas de un fotograma con {z}, {x} e {y} (formato de Leaflet y OpenLayers)"""
+    url = reverse('meteo_tile', kwargs={
+        'datetime_init': timezone.localtime(tile_set.simulation.initial_datetime).strftime('%Y%m%d%H'),
+        'var_name': tile_set.variable_name,
+        'valid_time': timezone.localtime(tile_set.valid_datetime).strftime('%Y%m%d%H'),
+        'z': 0, 'x': 0, 'y': 0,
+    })
+    return request.build_absolute_uri(url[:-len('0/0/0.png')]) + '{z}/{x}/{y}.png'
+
+
+@require_GET
+def meteo_tile(request, datetime_init, var_name, valid_time, z, x, y):
+    """
+    Tesela XYZ de la capa de datos de un fotograma (ver wrf_img.utils.tiles). Las teselas
+    vacías no se guardan: dentro de los zooms generados se responde con una tesela
+    transparente. Las respuestas se pueden cachear WRF_IMG_TILE_MAX_AGE segundos y llevan un
+    ETag que cambia cuando el fotograma se vuelve a renderizar.
+    """
+    try:
+        initial_datetime = timezone.make_aware(datetime.strptime(datetime_init, '%Y%m%d%H'))
+        valid_datetime = timezone.make_aware(datetime.strptime(valid_time, '%Y%m%d%H'))
+    except ValueError:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Formato de fecha inválido. Use YYYYMMDDHH'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    tile_set = MeteoTileSet.objects.filter(
+        simulation__initial_datetime=initial_datetime,
+        variable_name=var_name,
+        valid_datetime=valid_datetime,
+    ).first()
+    if tile_set is None or not tile_set.min_zoom <= z <= tile_set.max_zoom or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return JsonResponse({
+            'status': 'error',
+            'message': f'No existe la tesela {z}/{x}/{y} de {var_name} para {valid_time}'
+        }, status=status.HTTP_404_NOT_FOUND)
+
+    name = get_tile_name(tile_set.tile_dir, z, x, y)
+    etag = f'"{hashlib.md5(name.encode()).hexdigest()}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        if default_storage.exists(name):
+            response = FileResponse(default_storage.open(name, 'rb'), content_type='image/png')
+        else:
+            response = HttpResponse(get_empty_tile(), content_type='image/png')
+        response['ETag'] = etag
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'WRF_IMG_TILE_MAX_AGE', 604800))
+    return response